@@ -0,0 +1,110 @@
+# File: alt_text.py
+# Clients that suggest alt text for images, and a rate limiter for calling them in bulk
+
+import hashlib
+import threading
+import time
+from openai import OpenAI
+
+ALT_TEXT_PROMPT = (
+    "Please describe the contents of this image in detail using the format of a11y alt text. "
+    "If possible, please keep the response length to within three sentences or 50 words. "
+    "Please try to keep the response scope limited to the primary focuses of the image. "
+    "Please do not start the response with the phrase 'Alt text' or similar phrases. "
+    "Only include the actual alt text in the response."
+)
+
+
+class OpenAIAltTextClient:
+    """Asks an OpenAI vision model to describe images"""
+
+    def __init__(self, api_key, model="gpt-4o", timeout=60):
+        self.model = model
+        self._client = OpenAI(api_key=api_key, timeout=timeout)
+
+    def describe(self, image_url: str) -> str:
+        """Suggest alt text for the image at `image_url`, which must be publicly fetchable"""
+        response = self._client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": ALT_TEXT_PROMPT,
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                                "detail": "low"  # Saves tokens/money
+                            }
+                        }
+                    ]
+                }
+            ],
+            max_tokens=300
+        )
+        return response.choices[0].message.content
+
+
+class StubAltTextClient:
+    """Returns made-up alt text without calling anything, after an optional delay that simulates a real model.
+    Used for local development, tests and benchmarking the batch job
+    """
+
+    model = "stub"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def describe(self, image_url: str) -> str:
+        with self._lock:
+            self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        # presigned URLs change over time, so only the path identifies the image
+        digest = hashlib.md5(image_url.split("?")[0].encode()).hexdigest()[:8]
+        return f"Placeholder description of image {digest}"
+
+
+def make_alt_text_client(kind, api_key=None, model="gpt-4o", stub_delay=0.0):
+    """Create the alt text client named by `kind` ("openai" or "stub")
+
+    Returns:
+        the client, or None if `kind` is "openai" and there is no API key
+    """
+    if kind == "stub":
+        return StubAltTextClient(delay=stub_delay)
+    if kind == "openai":
+        if not api_key:
+            return None
+        return OpenAIAltTextClient(api_key, model=model)
+    raise ValueError(f"Unknown alt text client {kind!r}, expected 'openai' or 'stub'")
+
+
+class RateLimiter:
+    """A thread-safe token bucket allowing `per_minute` calls a minute on average, in bursts of up to `burst`"""
+
+    def __init__(self, per_minute, burst=1):
+        self.interval = 60.0 / per_minute
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.interval
+            time.sleep(wait)
@@ -1,21 +1,39 @@
 import os
 import io
+import mimetypes
 import subprocess
+import tempfile
 from dateutil import parser
 from enum import Enum
-from flask import Flask, render_template, request, redirect, abort, url_for, make_response, session, jsonify
+from flask import Flask, render_template, request, redirect, abort, url_for, make_response, session, jsonify, Response, stream_with_context, flash, send_file
 import logging
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import HTTPException
 import hashlib
 import re
+from dataclasses import dataclass, field
+import json
+import csv
+import zipfile
+import base64
 from functools import wraps
 from random import shuffle
 from PIL import Image as PilImage
 from relative_datetime import DateTimeUtils
 from PIL.ExifTags import TAGS as EXIF_TAGS, Base as ExifBase
-from datetime import datetime, timezone
-from sqlalchemy import and_
+from datetime import datetime, timezone, timedelta
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import time
+from sqlalchemy import and_, true
+from botocore.exceptions import ClientError
+from sqlalchemy.orm import joinedload, contains_eager, selectin_polymorphic
+from sqlalchemy.dialects.postgresql import insert as pg_insert, REGCONFIG, aggregate_order_by
+from sqlalchemy.sql import sqltypes
+from markupsafe import Markup, escape
+from flask.cli import AppGroup
+import click
 from db import (
     db,
     func,
@@ -33,6 +51,7 @@ from db import (
     DoorButton,
     Elevator,
     AccessPointReports,
+    AccessPointCurrentStatus,
     AccessPointConcordances,
     Report,
     Status,
@@ -41,21 +60,37 @@ from db import (
     AccessPointTag,
     ImageAccessPointRelation,
     Feedback,
-    StatusType
+    ImageJob,
+    ImageJobStatus,
+    CacheVersion,
+    touched_cache_versions,
+    FileDeletion,
+    GeneratedAltText,
+    StatusType,
+    SEARCH_CONFIG
 )
 from flask_migrate import Migrate, stamp, upgrade
 from flask_cors import CORS, cross_origin
-from s3 import S3Bucket
-from typing import Optional, Union
+from s3 import S3Bucket, DELETE_BATCH_SIZE
+from storage import LocalStorage, UploadError
+from perceptual_hash import dhash, BKTree
+from alt_text import make_alt_text_client, RateLimiter
+from archive import ZipStream
+from typing import IO, Optional, Union
 import shutil
-import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed to export Parquet files
+    pa = None
 import json_log_formatter
 from pathlib import Path
+from collections import deque
 from dotenv import load_dotenv
-from helpers import floor_to_integer, RoomNumber, integer_to_floor, MapLocation, ServiceNowStatus, ServiceNowUpdateType, save_user_details, check_for_admin_role, get_logged_in_user_id, get_logged_in_user, get_logged_in_user_info
+from helpers import floor_to_integer, RoomNumber, integer_to_floor, MapLocation, ServiceNowStatus, ServiceNowUpdateType, save_user_details, check_for_admin_role, refresh_auth0_user_roles, get_logged_in_user_id, get_logged_in_user, get_logged_in_user_info
 from urllib.parse import quote_plus, urlencode
 from authlib.integrations.flask_client import OAuth
-from openai import OpenAI
 from config import DefaultConfig
 
 
@@ -115,20 +150,41 @@ else:
     logging.info("Auth configuration not available due to missing variables. Ensure all of AUTH0_DOMAIN, CPACCESS_SECRET_KEY, AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET are present")
 
 
-# Make sure your OPENAI_API_KEY is in your environment variables
-gptClient = None
-if os.environ.get("OPENAI_API_KEY"):
-    gptClient = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
+# Make sure your OPENAI_API_KEY is in your environment variables (or set ALT_TEXT_CLIENT=stub to try things out without one)
+alt_text_client = make_alt_text_client(
+    os.environ.get("ALT_TEXT_CLIENT", app.config["ALT_TEXT_CLIENT"]),
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    model=app.config["ALT_TEXT_MODEL"],
+)
 
-logging.info(f"Connecting to S3 Bucket {os.environ.get('BUCKET_NAME')}")
 
-s3_bucket = S3Bucket(
-    os.environ.get("BUCKET_NAME"),
-    os.environ.get("S3_KEY"),
-    os.environ.get("S3_SECRET"),
-    os.environ.get("S3_URL"),
-)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", app.config["STORAGE_BACKEND"])
+
+if STORAGE_BACKEND == "local":
+    logging.info(f"Storing files in {os.environ.get('LOCAL_STORAGE_ROOT', app.config['LOCAL_STORAGE_ROOT'])}")
+    storage = LocalStorage(os.environ.get("LOCAL_STORAGE_ROOT", app.config["LOCAL_STORAGE_ROOT"]))
+elif STORAGE_BACKEND == "s3":
+    logging.info(f"Connecting to S3 Bucket {os.environ.get('BUCKET_NAME')}")
+
+    storage = S3Bucket(
+        os.environ.get("BUCKET_NAME"),
+        os.environ.get("S3_KEY"),
+        os.environ.get("S3_SECRET"),
+        os.environ.get("S3_URL"),
+        url_expires_in=int(os.environ.get("S3_URL_EXPIRES_IN", app.config["S3_URL_EXPIRES_IN"])),
+        url_cache_ttl=int(os.environ.get("S3_URL_CACHE_TTL", app.config["S3_URL_CACHE_TTL"])),
+        url_cache_size=int(app.config["S3_URL_CACHE_SIZE"]),
+        upload_concurrency=int(app.config["S3_UPLOAD_CONCURRENCY"]),
+        multipart_threshold=int(app.config["S3_MULTIPART_THRESHOLD"]),
+        multipart_chunksize=int(app.config["S3_MULTIPART_CHUNKSIZE"]),
+        multipart_concurrency=int(app.config["S3_MULTIPART_CONCURRENCY"]),
+        max_pool_connections=int(app.config["S3_MAX_POOL_CONNECTIONS"]),
+        connect_timeout=app.config["S3_CONNECT_TIMEOUT"],
+        read_timeout=app.config["S3_READ_TIMEOUT"],
+        max_attempts=int(app.config["S3_MAX_ATTEMPTS"]),
+    )
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, expected 's3' or 'local'")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = (
     f'postgresql://{os.environ.get("DBUSER")}:{os.environ.get("DBPWD")}@{os.environ.get("DBHOST")}:{os.environ.get("DBPORT", "5432")}/{os.environ.get("DBNAME")}'
@@ -164,8 +220,34 @@ class ImageType(Enum):
     RESIZED = "resized"
     ORIGINAL = "original"
 
+class ImageFormat(Enum):
+    """Formats responsive variants are encoded in. Values are the file extensions"""
+    AVIF = "avif"
+    WEBP = "webp"
+    JPEG = "jpg"
+
+    @property
+    def mimetype(self):
+        return "image/jpeg" if self is ImageFormat.JPEG else f"image/{self.value}"
+
+    @property
+    def pil_format(self):
+        return self.name
+
+# passed to PIL when encoding each format
+VARIANT_SAVE_OPTIONS = {
+    ImageFormat.AVIF: {"quality": 60},
+    ImageFormat.WEBP: {"quality": 80, "method": 4},
+    ImageFormat.JPEG: {"quality": 82, "optimize": True, "progressive": True},
+}
+
 def get_latest_naming_version():
-    return 1
+    return 2
+
+def get_variant_formats() -> list[ImageFormat]:
+    """The formats this install can encode variants in, most efficient first. AVIF needs a Pillow build (or plugin) that supports it"""
+    PilImage.init()
+    return [f for f in ImageFormat if f.pil_format in PilImage.SAVE]
 
 def path_for_image(file_hash:str, image_type: ImageType, naming_version=0) -> str:
     if file_hash is None:
@@ -173,35 +255,199 @@ def path_for_image(file_hash:str, image_type: ImageType, naming_version=0) -> st
 
     if naming_version == 0:
         return file_hash
-    elif naming_version == 1:
+    elif naming_version in (1, 2):
+        # version 2 keeps version 1's files and adds responsive variants alongside them
         return f"{file_hash}_{image_type.value}.jpg"
 
 
+def path_for_image_variant(file_hash:str, width: int, image_format: ImageFormat) -> str:
+    """Path to a responsive variant of an image (naming version 2 and up)"""
+    return f"{file_hash}_w{width}.{image_format.value}"
+
+
+def variant_paths_for_image(image: Image) -> list[str]:
+    """Paths to all of an image's responsive variants"""
+    if image.naming_version < 2 or not image.variant_widths or not image.variant_formats:
+        return []
+    return [
+        path_for_image_variant(image.fullsizehash, width, ImageFormat(image_format))
+        for width in image.variant_widths
+        for image_format in image.variant_formats
+    ]
+
+
+def paths_for_image(image) -> set[str]:
+    """Paths to every file stored for an image: the original, resized and thumbnail copies and any responsive variants.
+    Works with anything that has the Image columns as attributes, like a row selecting them
+    """
+    paths = {
+        path_for_image(image.fullsizehash, image_type, naming_version=image.naming_version)
+        for image_type in ImageType
+    }
+    paths.update(variant_paths_for_image(image))
+    return paths
+
+
+def url_for_image(file_hash:str, image_type: ImageType, naming_version=0) -> str:
+    """Get the URL a browser should load an image from.
+
+    When IMAGE_PROXY is enabled this is the long-lived, cacheable /img route. Otherwise it is a presigned S3 URL.
+    """
+    if file_hash is None or not app.config["IMAGE_PROXY"]:
+        return storage.get_file_s3(path_for_image(file_hash, image_type, naming_version=naming_version))
+
+    # the naming version is part of the URL so that re-encoding an image under a new version busts caches
+    return url_for("image_proxy", file_hash=file_hash, image_type=image_type.value, v=naming_version)
+
+
+def url_for_image_variant(file_hash:str, width: int, image_format: ImageFormat, naming_version=2) -> str:
+    """Get the URL a browser should load a responsive variant of an image from. See url_for_image"""
+    if not app.config["IMAGE_PROXY"]:
+        return storage.get_file_s3(path_for_image_variant(file_hash, width, image_format))
+    return url_for("image_proxy", file_hash=file_hash, image_type=f"w{width}.{image_format.value}", v=naming_version)
+
+
+def concordance_select(identifier: str):
+    """Select the concordance with an external identifier"""
+    return db.select(AccessPointConcordances).where(AccessPointConcordances.identifier == identifier)
+
+
 def lookup_access_point_for_concordance_id(session, identifier:str):
-    concordance = session.query(AccessPointConcordances).filter(AccessPointConcordances.identifier == identifier).first()
+    concordance = session.execute(concordance_select(identifier)).scalars().first()
     if concordance:
         return concordance.access_point
 
 
-def access_point_json(access_point: AccessPoint):
+def access_point_images_select(access_point_ids):
+    """Select (access point id, Image) pairs for the given access points, in display order"""
+    return (
+        db.select(ImageAccessPointRelation.access_point_id, Image)
+        .join(Image, Image.id == ImageAccessPointRelation.image_id)
+        .where(ImageAccessPointRelation.access_point_id.in_(access_point_ids))
+        .order_by(ImageAccessPointRelation.access_point_id, ImageAccessPointRelation.ordering.asc())
+    )
+
+
+def access_point_statuses_select(access_point_ids):
+    """Select (access point id, Status) pairs of the current status of the given access points, with each status's report loaded"""
+    return (
+        db.select(AccessPointCurrentStatus.access_point_id, Status)
+        .join(Status, Status.id == AccessPointCurrentStatus.status_id)
+        .join(Report, Report.id == Status.report_id)
+        .options(contains_eager(Status.report))
+        .where(AccessPointCurrentStatus.access_point_id.in_(access_point_ids))
+    )
+
+
+def access_point_tags_select(access_point_ids):
+    """Select (access point id, tag name) pairs for the given access points"""
+    return (
+        db.select(AccessPointTag.access_point_id, Tag.name)
+        .join(Tag, AccessPointTag.tag_id == Tag.id)
+        .where(AccessPointTag.access_point_id.in_(access_point_ids))
+    )
+
+
+def load_access_point_relations(access_points: list[AccessPoint]) -> dict:
+    """Resolve everything `access_point_json` needs for a batch of access points
+    using a fixed number of set-based queries (instead of several per access point)
+
+    Args:
+        access_points (list[AccessPoint]): the access points to load relations for
+
+    Returns:
+        dict: lookups of images, thumbnails, statuses and tags keyed by access point id, and locations keyed by location id
+    """
+    ids = [ap.id for ap in access_points]
+    relations = {
+        "locations": {},
+        "images": {i: [] for i in ids},
+        "thumbnails": {},
+        "statuses": {},
+        "tags": {i: [] for i in ids},
+    }
+    if not ids:
+        return relations
+
+    # keep the locations (with their buildings) in the lookup itself. The session identity map
+    # only holds weak references, so loaded-but-unreferenced objects would be dropped and lazy loaded again
+    location_ids = {ap.location_id for ap in access_points}
+    relations["locations"] = {
+        l.id: l for l in db.session.execute(
+            db.select(Location)
+            .options(joinedload(Location.building))
+            .where(Location.id.in_(location_ids))
+        ).scalars()
+    }
+
+    image_rows = db.session.execute(access_point_images_select(ids)).all()
+    for access_point_id, image in image_rows:
+        relations["images"][access_point_id].append(image)
+
+    # thumbnails follow the same rules as get_item_thumbnail
+    thumbnail_refs = {ap.thumbnail_ref for ap in access_points if ap.thumbnail_ref is not None}
+    thumbnail_images = {}
+    if thumbnail_refs:
+        thumbnail_images = {
+            i.id: i for i in db.session.execute(
+                db.select(Image).where(Image.id.in_(thumbnail_refs))
+            ).scalars()
+        }
+    for ap in access_points:
+        thumbnail = thumbnail_images.get(ap.thumbnail_ref)
+        if thumbnail is None and relations["images"][ap.id]:
+            thumbnail = relations["images"][ap.id][0]
+        relations["thumbnails"][ap.id] = thumbnail
+
+    # most recent status per access point, as in get_item_status
+    status_rows = db.session.execute(access_point_statuses_select(ids)).all()
+    relations["statuses"] = dict(status_rows)
+
+    tag_rows = db.session.execute(access_point_tags_select(ids)).all()
+    for access_point_id, tag_name in tag_rows:
+        relations["tags"][access_point_id].append(tag_name)
+
+    return relations
+
+
+def access_points_json(access_points) -> list[dict]:
+    """
+    Create JSON objects for a list of access_points, loading their relations in bulk
+    """
+    access_points = list(access_points)
+    relations = load_access_point_relations(access_points)
+    return [access_point_json(ap, relations=relations) for ap in access_points]
+
+
+def select_access_points():
+    """Base select for lists of access points.
+    Loads the subclass (elevator/button) columns for every row up front rather than one row at a time
+    """
+    return db.select(AccessPoint).options(
+        selectin_polymorphic(AccessPoint, [DoorButton, Elevator])
+    )
+
+
+def access_point_json(access_point: AccessPoint, relations: dict = None):
     """
     Create a JSON object for a access_point
+
+    `relations` is the output of `load_access_point_relations`. If not provided, it is loaded for just this access point.
     """
-    image_data = db.session.execute(
-        db.select(Image)
-        .join(ImageAccessPointRelation, Image.id == ImageAccessPointRelation.image_id)
-        .where(ImageAccessPointRelation.access_point_id == access_point.id)
-        .order_by(ImageAccessPointRelation.ordering)
-    ).scalars()
-    images = [image_json(i) for i in image_data]
-    thumbnail = get_item_thumbnail(access_point)
-    naming_version = thumbnail.naming_version if thumbnail is not None else None
-    thumbnail = thumbnail.fullsizehash if thumbnail is not None else None
-    thumbnail = s3_bucket.get_file_s3(path_for_image(thumbnail, ImageType.THUMB, naming_version=naming_version))
+    if relations is None:
+        relations = load_access_point_relations([access_point])
 
-    rn = RoomNumber(access_point.location.floor_number, access_point.location.room_number)
+    location = relations["locations"][access_point.location_id]
 
-    status = get_item_status(access_point)
+    images = [image_json(i) for i in relations["images"][access_point.id]]
+    thumbnail_image = relations["thumbnails"][access_point.id]
+    naming_version = thumbnail_image.naming_version if thumbnail_image is not None else None
+    thumbnail = thumbnail_image.fullsizehash if thumbnail_image is not None else None
+    thumbnail = url_for_image(thumbnail, ImageType.THUMB, naming_version=naming_version)
+
+    rn = RoomNumber(location.floor_number, location.room_number)
+
+    status = relations["statuses"].get(access_point.id)
     status_style = None
     statusUpdated = "No Data"
     if status is None:
@@ -215,32 +461,38 @@ def access_point_json(access_point: AccessPoint):
     base_data = {
         "id": access_point.id,
         "thumbnail_ref": access_point.thumbnail_ref or "",
-        "building_name": access_point.location.building.name,
-        "room": access_point.location.room_number,
-        "floor": access_point.location.floor_number,
+        "building_name": location.building.name,
+        "room": location.room_number,
+        "floor": location.floor_number,
         "notes": access_point.remarks,
         "active": "checked" if access_point.active else "unchecked",
         "status": status_style,
         "status_updated": statusUpdated,
         "images": images,
-        "tags": getTags(access_point.id)
+        "tags": relations["tags"][access_point.id]
     }
 
     if thumbnail is not None:
         base_data.update({"thumbnail": thumbnail})
-    if access_point.location.nickname is not None:
-        base_data.update({"location_nick": access_point.location.nickname})
+    if thumbnail_image is not None:
+        base_data.update({
+            "thumbnail_width": thumbnail_image.thumb_width,
+            "thumbnail_height": thumbnail_image.thumb_height,
+            "thumbnail_placeholder": thumbnail_image.placeholder,
+        })
+    if location.nickname is not None:
+        base_data.update({"location_nick": location.nickname})
 
-    if access_point.location.additional_info is not None:
-        base_data.update({"location_info": access_point.location.additional_info})
+    if location.additional_info is not None:
+        base_data.update({"location_info": location.additional_info})
 
-    if access_point.location.latitude is not None and access_point.location.longitude:
-        base_data.update({"coordinates": MapLocation.to_string(access_point.location.latitude, access_point.location.longitude)})
+    if location.latitude is not None and location.longitude:
+        base_data.update({"coordinates": MapLocation.to_string(location.latitude, location.longitude)})
 
     if isinstance(access_point, Elevator):
-        title = access_point.location.building.human_name()
+        title = location.building.human_name()
         title += f" - "
-        title += access_point.location.human_name()
+        title += location.human_name()
 
         base_data.update(
             {
@@ -248,7 +500,7 @@ def access_point_json(access_point: AccessPoint):
                 "room": rn.to_string(),
                 "door_count": access_point.door_count,
                 "descriptor": "elevator",
-                "report_url": f"https://report.campuspulse.app/elevator?room={rn.to_string()}+{access_point.location.nickname}&campuspulse_id={access_point.id}&building={access_point.location.building.number}:{access_point.location.building.human_name()}"
+                "report_url": f"https://report.campuspulse.app/elevator?room={rn.to_string()}+{location.nickname}&campuspulse_id={access_point.id}&building={location.building.number}:{location.building.human_name()}"
             }
         )
 
@@ -259,9 +511,9 @@ def access_point_json(access_point: AccessPoint):
     elif isinstance(access_point, DoorButton):
 
         # TODO: Decide title
-        # title = access_point.location.building.human_name()
+        # title = location.building.human_name()
         # title += f" - "
-        # title += access_point.location.human_name()\
+        # title += location.human_name()\
 
         base_data.update(
             {
@@ -273,7 +525,7 @@ def access_point_json(access_point: AccessPoint):
                 "mount_style": access_point.mount_style,
                 "powered_by": access_point.powered_by,
                 "descriptor": "button",
-                "report_url": f"https://report.campuspulse.app/button?room={rn.to_string()}+{access_point.location.nickname}&campuspulse_id={access_point.id}&building={access_point.location.building.number}:{access_point.location.building.human_name()}"#&floor={}
+                "report_url": f"https://report.campuspulse.app/button?room={rn.to_string()}+{location.nickname}&campuspulse_id={access_point.id}&building={location.building.number}:{location.building.human_name()}"#&floor={}
             }
         )
 
@@ -315,34 +567,6 @@ def formFieldData():
         }
     }
 
-def map_features_geojson(access_point: AccessPoint):
-    """
-    Creates a geojson for map feature
-    """
-    status = get_item_status(access_point)
-
-    if status is None:
-        status = (StatusType.UNKNOWN, "No Data")
-    else: 
-        status = status.statusInfo()
-    # TODO: use marshmallow to serialize
-    base_data = {
-        "type": "Feature",
-        "properties":{
-            "id": access_point.id,
-            "building_name": access_point.location.building.name,
-            "room": access_point.location.room_number,
-            "status": status[0].name,
-        },
-        "geometry":{
-            "coordinates": MapLocation.to_long_lat(access_point.location.latitude, access_point.location.longitude),
-            "type": "Point"
-        }
-    }
-
-    return base_data
-
-
 def feedback_json(feedback: Feedback):
     """
     Create a JSON object for Feedback
@@ -375,15 +599,39 @@ def image_json(image: Image):
     """
 
     out = {
-        "imgurl": s3_bucket.get_file_s3(path_for_image(image.fullsizehash, ImageType.RESIZED, naming_version=image.naming_version)),
+        "imgurl": url_for_image(image.fullsizehash, ImageType.RESIZED, naming_version=image.naming_version),
         "caption": image.caption or "",
         "alttext": image.alttext or "",
         "attribution": image.attribution or "Anonymous",
         "datecreated": image.datecreated,
         "id": image.id,
+        # of imgurl, as displayed. None for images that haven't been measured yet
+        "width": image.resized_width,
+        "height": image.resized_height,
+        "bytes": image.resized_bytes,
+        "placeholder": image.placeholder,
     }
     if image.fullsizehash != None:
-        out["fullsizeimage"] = s3_bucket.get_file_s3(path_for_image(image.fullsizehash, ImageType.ORIGINAL, naming_version=image.naming_version))
+        out["fullsizeimage"] = url_for_image(image.fullsizehash, ImageType.ORIGINAL, naming_version=image.naming_version)
+        out["fullsize_width"] = image.original_width
+        out["fullsize_height"] = image.original_height
+        out["fullsize_bytes"] = image.original_bytes
+
+    # responsive variants, for <picture>. "srcset" is the JPEG fallback for the <img> itself
+    out["sources"] = []
+    out["srcset"] = None
+    if image.naming_version >= 2 and image.variant_widths and image.variant_formats:
+        for image_format in ImageFormat:
+            if image_format.value not in image.variant_formats:
+                continue
+            srcset = ", ".join(
+                f"{url_for_image_variant(image.fullsizehash, width, image_format, naming_version=image.naming_version)} {width}w"
+                for width in sorted(image.variant_widths)
+            )
+            if image_format is ImageFormat.JPEG:
+                out["srcset"] = srcset
+            else:
+                out["sources"].append({"type": image_format.mimetype, "srcset": srcset})
     return out
 
 
@@ -413,60 +661,128 @@ def limit_height(pil_img, height_limit):
     return pil_img.resize((width, height))
 
 
+# ts_headline doesn't escape the text it highlights, so mark matches with control characters
+# and swap them for tags after the snippet has been escaped
+SNIPPET_START = "\x02"
+SNIPPET_STOP = "\x03"
+SNIPPET_OPTIONS = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxFragments=2, MaxWords=20, MinWords=5"
+
+
+def highlight_snippet(snippet: str) -> Markup:
+    """
+    Turn a ts_headline snippet into safe HTML with matches wrapped in <mark>
+    """
+    if snippet is None:
+        return None
+    html = str(escape(snippet))
+    html = html.replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+    return Markup(html)
+
+
 def searchAccessPoints(query):
     """
-    Search all access points given query
+    Search all access points given query, best matches first
     """
-    return list(
-        map(
-            access_point_json,
-            db.session.execute(
-                db.select(AccessPoint)
-                .where(
-                    text(
-                        "access_point.text_search_index @@ websearch_to_tsquery(:query)"
-                    )
-                )
-                .order_by(AccessPoint.id)
-                .limit(150),
-                {"query": query},
-            ).scalars(),
-        )
+    config = db.cast(SEARCH_CONFIG, REGCONFIG)
+    tsquery = func.websearch_to_tsquery(config, query)
+    rank = func.ts_rank(AccessPoint.text_search_index, tsquery)
+    snippet = func.ts_headline(
+        config,
+        func.access_point_search_text(AccessPoint.id, AccessPoint.location_id, AccessPoint.remarks),
+        tsquery,
+        SNIPPET_OPTIONS,
     )
 
+    rows = db.session.execute(
+        select_access_points()
+        .add_columns(snippet)
+        .where(AccessPoint.text_search_index.op("@@")(tsquery))
+        .order_by(rank.desc(), AccessPoint.id)
+        .limit(app.config["SEARCH_RESULT_LIMIT"])
+    ).all()
+
+    results = access_points_json(ap for ap, _ in rows)
+    for result, (_, row_snippet) in zip(results, rows):
+        result["search_snippet"] = highlight_snippet(row_snippet)
+    return results
 
-def getAccessPointsPaginated(page_num):
+
+def encode_catalog_cursor(building_name: str, nickname: str, access_point_id: int) -> str:
+    """Encode the catalog sort key of an access point into an opaque, url-safe cursor token
     """
-    Get access points in list, paginated
+    raw = json.dumps([building_name, nickname, access_point_id]).encode("utf8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_catalog_cursor(token: str) -> tuple[str, str, int]:
+    """Decode a cursor token made by `encode_catalog_cursor`
+
+    Raises:
+        ValueError: if the token is malformed
     """
-    return list(
-        map(
-            access_point_json,
-            db.session.execute(
-                db.select(AccessPoint)
-                .join(Location, AccessPoint.location_id == Location.id)
-                .join(Building, Location.building_id == Building.id)
-                .where(AccessPoint.active)
-                .order_by(Building.name.asc(), Location.nickname.asc())
-                .offset(page_num * app.config["ITEMSPERPAGE"])
-                .limit(app.config["ITEMSPERPAGE"])
-            ).scalars(),
-        )
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        building_name, nickname, access_point_id = json.loads(raw)
+    except Exception as e:
+        raise ValueError(f"Invalid catalog cursor {token}") from e
+
+    if not isinstance(building_name, str) or not isinstance(nickname, str) or not isinstance(access_point_id, int):
+        raise ValueError(f"Invalid catalog cursor {token}")
+    return building_name, nickname, access_point_id
+
+
+def getAccessPointsPaginated(cursor: Optional[str] = None):
+    """
+    Get access points in list, paginated by cursor (keyset pagination)
+    so a page only reads from the cursor's building onwards, and rows changing between page loads can't cause skips or duplicates.
+
+    Args:
+        cursor (str, optional): the token returned with the previous page. Defaults to None, which returns the first page.
+
+    Returns:
+        list, str: the access points on this page and the cursor for the next page (None if this is the last page)
+    """
+    per_page = app.config["ITEMSPERPAGE"]
+    # nicknames are optional, and row comparisons need a non-null value to compare against
+    nickname = func.coalesce(Location.nickname, "")
+
+    stmt = (
+        select_access_points()
+        .add_columns(Building.name, nickname)
+        .join(Location, AccessPoint.location_id == Location.id)
+        .join(Building, Location.building_id == Building.id)
+        .where(AccessPoint.active)
+        .order_by(Building.name.asc(), nickname.asc(), AccessPoint.id.asc())
+        .limit(per_page)
     )
+    if cursor is not None:
+        cursor_key = decode_catalog_cursor(cursor)
+        stmt = stmt.where(
+            # the row comparison spans three tables, so on its own it can only filter rows after they are read.
+            # Bounding the leading column lets the scan of ix_building_name_id start at the cursor's building
+            Building.name >= cursor_key[0],
+            db.tuple_(Building.name, nickname, AccessPoint.id) > db.tuple_(*cursor_key),
+        )
+
+    rows = db.session.execute(stmt).all()
+
+    next_cursor = None
+    if len(rows) == per_page:
+        last_access_point, last_building_name, last_nickname = rows[-1]
+        next_cursor = encode_catalog_cursor(last_building_name, last_nickname, last_access_point.id)
+
+    return access_points_json(ap for ap, _, _ in rows), next_cursor
 
 
 def getAllAccessPoints():
     """
     Get all access points
     """
-    return list(
-        map(
-            access_point_json,
-            db.paginate(
-                db.select(AccessPoint).order_by(AccessPoint.id.asc()),
-                per_page=200,
-            ).items,
-        )
+    return access_points_json(
+        db.paginate(
+            select_access_points().order_by(AccessPoint.id.asc()),
+            per_page=200,
+        ).items
     )
 
 
@@ -485,6 +801,22 @@ def getAllTags():
     return list(db.session.execute(db.select(Tag)).scalars())
 
 
+def getUnfinishedImageJobs(access_point_id):
+    """
+    Get image jobs for an access point that are queued, running or failed
+    """
+    return list(
+        db.session.execute(
+            db.select(ImageJob)
+            .where(
+                ImageJob.access_point_id == access_point_id,
+                ImageJob.status != ImageJobStatus.DONE,
+            )
+            .order_by(ImageJob.id)
+        ).scalars()
+    )
+
+
 def getAccessPointFeedback(access_point_id):
     """
     Get Feedback for a AccessPoint
@@ -517,88 +849,323 @@ def getTagDetails(name):
     )
 
 
-def export_database(dir, public):
-    """
-    Exports database tables to CSV files
-    Stores in provided directory
-    Not currently used/tested
+# rows fetched from the database (and written out) at a time when exporting
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_selects(public: bool) -> dict:
+    """The queries behind each exported table. Public exports leave out feedback, status notes and ticket references
+
+    Returns:
+        dict[str, Select]: table name to query, in the order they should be written
     """
-    if public:
-        access_point_select = db.select(
-            AccessPoint.id,
-            AccessPoint.notes,
-            AccessPoint.remarks,
-            AccessPoint.year,
-            AccessPoint.location,
-            AccessPoint.spotify,
-        ).order_by(AccessPoint.id.asc())
-    else:
-        access_point_select = db.select(
-            AccessPoint.id,
-            AccessPoint.title,
-            AccessPoint.private_notes,
-            AccessPoint.notes,
-            AccessPoint.remarks,
-            AccessPoint.year,
-            AccessPoint.location,
-            AccessPoint.spotify,
-        ).order_by(AccessPoint.id.asc())
-
-        feedback_select = db.select(Feedback).order_by(Feedback.feedback_id.asc())
-        feedback_df = pd.read_sql(feedback_select, db.engine)
-        feedback_df.to_csv(dir + "feedback.csv")
-
-    access_points_df = pd.read_sql(access_point_select, db.engine)
-
-    access_points_df["tags"] = access_points_df.apply(
-        lambda x: getTags(x["id"]), axis=1
-    )
-    images_select = (
+    door_button = DoorButton.__table__
+    elevator = Elevator.__table__
+    # coordinates are stored as integers scaled by MapLocation.PRECISION, and exported in degrees
+    scale = 10 ** MapLocation.PRECISION
+
+    # aggregated in the database, rather than looked up once per access point
+    tags = (
         db.select(
-            Image.id, Image.caption, Image.alttext, Image.attribution, Image.datecreated
-        )
-        .join(
-            ImageAccessPointRelation, ImageAccessPointRelation.image_id == Image.id
+            AccessPointTag.access_point_id,
+            func.string_agg(Tag.name, aggregate_order_by(db.literal("; "), Tag.name)).label("tags"),
         )
-        .where(ImageAccessPointRelation.ordering != 0)
-        .order_by(Image.id.asc())
+        .join(Tag, Tag.id == AccessPointTag.tag_id)
+        .group_by(AccessPointTag.access_point_id)
+        .subquery()
     )
+    current_status = (
+        db.select(AccessPointCurrentStatus.access_point_id, Status.status_type, Status.status, Status.timestamp, Status.notes, Report.ref)
+        .join(Status, Status.id == AccessPointCurrentStatus.status_id)
+        .join(Report, Report.id == Status.report_id)
+        .subquery()
+    )
+
+    access_point_columns = [
+        AccessPoint.id,
+        AccessPoint.type,
+        Building.acronym.label("building"),
+        Building.name.label("building_name"),
+        Location.floor_number,
+        Location.room_number,
+        Location.nickname.label("location_nickname"),
+        (db.cast(Location.latitude, db.Double) / scale).label("latitude"),
+        (db.cast(Location.longitude, db.Double) / scale).label("longitude"),
+        AccessPoint.remarks,
+        AccessPoint.active,
+        tags.c.tags,
+        current_status.c.status_type,
+        current_status.c.status,
+        current_status.c.timestamp.label("status_timestamp"),
+        door_button.c.shelter,
+        door_button.c.activation,
+        door_button.c.mount_surface,
+        door_button.c.mount_style,
+        door_button.c.powered_by,
+        elevator.c.floor_min,
+        elevator.c.floor_max,
+        elevator.c.door_count,
+        elevator.c.manufacturer,
+    ]
+    if not public:
+        access_point_columns += [current_status.c.notes.label("status_notes"), current_status.c.ref.label("report_ref")]
+
+    selects = {
+        "buildings": db.select(Building.__table__).order_by(Building.id),
+        "locations": (
+            db.select(*(
+                (db.cast(c, db.Double) / scale).label(c.key) if c.key in ("latitude", "longitude") else c
+                for c in Location.__table__.c
+            ))
+            .order_by(Location.id)
+        ),
+        "tags": db.select(Tag.id, Tag.name, Tag.description).order_by(Tag.id),
+        "access_points": (
+            db.select(*access_point_columns)
+            .join(Location, Location.id == AccessPoint.location_id)
+            .join(Building, Building.id == Location.building_id)
+            .outerjoin(tags, tags.c.access_point_id == AccessPoint.id)
+            .outerjoin(current_status, current_status.c.access_point_id == AccessPoint.id)
+            .outerjoin(door_button, door_button.c.id == AccessPoint.id)
+            .outerjoin(elevator, elevator.c.id == AccessPoint.id)
+            .order_by(AccessPoint.id)
+        ),
+        "images": (
+            db.select(
+                Image.id,
+                ImageAccessPointRelation.access_point_id,
+                ImageAccessPointRelation.ordering,
+                Image.caption,
+                Image.alttext,
+                Image.attribution,
+                Image.datecreated,
+                Image.fullsizehash,
+                Image.original_width,
+                Image.original_height,
+            )
+            .join(ImageAccessPointRelation, ImageAccessPointRelation.image_id == Image.id)
+            .order_by(ImageAccessPointRelation.access_point_id, ImageAccessPointRelation.ordering, Image.id)
+        ),
+    }
+    if not public:
+        selects["status_history"] = (
+            db.select(
+                Status.id,
+                AccessPointReports.access_point_id,
+                Report.ref.label("report_ref"),
+                Status.status_type,
+                Status.status,
+                Status.timestamp,
+                Status.notes,
+            )
+            .join(Report, Report.id == Status.report_id)
+            .join(AccessPointReports, AccessPointReports.report_id == Report.id)
+            .order_by(AccessPointReports.access_point_id, Status.timestamp, Status.id)
+        )
+        selects["feedback"] = db.select(Feedback.__table__).order_by(Feedback.feedback_id)
+    return selects
+
 
-    images_df = pd.read_sql(images_select, db.engine)
+def export_value(value):
+    return value.name if isinstance(value, Enum) else value
 
-    if not Path(dir).exists():
-        Path(dir).mkdir()
 
-    access_points_df.to_csv(dir + "access_points.csv")
-    images_df.to_csv(dir + "images.csv")
+def export_batches(select):
+    """Run an export query with a server side cursor, so only one batch of rows is in memory at a time
 
+    Returns:
+        tuple[list[str], Iterator[list[tuple]]]: the column names, and the rows in batches of EXPORT_BATCH_SIZE
+    """
+    result = db.session.execute(select.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    batches = ([tuple(export_value(v) for v in row) for row in partition] for partition in result.partitions())
+    return list(result.keys()), batches
 
-def export_images(path):
+
+def export_csv(select):
     """
-    Exports images to <path>/images
+    Yields:
+        bytes: successive parts of a CSV file of the query's results, one batch of rows at a time
     """
-    access_points = db.session.execute(
-        db.select(AccessPoint).order_by(AccessPoint.id.asc())
-    ).scalars()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    columns, batches = export_batches(select)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def arrow_type(sql_type):
+    if isinstance(sql_type, sqltypes.Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, sqltypes.Integer):
+        return pa.int64()
+    if isinstance(sql_type, (sqltypes.Float, sqltypes.Numeric)):
+        return pa.float64()
+    if isinstance(sql_type, sqltypes.DateTime):
+        return pa.timestamp("us")
+    # strings, and enums (exported by name)
+    return pa.string()
+
+
+def export_parquet(select, path):
+    """Write the query's results to a Parquet file, one row group per batch of rows"""
+    schema = pa.schema([(column.name, arrow_type(column.type)) for column in select.selected_columns])
+    _, batches = export_batches(select)
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist([dict(zip(schema.names, row)) for row in batch], schema=schema))
+
+
+def stream_database_export(public: bool):
+    """
+    Yields:
+        bytes: successive parts of a zip with a CSV file of each exported table
+    """
+    archive = ZipStream()
+    for name, select in export_selects(public).items():
+        yield from archive.add_stream(f"{name}.csv", export_csv(select), compression=zipfile.ZIP_DEFLATED)
+    yield archive.close()
+
+
+@dataclass
+class ImageArchiveEntry:
+    """A file going into a photo archive"""
+    path: str # where it goes in the archive
+    key: str # where it is in storage
+    access_point_id: int
+    ordering: int
+    image_id: int
+    image_type: ImageType
+    caption: Optional[str]
+    alttext: Optional[str]
+    attribution: Optional[str]
+    datecreated: datetime
+
+
+IMAGE_ARCHIVE_MANIFEST_FIELDS = [
+    "path", "access_point_id", "ordering", "image_id", "type", "bytes", "md5", "datecreated", "caption", "alttext", "attribution", "error",
+]
 
-    for m in access_points:
-        # TODO: migrate this to download the images
-        images = db.session.execute(
-            db.select(Image)
-            .join(
-                ImageAccessPointRelation, ImageAccessPointRelation.image_id == Image.id
+
+# image rows read per query when building an archive
+IMAGE_ARCHIVE_PAGE_SIZE = 500
+
+
+def image_archive_entries(after=0, until=None, image_types=(ImageType.ORIGINAL,)):
+    """The files of every image attached to each access point with an id above `after` (and up to `until`),
+    grouped into a folder per access point. Rows are read a page at a time, and the transaction is ended between pages
+    so a download that takes minutes doesn't hold one open the whole time
+
+    Yields:
+        ImageArchiveEntry: in access point and then image order
+    """
+    select = (
+        db.select(
+            ImageAccessPointRelation.access_point_id,
+            ImageAccessPointRelation.ordering,
+            Image.id,
+            Image.fullsizehash,
+            Image.naming_version,
+            Image.caption,
+            Image.alttext,
+            Image.attribution,
+            Image.datecreated,
+        )
+        .join(Image, Image.id == ImageAccessPointRelation.image_id)
+        .where(ImageAccessPointRelation.access_point_id > after)
+        .order_by(ImageAccessPointRelation.access_point_id, ImageAccessPointRelation.ordering, Image.id)
+    )
+    if until is not None:
+        select = select.where(ImageAccessPointRelation.access_point_id <= until)
+
+    last = None
+    while True:
+        page_select = select
+        if last is not None:
+            page_select = page_select.where(
+                db.tuple_(ImageAccessPointRelation.access_point_id, ImageAccessPointRelation.ordering, Image.id) > db.tuple_(*last)
             )
-            .where(ImageAccessPointRelation.access_point_id == m.id)
-            .filter(ImageAccessPointRelation.ordering != 0)
-        ).scalars()
+        rows = db.session.execute(page_select.limit(IMAGE_ARCHIVE_PAGE_SIZE)).all()
+        db.session.rollback()
+        if not rows:
+            return
+        last = (rows[-1].access_point_id, rows[-1].ordering, rows[-1].id)
+
+        for row in rows:
+            for image_type in image_types:
+                key = path_for_image(row.fullsizehash, image_type, naming_version=row.naming_version)
+                extension = os.path.splitext(key)[1] or ".jpg"
+                yield ImageArchiveEntry(
+                    path=f"{row.access_point_id}/{row.ordering}_{row.id}_{image_type.value}{extension}",
+                    key=key,
+                    access_point_id=row.access_point_id,
+                    ordering=row.ordering,
+                    image_id=row.id,
+                    image_type=image_type,
+                    caption=row.caption,
+                    alttext=row.alttext,
+                    attribution=row.attribution,
+                    datecreated=row.datecreated,
+                )
+
+
+def read_stored_file(key: str) -> bytes:
+    f = io.BytesIO()
+    storage.download_file(key, f)
+    return f.getvalue()
 
-        basepath = path + "images/" + str(m.id) + "/"
 
-        if not Path(basepath).exists():
-            Path(basepath).mkdir()
+def stream_image_archive(entries, workers=8, manifest_name="manifest.csv"):
+    """Build a zip of image files as it is sent. `workers` threads fetch files from storage ahead of the writer
+    (at most twice that many files are held in memory at once) while files are added in order, ending with a CSV manifest
+    of everything in the archive. Files that can't be fetched are listed in the manifest with the error instead
 
-        for i in images:
-            s3_bucket.get_file(i.fullsizehash, basepath + str(i.ordering) + ".jpg")
+    Yields:
+        bytes: successive parts of the archive
+    """
+    archive = ZipStream()
+    manifest = io.StringIO()
+    manifest_writer = csv.writer(manifest)
+    manifest_writer.writerow(IMAGE_ARCHIVE_MANIFEST_FIELDS)
+
+    entries = iter(entries)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-archive")
+    pending = deque()
+
+    def fetch_next():
+        entry = next(entries, None)
+        if entry is not None:
+            pending.append((entry, pool.submit(read_stored_file, entry.key)))
+
+    try:
+        for _ in range(workers * 2):
+            fetch_next()
+
+        while pending:
+            entry, future = pending.popleft()
+            fetch_next()
+            try:
+                data = future.result()
+            except Exception as e:
+                app.logger.error(f"Couldn't add {entry.key} to archive: {e}")
+                size, md5, error = "", "", str(e)
+            else:
+                yield archive.add(entry.path, data, modified=entry.datecreated)
+                size, md5, error = len(data), hashlib.md5(data).hexdigest(), ""
+            manifest_writer.writerow([
+                entry.path, entry.access_point_id, entry.ordering, entry.image_id, entry.image_type.value,
+                size, md5, entry.datecreated.isoformat(), entry.caption, entry.alttext, entry.attribution, error,
+            ])
+
+        yield archive.add(manifest_name, manifest.getvalue().encode())
+        yield archive.close()
+    finally:
+        # if the download is abandoned, don't bother fetching the rest
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 def getAccessPoint(id, is_admin=False):
@@ -649,17 +1216,14 @@ def getAccessPointsTagged(tag):
     """
     Get all access points with given tag
     """
-    return list(
-        map(
-            access_point_json,
-            db.session.execute(
-                db.select(AccessPoint)
-                .select_from(AccessPointTag)
-                .join(Tag, AccessPointTag.tag_id == Tag.id)
-                .join(AccessPoint, AccessPoint.id == AccessPointTag.access_point_id)
-                .where(Tag.name == tag)
-            ).scalars(),
-        )
+    return access_points_json(
+        db.session.execute(
+            select_access_points()
+            .select_from(AccessPointTag)
+            .join(Tag, AccessPointTag.tag_id == Tag.id)
+            .join(AccessPoint, AccessPoint.id == AccessPointTag.access_point_id)
+            .where(Tag.name == tag)
+        ).scalars()
     )
 
 
@@ -744,23 +1308,113 @@ def detachImageByRef(image_ref, keep_files=False):
 
     image = image_ref.image
 
-    # check how many total references to this image exist
-    total_ref_count = db.session.execute(
+    # remove the reference to this image
+    db.session.delete(image_ref)
+
+    # the same image can be attached to several items, so keep it while anything else refers to it
+    other_ref_count = db.session.execute(
         db.select(func.count()).where(
-            Image.fullsizehash == image.fullsizehash
+            ImageAccessPointRelation.image_id == image.id,
+            ImageAccessPointRelation.access_point_id != image_ref.access_point_id,
         )
     ).scalar()
+    if other_ref_count > 0:
+        return
+
+    db.session.execute(
+        db.update(ImageJob).where(ImageJob.image_id == image.id).values(image_id=None)
+    )
+    db.session.delete(image)
 
-    #if theres only this one reference, remove all three images from S3 and remove it from the database
-    if total_ref_count <= 1:
-        s3_bucket.remove_file(path_for_image(image.fullsizehash, ImageType.ORIGINAL, naming_version=image.naming_version))
-        s3_bucket.remove_file(path_for_image(image.fullsizehash, ImageType.RESIZED, naming_version=image.naming_version))
-        s3_bucket.remove_file(path_for_image(image.fullsizehash, ImageType.THUMB, naming_version=image.naming_version))  
+    if not keep_files:
+        # files are only actually removed if nothing still needs them once this transaction commits (see flushFileDeletions)
+        queueFileDeletions(paths_for_image(image))
 
-        db.session.delete(image)
 
-    # remove the reference to this image
-    db.session.delete(image_ref)
+def queueFileDeletions(keys):
+    """Queue files to be removed from S3 when the current transaction commits. Call flushFileDeletions after committing"""
+    now = datetime.utcnow()
+    db.session.add_all(FileDeletion(key=key, created=now) for key in keys)
+
+
+def pathsStillInUse(keys) -> set[str]:
+    """Which of `keys` an image, or a job waiting to create one, still refers to"""
+    # every image file key starts with the image's hash
+    hashes = {key[:32] for key in keys}
+    in_use = set()
+    for image in db.session.execute(
+        db.select(Image.fullsizehash, Image.naming_version, Image.variant_widths, Image.variant_formats)
+        .where(Image.fullsizehash.in_(hashes))
+    ):
+        in_use.update(paths_for_image(image))
+    in_use.update(db.session.execute(
+        db.select(ImageJob.original_key).where(ImageJob.fullsizehash.in_(hashes))
+    ).scalars())
+    return in_use & set(keys)
+
+
+def storedLastModified(keys) -> dict[str, datetime]:
+    """When each of `keys` that is stored was last written, listing each image's files (which share a hash prefix) once"""
+    keys = set(keys)
+    last_modified = {}
+    for fullsizehash in {key[:32] for key in keys}:
+        for entry in storage.list_files(prefix=fullsizehash):
+            if entry["Key"] in keys:
+                last_modified[entry["Key"]] = entry["LastModified"]
+    return last_modified
+
+
+# allowance for the app server's clock and the storage backend's disagreeing, when comparing a file's LastModified
+STORAGE_CLOCK_SKEW = timedelta(minutes=1)
+
+
+def flushFileDeletions() -> int:
+    """Remove the files queued by queueFileDeletions from S3, up to DELETE_BATCH_SIZE per request.
+    Call this after committing. Anything left behind (if S3 fails, or the process dies first) is retried by the next flush
+
+    Returns:
+        int: the number of files removed
+    """
+    removed = 0
+    last_id = 0
+    while True:
+        deletions = db.session.execute(
+            db.select(FileDeletion)
+            .where(FileDeletion.id > last_id)
+            .order_by(FileDeletion.id)
+            .limit(DELETE_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        ).scalars().all()
+        if not deletions:
+            break
+        last_id = deletions[-1].id
+
+        keys = {d.key for d in deletions}
+        # the same file may have been uploaded again since it was queued
+        keys -= pathsStillInUse(keys)
+        # ... including by a request that hasn't committed the rows that will use it yet
+        queued_at = {}
+        for d in deletions:
+            queued_at[d.key] = max(d.created, queued_at.get(d.key, d.created))
+        for key, modified in storedLastModified(keys).items():
+            if modified > queued_at[key].replace(tzinfo=timezone.utc) - STORAGE_CLOCK_SKEW:
+                keys.discard(key)
+        try:
+            failures = storage.remove_files(keys) if keys else {}
+        except Exception as e:
+            # the deletions stay queued for next time. The transaction they were queued in has committed either way
+            app.logger.error(f"Failed to remove queued files from S3: {e}")
+            db.session.rollback()
+            break
+        for key, error in failures.items():
+            app.logger.error(f"Failed to remove {key} from S3: {error}")
+
+        for deletion in deletions:
+            if deletion.key not in failures:
+                db.session.delete(deletion)
+        removed += len(keys) - len(failures)
+        db.session.commit()
+    return removed
 
 
 def statusDataToStyle(statustype: StatusType, message:str, context:str=None):
@@ -858,26 +1512,31 @@ def map_page():
 @app.route("/catalog")
 def catalog():
     query = request.args.get("q")
-    page = request.args.get("p")
+    cursor = request.args.get("p")
     if query == None:
-        if page is None:
+        if cursor is None:
+            accessPoints, next_cursor = getAccessPointsPaginated()
             return render_template(
             "catalog.html",
             authsession=get_logged_in_user(),
             is_admin = check_for_admin_role(get_logged_in_user_id()),
             q=query,
-            page=1,
-            accessPoints=getAccessPointsPaginated(0),
+            next_cursor=next_cursor,
+            accessPoints=accessPoints,
             tags=getAllTags(),
         )
         else:
-            page = int(page)
+            try:
+                murals, next_cursor = getAccessPointsPaginated(cursor)
+            except ValueError as e:
+                app.logger.warning(e)
+                return ("Invalid page", 400)
             return render_template(
                 "paginated.html",
                 authsession=get_logged_in_user(),
                 is_admin = check_for_admin_role(get_logged_in_user_id()),
-                page=(page+1),
-                murals=getAccessPointsPaginated(page)
+                next_cursor=next_cursor,
+                murals=murals
             )
     else:
         return render_template(
@@ -938,6 +1597,14 @@ if auth_configured:
     def callback():
         token = oauth.auth0.authorize_access_token()
         save_user_details(token)
+        # pick up any role changes made since this user's roles were last cached
+        user_id = get_logged_in_user_id()
+        if user_id is not None:
+            try:
+                refresh_auth0_user_roles(user_id)
+            except Exception as e:
+                # the login itself succeeded. Roles fall back to the cache, or are looked up when next needed
+                app.logger.warning(f"Could not refresh Auth0 roles for {user_id}: {e}")
         return redirect("/")
 
 
@@ -976,6 +1643,24 @@ def not_found(e):
     return render_template("404.html"), 404
 
 
+@app.errorhandler(UploadError)
+def upload_failed(e):
+    """
+    None of the images from a failed upload are kept, so the whole upload can be retried
+    """
+    app.logger.error(e)
+    db.session.rollback()
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({
+            "error": "Failed to store uploaded images",
+            "failed": list(e.failures),
+            "rollback_failed": list(e.rollback_failures),
+        }), 502
+    # back to the page the upload came from (usually the edit page), which shows the message
+    flash(f"Failed to store {len(e.failures)} uploaded image(s), so none were kept. Please try the upload again")
+    return redirect(request.referrer or "/")
+
+
 
 ########################
 #
@@ -1063,9 +1748,7 @@ def email_webhook():
 
     statusUpdate = ServiceNowStatus.from_email(from_addr, subject, html_body)
 
-    report = db.session.execute(
-        db.select(Report).where(Report.ref == statusUpdate.ref)
-    ).scalar()
+    report = db.session.execute(report_by_ref_select(statusUpdate.ref)).scalar()
 
     if report is None:
         # create new report and status
@@ -1101,6 +1784,7 @@ def email_webhook():
         notes=statusNotes
     )
     db.session.add(status)
+    refresh_current_status_for_report(report.id)
 
     
     db.session.commit()
@@ -1118,9 +1802,7 @@ def add_ticket(item_id):
     if ticket_ref is None or ticket_ref == "" or not ticket_ref.startswith("WOT"):
         return "invalid ticket number", 400
 
-    report = db.session.execute(
-        db.select(Report).where(Report.ref == ticket_ref)
-    ).scalar()
+    report = db.session.execute(report_by_ref_select(ticket_ref)).scalar()
 
     if report is None:
         # create new report and status
@@ -1137,6 +1819,8 @@ def add_ticket(item_id):
         access_point_id=item_id
     )
     db.session.add(association)
+    # the report may already have statuses from emails that came in before it was associated
+    refresh_current_status([item_id])
     
     db.session.commit()
 
@@ -1191,6 +1875,7 @@ def add_status(item_id):
         notes = note_text
     )
     db.session.add(status_update)
+    refresh_current_status_for_report(current_report.id)
     db.session.commit()
 
     return redirect(f"/access_points/{item_id}")
@@ -1201,17 +1886,29 @@ def add_status(item_id):
 #
 ########################
 
+THUMBNAIL_SIZE = 256
+
+
+def thumbnail_from_image(pil_img):
+    """
+    Crop an (already decoded) image to a centered square and downscale it to thumbnail size
+    """
+    im = crop_center(pil_img, min(pil_img.size), min(pil_img.size))
+    # thumbnail() uses reduce() for the bulk of a large downscale before resampling
+    im.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    return im
+
+
 def make_thumbnail(input_file, output_file, raise_if_already=True):
     """
     Given an input file (as a filename to an image), downscale it to a thumbnail and store it in the (file or string filepath) represented by output_file
     """
 
     with PilImage.open(input_file) as im:
-        if im.width == 256 or im.height == 256:
+        if im.width == THUMBNAIL_SIZE or im.height == THUMBNAIL_SIZE:
             if raise_if_already:
                 raise ValueError("Thumbnail requested from image that is already thumbnail size.")
-        im = crop_center(im, min(im.size), min(im.size))
-        im.thumbnail((256, 256))
+        im = thumbnail_from_image(im)
         exif = im.getexif()
         exif[ExifBase.ImageWidth.value] = im.width
         exif[ExifBase.ImageLength.value] = im.height
@@ -1282,6 +1979,20 @@ def associate_thumbnail(file_hash, thumbnail_file, item_identifier):
     db.session.commit()
 
 
+def current_status_select(access_point_id: int):
+    """Select the current status of an access point"""
+    return (
+        db.select(Status)
+        .join(AccessPointCurrentStatus, AccessPointCurrentStatus.status_id == Status.id)
+        .where(AccessPointCurrentStatus.access_point_id == access_point_id)
+    )
+
+
+def report_by_ref_select(ref: str):
+    """Select a report by its ticket number"""
+    return db.select(Report).where(Report.ref == ref)
+
+
 def get_item_status(item: Union[AccessPoint, int]):
     """Fetch the most recent status for the provided item.
 
@@ -1292,26 +2003,96 @@ def get_item_status(item: Union[AccessPoint, int]):
         Status: the status of the access point, or None if none were found
     """
     item_id = item.id if isinstance(item, AccessPoint) else item
-    status = db.session.execute(
-        db.select(Status)
-        .join(AccessPointReports, AccessPointReports.report_id == Status.report_id)
-        .where(AccessPointReports.access_point_id == item_id)
-        .order_by(Status.timestamp.desc())
-    ).scalars().first()
+    status = db.session.execute(current_status_select(item_id)).scalars().first()
     
     return status
 
-def get_item_report(item:Union[AccessPoint, int]):
-    """Fetch the latest report for the provided item.
 
-    While you can get this using get_item_status and accessing it through the associated report,
-    that method can miss scenarios where a report has been created but there is no status yet
-    This can happen when associating a ticket before any email has come in yet.
+def latest_status_select():
+    """Select the most recent status id for each access point from the full status history.
+    This is the source of truth that the `access_point_current_status` table is derived from.
+    """
+    return (
+        db.select(AccessPointReports.access_point_id, Status.id)
+        .join(Status, Status.report_id == AccessPointReports.report_id)
+        .order_by(AccessPointReports.access_point_id, Status.timestamp.desc(), Status.id.desc())
+        .distinct(AccessPointReports.access_point_id)
+    )
+
+
+def refresh_current_status(access_point_ids=None):
+    """Recompute the current status of the given access points from their status history.
+
+    This runs in the caller's transaction, so call it after adding a Status (or a report association) and before committing.
 
     Args:
-        item (Union[AccessPoint, int]): The item (in this case AccessPoint) to fetch the report for (or its integer ID)
+        access_point_ids (optional): a list of access point ids, or a select of ids. Defaults to None, which rebuilds every access point.
+    """
+    latest = latest_status_select()
+    stale = db.delete(AccessPointCurrentStatus)
+    if access_point_ids is not None:
+        latest = latest.where(AccessPointReports.access_point_id.in_(access_point_ids))
+        stale = stale.where(AccessPointCurrentStatus.access_point_id.in_(access_point_ids))
 
-    Returns:
+    # flush pending statuses so they are visible to the INSERT ... SELECT below
+    db.session.flush()
+
+    upsert = pg_insert(AccessPointCurrentStatus).from_select(
+        ["access_point_id", "status_id"], latest
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[AccessPointCurrentStatus.access_point_id],
+        set_={"status_id": upsert.excluded.status_id},
+    )
+    db.session.execute(upsert)
+
+    # drop rows for access points that no longer have any status at all
+    db.session.execute(
+        stale.where(
+            AccessPointCurrentStatus.access_point_id.not_in(
+                latest.with_only_columns(AccessPointReports.access_point_id).order_by(None)
+            )
+        )
+    )
+
+
+def refresh_current_status_for_report(report_id: int):
+    """Recompute the current status of every access point associated with a report
+    """
+    refresh_current_status(
+        db.select(AccessPointReports.access_point_id)
+        .where(AccessPointReports.report_id == report_id)
+    )
+
+
+def find_current_status_mismatches():
+    """Compare the `access_point_current_status` table against the status history
+
+    Returns:
+        list[tuple[int, Optional[int], Optional[int]]]: (access point id, stored status id, expected status id) for every access point that is out of sync
+    """
+    expected = dict(db.session.execute(latest_status_select()).all())
+    stored = dict(db.session.execute(
+        db.select(AccessPointCurrentStatus.access_point_id, AccessPointCurrentStatus.status_id)
+    ).all())
+
+    return [
+        (ap_id, stored.get(ap_id), expected.get(ap_id))
+        for ap_id in sorted(expected.keys() | stored.keys())
+        if stored.get(ap_id) != expected.get(ap_id)
+    ]
+
+def get_item_report(item:Union[AccessPoint, int]):
+    """Fetch the latest report for the provided item.
+
+    While you can get this using get_item_status and accessing it through the associated report,
+    that method can miss scenarios where a report has been created but there is no status yet
+    This can happen when associating a ticket before any email has come in yet.
+
+    Args:
+        item (Union[AccessPoint, int]): The item (in this case AccessPoint) to fetch the report for (or its integer ID)
+
+    Returns:
         Report: the report of the access point, or None if none were found
     """
     item_id = item.id if isinstance(item, AccessPoint) else item
@@ -1348,16 +2129,14 @@ def deleteAccessPointEntry(id):
         .where(ImageAccessPointRelation.access_point_id == id),
         per_page=150,
     ).items
-    # we are deleting the whole access point, so remove all image references
-    db.session.execute(
-        db.delete(ImageAccessPointRelation).where(
-            ImageAccessPointRelation.access_point_id == id
-        )
-    )
     db.session.execute(
         db.delete(AccessPointTag).where(AccessPointTag.access_point_id == id)
     )
     db.session.execute(db.delete(Feedback).where(Feedback.access_point_id == id))
+    db.session.execute(db.delete(ImageJob).where(ImageJob.access_point_id == id))
+    db.session.execute(
+        db.delete(AccessPointCurrentStatus).where(AccessPointCurrentStatus.access_point_id == id)
+    )
 
     # https://docs.sqlalchemy.org/en/21/orm/queryguide/inheritance.html#using-with-polymorphic
     ap_poly = with_polymorphic(AccessPoint, "*")
@@ -1365,9 +2144,11 @@ def deleteAccessPointEntry(id):
     m = db.session.execute(
         db.select(ap_poly).where(AccessPoint.id == id)
     ).scalar_one()
+    # we are deleting the whole access point, so remove all image references (and any images nothing else uses)
     detachAllImagesFromItem(m.id)
     db.session.delete(m)
     db.session.commit()
+    flushFileDeletions()
 
 ########################
 # region Image Helpers
@@ -1375,14 +2156,16 @@ def deleteAccessPointEntry(id):
 
 def creationTimeFromFileExif(file, default=datetime.now()):
     with PilImage.open(file) as im:
-        exif = im.getexif()
-        try:
-            exifdate = exif[ExifBase.DateTime.value]
-        except KeyError:
-            # No Exif Data available
-            return default
-        exif_format = "%Y:%m:%d %H:%M:%S"
-        return datetime.strptime(exifdate, exif_format)
+        return creationTimeFromExif(im.getexif(), default=default)
+
+def creationTimeFromExif(exif, default=None):
+    try:
+        exifdate = exif[ExifBase.DateTime.value]
+    except KeyError:
+        # No Exif Data available
+        return default
+    exif_format = "%Y:%m:%d %H:%M:%S"
+    return datetime.strptime(exifdate, exif_format)
 
 def scrubGPSFromExif(exif):
     try:
@@ -1393,9 +2176,14 @@ def scrubGPSFromExif(exif):
 
 
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 def generateImageHash(file):
     file.seek(0)
-    hashvalue = hashlib.md5(file.read()).hexdigest()
+    md5 = hashlib.md5()
+    while chunk := file.read(UPLOAD_CHUNK_SIZE):
+        md5.update(chunk)
+    hashvalue = md5.hexdigest()
 
     if hashvalue == hashlib.md5("".encode("utf8")).hexdigest():
         raise ValueError("The data to be hashed was empty")
@@ -1404,81 +2192,1003 @@ def generateImageHash(file):
     return hashvalue
 
 
-def uploadImageResize(file, access_point_id, count, is_thumbnail=False):
+def spoolFile(stream) -> tuple[tempfile.SpooledTemporaryFile, str]:
     """
-    Upload fullsize and resized image, add relation to access point given ID
+    Copy a stream into a temporary file, hashing it on the way, so it is only read once.
+    The copy stays in memory up to UPLOAD_SPOOL_MAX_SIZE bytes and moves to disk beyond that.
+
+    Args:
+        stream (a file-like object): the data to copy, read from its current position
+
+    Returns:
+        tuple[tempfile.SpooledTemporaryFile, str]: the rewound copy (which the caller must close) and the MD5 hash of its contents
     """
+    spool = tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"]))
+    md5 = hashlib.md5()
+    while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+        md5.update(chunk)
+        spool.write(chunk)
+
+    if spool.tell() == 0:
+        spool.close()
+        raise ValueError("The data to be hashed was empty")
 
-    file_obj = io.BytesIO(file.read())
-    fullsizehash = generateImageHash(file_obj)
-    file_obj.seek(0)
+    spool.seek(0)
+    return spool, md5.hexdigest()
+
+
+@dataclass
+class ImageDerivatives:
+    """Everything generated from a single decode of an uploaded image"""
+    datecreated: Optional[datetime] # from the EXIF data, if present
+    resized: io.BytesIO # JPEG scaled to MAX_IMG_HEIGHT
+    thumbnail: io.BytesIO # square JPEG thumbnail
+    variants: dict[tuple[int, ImageFormat], io.BytesIO] = field(default_factory=dict) # responsive variants by (width, format)
+    perceptual_hash: Optional[int] = None
+    metadata: dict = field(default_factory=dict) # dimensions, sizes and placeholder, as Image column values
+
+
+# EXIF orientation -> the transpose that displays the image upright
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: PilImage.Transpose.FLIP_LEFT_RIGHT,
+    3: PilImage.Transpose.ROTATE_180,
+    4: PilImage.Transpose.FLIP_TOP_BOTTOM,
+    5: PilImage.Transpose.TRANSPOSE,
+    6: PilImage.Transpose.ROTATE_270,
+    7: PilImage.Transpose.TRANSVERSE,
+    8: PilImage.Transpose.ROTATE_90,
+}
+
+PLACEHOLDER_WIDTH = 16
+
+def displayedSize(size: tuple[int, int], orientation) -> tuple[int, int]:
+    """The (width, height) an image is shown at once its EXIF orientation is applied"""
+    width, height = size
+    if orientation in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def makePlaceholder(pil_img, orientation) -> str:
+    """Shrink an image to a tiny, upright data URI to show (blurred) while the real image loads. About 100 bytes"""
+    small = pil_img.resize(
+        (PLACEHOLDER_WIDTH, max(1, round(pil_img.height * PLACEHOLDER_WIDTH / pil_img.width))),
+        PilImage.Resampling.BOX,
+        reducing_gap=2.0,
+    )
+    transpose = EXIF_ORIENTATION_TRANSPOSE.get(orientation)
+    if transpose is not None:
+        small = small.transpose(transpose)
+
+    image_format = ImageFormat.WEBP if ImageFormat.WEBP in get_variant_formats() else ImageFormat.JPEG
+    placeholder_file = io.BytesIO()
+    small.save(placeholder_file, image_format.pil_format, quality=40)
+    return f"data:{image_format.mimetype};base64,{base64.b64encode(placeholder_file.getvalue()).decode('ascii')}"
 
-    name_ver = get_latest_naming_version()
 
-    original_filename = path_for_image(fullsizehash, ImageType.ORIGINAL, naming_version=name_ver)
-    resized_filename = path_for_image(fullsizehash, ImageType.RESIZED, naming_version=name_ver)
-    thumb_filename = path_for_image(fullsizehash, ImageType.THUMB, naming_version=name_ver)
+def generateVariants(pil_img, orientation, widths: list[int], formats: list[ImageFormat]) -> dict[tuple[int, ImageFormat], io.BytesIO]:
+    """
+    Encode responsive variants of an image at each width (that doesn't upscale it) and format.
+    Images narrower than every width get a single variant at their own width.
+    Variants have no EXIF data, so they are rotated upright here instead.
+    """
+    transpose = EXIF_ORIENTATION_TRANSPOSE.get(orientation)
+    if transpose is not None:
+        pil_img = pil_img.transpose(transpose)
+
+    variants = {}
+    variant_widths = sorted({w for w in widths if w <= pil_img.width} or {pil_img.width}, reverse=True)
+    source = pil_img
+    for width in variant_widths:
+        # each size is scaled down from the previous (larger) one, which is cheaper than starting from full size every time
+        if width != source.width:
+            source = source.resize((width, round(source.height * width / source.width)), reducing_gap=2.0)
+        for image_format in formats:
+            variant_file = io.BytesIO()
+            source.save(variant_file, image_format.pil_format, **VARIANT_SAVE_OPTIONS[image_format])
+            variant_file.seek(0)
+            variants[(width, image_format)] = variant_file
+    return variants
+
+
+def generateDerivatives(file_obj, height_limit: int, variant_widths: list[int] = (), variant_formats: list[ImageFormat] = ()) -> ImageDerivatives:
+    """
+    Decode an image once and produce its metadata, resized version, thumbnail and any responsive variants from the same in-memory bitmap.
 
+    When the image is much larger than the target, the JPEG decoder is asked to scale it down while decoding (draft),
+    which decodes far fewer pixels and keeps peak memory down. The remaining downscale uses reduce() before resampling.
 
-    # Upload full size img to S3
-    s3_bucket.upload_file(original_filename, file_obj, filename=original_filename)
+    Args:
+        file_obj (a file-like object): the original image
+        height_limit (int): the height of the resized image
+        variant_widths (list[int], optional): widths to generate responsive variants at. Defaults to none
+        variant_formats (list[ImageFormat], optional): formats to encode each responsive variant in. Defaults to none
 
-    file_obj.seek(0)
-    imageTakenOn = creationTimeFromFileExif(file_obj)
-    file_obj.seek(0)
+    Returns:
+        ImageDerivatives: the generated derivatives
+    """
+    # hashed from the original, exactly like the near-duplicate check at upload time, so the two are comparable
+    perceptual_hash = perceptualHashOfFile(file_obj)
 
+    file_obj.seek(0)
     with PilImage.open(file_obj) as im:
         exif = im.getexif()
-        im = limit_height(im, int(app.config["MAX_IMG_HEIGHT"]))
-        exif = scrubGPSFromExif(exif)
-        exif[ExifBase.ImageWidth.value] = im.width
-        exif[ExifBase.ImageLength.value] = im.height
-                
-        im = im.convert("RGB")
+        datecreated = creationTimeFromExif(exif)
+        orientation = exif.get(ExifBase.Orientation.value)
+        original_size = im.size # before draft() changes it
+
+        # scale width proportionally to height
+        width = (im.width * height_limit) // im.height
+        if im.height > height_limit:
+            # only picks a DCT scale (1/2, 1/4, 1/8) that stays at or above the requested size, and is a no-op for non-JPEGs
+            im.draft("RGB", (width, height_limit))
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        resized = im.resize((width, height_limit), reducing_gap=3.0)
+
+    exif = scrubGPSFromExif(exif)
+
+    exif[ExifBase.ImageWidth.value] = resized.width
+    exif[ExifBase.ImageLength.value] = resized.height
+    resized_file = io.BytesIO()
+    resized.save(resized_file, "JPEG", exif=exif)
+    resized_file.seek(0)
+
+    variants = {}
+    if variant_widths and variant_formats:
+        variants = generateVariants(resized, orientation, variant_widths, variant_formats)
+    resized_width, resized_height = displayedSize(resized.size, orientation)
+    placeholder = makePlaceholder(resized, orientation)
+
+    thumbnail = thumbnail_from_image(resized)
+    del resized
+
+    exif[ExifBase.ImageWidth.value] = thumbnail.width
+    exif[ExifBase.ImageLength.value] = thumbnail.height
+    thumbnail_file = io.BytesIO()
+    thumbnail.save(thumbnail_file, "JPEG", exif=exif)
+    thumbnail_file.seek(0)
+
+    original_width, original_height = displayedSize(original_size, orientation)
+    metadata = {
+        "original_width": original_width,
+        "original_height": original_height,
+        "resized_width": resized_width,
+        "resized_height": resized_height,
+        "resized_bytes": resized_file.getbuffer().nbytes,
+        "thumb_width": thumbnail.width,
+        "thumb_height": thumbnail.height,
+        "thumb_bytes": thumbnail_file.getbuffer().nbytes,
+        "placeholder": placeholder,
+    }
+    return ImageDerivatives(datecreated, resized_file, thumbnail_file, variants, perceptual_hash, metadata)
 
-        resized_file = io.BytesIO()
-        im.save(resized_file, "JPEG", exif=exif)
-        resized_file.seek(0)
 
-        s3_bucket.upload_file(resized_filename, resized_file, filename=resized_filename)
+def uploadImageDerivatives(file_obj, image: Image, existing_paths=frozenset()) -> ImageDerivatives:
+    """
+    Generate the derivatives of an original image for its naming version, upload them,
+    and record which responsive variants it has on the Image row
 
-        
-        thumbnail_file = io.BytesIO()
+    Args:
+        file_obj (a file-like object): the original image
+        image (Image): the image to generate derivatives for
+        existing_paths (set[str], optional): paths that are already stored and in use, which are left alone
+            rather than uploaded again (and so are never removed if another upload fails)
+    """
+    fullsizehash = image.fullsizehash
+    name_ver = image.naming_version
+
+    variant_widths, variant_formats = [], []
+    if name_ver >= 2:
+        variant_widths = app.config["RESPONSIVE_IMAGE_WIDTHS"]
+        variant_formats = get_variant_formats()
+
+    derivatives = generateDerivatives(file_obj, int(app.config["MAX_IMG_HEIGHT"]), variant_widths, variant_formats)
+
+    uploads = [
+        (path_for_image(fullsizehash, ImageType.RESIZED, naming_version=name_ver), derivatives.resized),
+        (path_for_image(fullsizehash, ImageType.THUMB, naming_version=name_ver), derivatives.thumbnail),
+    ]
+    uploads += [
+        (path_for_image_variant(fullsizehash, width, image_format), variant_file)
+        for (width, image_format), variant_file in derivatives.variants.items()
+    ]
+    storage.upload_files([(path, f) for path, f in uploads if path not in existing_paths])
+
+    image.perceptual_hash = derivatives.perceptual_hash
+    file_obj.seek(0, io.SEEK_END)
+    image.original_bytes = file_obj.tell()
+    file_obj.seek(0)
+    for column, value in derivatives.metadata.items():
+        setattr(image, column, value)
+    if derivatives.variants:
+        image.variant_widths = sorted({width for width, _ in derivatives.variants})
+        image.variant_formats = [f.value for f in variant_formats]
+    else:
+        image.variant_widths = None
+        image.variant_formats = None
+    return derivatives
+
+
+def processImageDerivatives(file_obj, fullsizehash) -> Image:
+    """
+    Generate and upload the resized and thumbnail versions of an original image, and add its Image row.
+    The original itself must already be stored. The caller is responsible for committing.
+
+    Args:
+        file_obj (a file-like object): the original image
+        fullsizehash (str): the hash of the original image
+
+    Returns:
+        Image: the new (flushed) Image row
+    """
+    img = Image(
+        fullsizehash=fullsizehash,
+        naming_version=get_latest_naming_version()
+    )
+    derivatives = uploadImageDerivatives(file_obj, img)
+    img.datecreated = derivatives.datecreated or datetime.now()
+    db.session.add(img)
+    db.session.flush()
+    return img
+
+
+@dataclass
+class ImageUpload:
+    """An uploaded image, spooled to a temporary file and hashed"""
+    file_obj: IO[bytes]
+    fullsizehash: str
+    ordering: int # the ordering of the image on its access point
+    size: int # in bytes
+    perceptual_hash: Optional[int] = None # None if the file couldn't be read as an image
+    is_thumbnail: bool = False
+    reprocess: bool = False # an Image with this hash exists, but its files are missing and need regenerating
+
+    def close(self):
+        self.file_obj.close()
+
+
+def readImageUpload(file, ordering, is_thumbnail=False) -> ImageUpload:
+    """Spool and hash an uploaded file. The caller must close() the result"""
+    file_obj, fullsizehash = spoolFile(file)
+    file_obj.seek(0, io.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return ImageUpload(file_obj, fullsizehash, ordering, size, perceptualHashOfFile(file_obj), is_thumbnail=is_thumbnail)
+
+
+def perceptualHashOfFile(file_obj) -> Optional[int]:
+    """dHash an image file. JPEGs are only partially decoded, so this is cheap enough to do during the upload request"""
+    try:
+        with PilImage.open(file_obj) as im:
+            return dhash(im)
+    except (PilImage.UnidentifiedImageError, OSError) as e:
+        app.logger.warning(f"Could not compute perceptual hash: {e}")
+        return None
+    finally:
+        file_obj.seek(0)
+
+
+def closeImageUploads(uploads: list[ImageUpload]):
+    for upload in uploads:
+        upload.close()
+
+
+@dataclass
+class DedupReport:
+    """What deduplicating an upload saved"""
+    reused_images: int = 0
+    bytes_saved: int = 0 # bytes that didn't need storing again (originals only, derivatives aren't counted)
+    cpu_seconds_saved: float = 0.0 # estimated from the average measured cost of generating derivatives
+    # uploads that look like an existing image (but aren't byte-identical) and were kept anyway
+    near_duplicates: list[dict] = field(default_factory=list)
+
+    def json(self):
+        return {
+            "reused_images": self.reused_images,
+            "bytes_saved": self.bytes_saved,
+            "cpu_seconds_saved": round(self.cpu_seconds_saved, 3),
+            "near_duplicates": self.near_duplicates,
+        }
 
-        try:
-            make_thumbnail(resized_file, thumbnail_file)
-        except ValueError as e:
-            app.logger.error(f"Exception encountered generating thumbnail: {e}")
-        
-        thumbnail_file.seek(0)
 
-        s3_bucket.upload_file(thumb_filename, thumbnail_file, filename=thumb_filename)
+# the near-duplicate index: the tree, the ids in it and the highest of them, the "images" cache version it was built at,
+# and whether a rebuild is running
+_near_duplicate_cache = {"tree": None, "ids": set(), "max_id": 0, "version": None, "building": False}
+_near_duplicate_lock = threading.Lock()
+# images can commit out of id order, so new images are looked for this far below the highest id already in the tree
+NEAR_DUPLICATE_ID_LOOKBACK = 100
 
-        img = Image(
-            fullsizehash=fullsizehash,
-            datecreated=imageTakenOn or datetime.now(),
-            naming_version=name_ver
+
+def _load_near_duplicate_tree() -> dict:
+    """Build a BK-tree of every image's perceptual hash from a full scan of the images table"""
+    tree = BKTree()
+    ids = set()
+    for image_id, perceptual_hash in db.session.execute(
+        db.select(Image.id, Image.perceptual_hash).where(Image.perceptual_hash.is_not(None))
+    ):
+        tree.add(perceptual_hash, image_id)
+        ids.add(image_id)
+    return {"tree": tree, "ids": ids, "max_id": max(ids, default=0)}
+
+
+def _rebuild_near_duplicate_tree(version: int):
+    """Build a fresh BK-tree in a background thread and swap it in once it's complete"""
+    try:
+        with app.app_context():
+            rebuilt = _load_near_duplicate_tree()
+        with _near_duplicate_lock:
+            _near_duplicate_cache.update(version=version, **rebuilt)
+    except Exception as e:
+        app.logger.error(f"Rebuilding the near-duplicate index failed: {e}")
+    finally:
+        with _near_duplicate_lock:
+            _near_duplicate_cache["building"] = False
+
+
+def get_near_duplicate_tree() -> BKTree:
+    """A BK-tree of every image's perceptual hash.
+
+    The first call in a process builds the tree. After that, images added since are looked up by id and added to it
+    in place. Deleted images are left in the tree (findNearDuplicate skips them). Only when existing images are rehashed
+    (which bumps the "images" cache version) is the whole tree rebuilt, in the background, with the current one
+    used meanwhile.
+    """
+    version = get_cache_version("images")
+    with _near_duplicate_lock:
+        if _near_duplicate_cache["tree"] is None:
+            _near_duplicate_cache.update(version=version, **_load_near_duplicate_tree())
+        elif _near_duplicate_cache["version"] != version and not _near_duplicate_cache["building"]:
+            _near_duplicate_cache["building"] = True
+            threading.Thread(
+                target=_rebuild_near_duplicate_tree, args=(version,), name="near-duplicate-index", daemon=True
+            ).start()
+
+        tree, ids = _near_duplicate_cache["tree"], _near_duplicate_cache["ids"]
+        for image_id, perceptual_hash in db.session.execute(
+            db.select(Image.id, Image.perceptual_hash).where(
+                Image.id > _near_duplicate_cache["max_id"] - NEAR_DUPLICATE_ID_LOOKBACK,
+                Image.perceptual_hash.is_not(None),
+            )
+        ):
+            if image_id not in ids:
+                tree.add(perceptual_hash, image_id)
+                ids.add(image_id)
+                _near_duplicate_cache["max_id"] = max(_near_duplicate_cache["max_id"], image_id)
+        return tree
+
+
+def findNearDuplicate(perceptual_hash: int) -> Optional[tuple[int, Image]]:
+    """Find the existing image that looks most like one with the given perceptual hash, if any is close enough
+
+    Returns:
+        Optional[tuple[int, Image]]: the distance (in bits) to the closest image, and the image
+    """
+    matches = get_near_duplicate_tree().search(perceptual_hash, int(app.config["IMAGE_NEAR_DUPLICATE_DISTANCE"]))
+    for distance, image_id in matches:
+        # the tree can be a moment behind deletions
+        image = db.session.get(Image, image_id)
+        if image is not None:
+            return distance, image
+    return None
+
+
+def imageFilesExist(image: Image) -> bool:
+    """Check (with HEAD requests) that all of an image's files are in S3"""
+    return all(
+        storage.file_exists(path_for_image(image.fullsizehash, image_type, naming_version=image.naming_version))
+        for image_type in (ImageType.ORIGINAL, ImageType.RESIZED, ImageType.THUMB)
+    )
+
+
+def dedupImageUploads(uploads: list[ImageUpload], access_point_id) -> tuple[list[ImageUpload], DedupReport]:
+    """
+    Attach uploads of images that have already been processed straight to the access point,
+    reusing the existing Image row and files instead of decoding, resizing or storing anything.
+    Every upload path goes through this before queueing. The caller is responsible for committing.
+
+    Uploads that aren't byte-identical to an existing image are also compared by perceptual hash.
+    Depending on IMAGE_NEAR_DUPLICATE_ACTION, near-duplicates are reused like exact ones ("reuse"),
+    kept but reported ("warn"), or not looked for ("off").
+
+    With IMAGE_DEDUP_VERIFY set, an existing image is only reused once its files are confirmed to be in S3.
+    If they aren't, the upload is marked to regenerate them.
+
+    Args:
+        uploads (list[ImageUpload]): the uploaded images
+        access_point_id (int): the access point to attach the images to
+
+    Returns:
+        tuple[list[ImageUpload], DedupReport]: the uploads that still need processing, and what was saved
+    """
+    report = DedupReport()
+    if not uploads:
+        return [], report
+
+    hashes = {u.fullsizehash for u in uploads}
+    existing_images = {}
+    # newest naming version last, so it wins
+    for image in db.session.execute(
+        db.select(Image).where(Image.fullsizehash.in_(hashes)).order_by(Image.naming_version)
+    ).scalars():
+        existing_images[image.fullsizehash] = image
+
+    # uploads that aren't byte-identical to an existing image might still be the same photo, re-exported or resized
+    near_duplicate_action = app.config["IMAGE_NEAR_DUPLICATE_ACTION"]
+    near_duplicates = {}
+    if near_duplicate_action in ("warn", "reuse"):
+        for upload in uploads:
+            if upload.fullsizehash in existing_images or upload.perceptual_hash is None:
+                continue
+            match = findNearDuplicate(upload.perceptual_hash)
+            if match is None:
+                continue
+            distance, image = match
+            if near_duplicate_action == "reuse":
+                near_duplicates[upload.fullsizehash] = image
+            else:
+                report.near_duplicates.append({"ordering": upload.ordering, "image_id": image.id, "distance": distance})
+            app.logger.info(
+                f"Upload {upload.fullsizehash} looks like image {image.id} ({distance} bits apart), "
+                f"{'reusing' if near_duplicate_action == 'reuse' else 'keeping'} it"
+            )
+
+    if not existing_images and not near_duplicates:
+        return uploads, report
+
+    already_attached = set(db.session.execute(
+        db.select(ImageAccessPointRelation.image_id).where(
+            ImageAccessPointRelation.access_point_id == access_point_id,
+            ImageAccessPointRelation.image_id.in_([i.id for i in (*existing_images.values(), *near_duplicates.values())]),
         )
-        db.session.add(img)
-        db.session.flush()
-        img_id = img.id
-        db.session.add(
-            ImageAccessPointRelation(image_id=img_id, 
-            ordering=count,
-            access_point_id=access_point_id)
+    ).scalars())
+
+    verified = {}
+    new_uploads = []
+    for upload in uploads:
+        existing_image = existing_images.get(upload.fullsizehash) or near_duplicates.get(upload.fullsizehash)
+        if existing_image is not None and app.config["IMAGE_DEDUP_VERIFY"]:
+            if existing_image.id not in verified:
+                verified[existing_image.id] = imageFilesExist(existing_image)
+            if not verified[existing_image.id]:
+                app.logger.warning(f"Files for image {existing_image.id} are missing from S3, regenerating them")
+                upload.reprocess = True
+                existing_image = None
+
+        if existing_image is None:
+            new_uploads.append(upload)
+            continue
+
+        # associate image
+        if existing_image.id not in already_attached:
+            db.session.add(
+                ImageAccessPointRelation(image_id=existing_image.id,
+                ordering=upload.ordering,
+                access_point_id=access_point_id)
+            )
+            already_attached.add(existing_image.id)
+        if upload.is_thumbnail:
+            set_thumbnail(db.session.get(AccessPoint, access_point_id), existing_image)
+
+        report.reused_images += 1
+        report.bytes_saved += upload.size
+
+    if report.reused_images:
+        average_cpu_seconds = db.session.execute(
+            db.select(func.avg(ImageJob.cpu_seconds)).where(ImageJob.cpu_seconds.is_not(None))
+        ).scalar()
+        report.cpu_seconds_saved = report.reused_images * float(average_cpu_seconds or 0)
+        app.logger.info(
+            f"Reused {report.reused_images} existing image(s) for access point {access_point_id}, "
+            f"saving {report.bytes_saved} bytes and ~{report.cpu_seconds_saved:.2f} CPU seconds"
+        )
+
+    return new_uploads, report
+
+
+def storedImageKeys(fullsizehash: str) -> set[str]:
+    """Every file stored for a content hash, under any naming version, found with a single listing"""
+    return {f["Key"] for f in storage.list_files(prefix=fullsizehash)}
+
+
+def queueImageUploads(uploads: list[ImageUpload], access_point_id) -> list[ImageJob]:
+    """
+    Store the originals of uploaded images and queue the rest of their processing for the background worker.
+    The originals are uploaded to S3 in parallel. If any of them fail, none are kept and UploadError is raised.
+    Uploading the same image to the same access point again reuses its existing job. The caller is responsible for committing.
+
+    Args:
+        uploads (list[ImageUpload]): the uploaded images
+        access_point_id (int): the access point to attach the images to
+
+    Returns:
+        list[ImageJob]: the jobs that will finish processing each image, in the same order as `uploads`
+    """
+    if not uploads:
+        return []
+
+    name_ver = get_latest_naming_version()
+    hashes = {u.fullsizehash for u in uploads}
+    in_progress = (ImageJobStatus.PENDING, ImageJobStatus.PROCESSING)
+
+    existing_jobs = {
+        job.fullsizehash: job
+        for job in db.session.execute(
+            db.select(ImageJob).where(
+                ImageJob.access_point_id == access_point_id,
+                ImageJob.fullsizehash.in_(hashes),
+            )
+        ).scalars()
+    }
+
+    # originals that are already stored don't need uploading again, and mustn't be deleted if another upload fails
+    already_stored = set(db.session.execute(
+        db.select(Image.fullsizehash).where(
+            Image.fullsizehash.in_({u.fullsizehash for u in uploads if not u.reprocess}),
+            Image.naming_version == name_ver,
+        )
+    ).scalars())
+    already_stored.update(db.session.execute(
+        db.select(ImageJob.fullsizehash).where(ImageJob.fullsizehash.in_(hashes), ImageJob.status.in_(in_progress))
+    ).scalars())
+
+    # a reprocessed image may still have its original, which other rows use. Leave it alone, so a failed batch can't roll it back
+    stored_keys = set()
+    for fullsizehash in {u.fullsizehash for u in uploads if u.reprocess}:
+        stored_keys.update(storedImageKeys(fullsizehash))
+
+    to_upload = {}
+    for upload in uploads:
+        job = existing_jobs.get(upload.fullsizehash)
+        if upload.fullsizehash in already_stored or (job is not None and job.status in in_progress):
+            continue
+        original_filename = path_for_image(upload.fullsizehash, ImageType.ORIGINAL, naming_version=name_ver)
+        if original_filename in stored_keys:
+            continue
+        to_upload.setdefault(original_filename, upload.file_obj)
+
+    # Upload full size imgs to S3
+    storage.upload_files(list(to_upload.items()))
+
+    now = datetime.utcnow()
+    jobs = []
+    for upload in uploads:
+        job = existing_jobs.get(upload.fullsizehash)
+        if job is not None and job.status in in_progress:
+            jobs.append(job)
+            continue
+
+        if job is None:
+            job = ImageJob(
+                access_point_id=access_point_id,
+                fullsizehash=upload.fullsizehash,
+                created=now,
+            )
+            db.session.add(job)
+            existing_jobs[upload.fullsizehash] = job
+
+        # (re)start the job from scratch. Processing is idempotent, so re-running a finished job just re-links the image
+        job.original_key = path_for_image(upload.fullsizehash, ImageType.ORIGINAL, naming_version=name_ver)
+        job.ordering = upload.ordering
+        job.is_thumbnail = upload.is_thumbnail
+        job.reprocess = upload.reprocess
+        job.status = ImageJobStatus.PENDING
+        job.attempts = 0
+        job.error = None
+        job.updated = now
+        job.run_after = now
+        jobs.append(job)
+
+    db.session.flush()
+    return jobs
+
+
+def image_job_json(job: ImageJob):
+    """
+    Create a JSON object for an image job
+    """
+    return {
+        "id": job.id,
+        "access_point_id": job.access_point_id,
+        "status": job.status.name,
+        "attempts": job.attempts,
+        "error": job.error,
+        "image_id": job.image_id,
+        "status_url": url_for("image_job_status", job_id=job.id),
+    }
+
+
+def image_upload_response(access_point_id, jobs, dedup: DedupReport):
+    """
+    Respond to an image upload. Scripts asking for JSON get a 202 with the queued jobs to poll
+    (and what deduplication saved), browsers go to the edit page
+    """
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"jobs": [image_job_json(j) for j in jobs], "deduplicated": dedup.json()}), 202
+    for near_duplicate in dedup.near_duplicates:
+        flash(
+            f"Uploaded image {near_duplicate['ordering']} looks very similar to an existing image (#{near_duplicate['image_id']}). "
+            "It was uploaded anyway, remove it if it's a duplicate"
         )
+    return redirect(f"/edit/{access_point_id}")
+
+
+########################
+# region Image Jobs
+########################
+
+def claim_image_job() -> Optional[ImageJob]:
+    """Claim the next runnable image job, if there is one, and mark it as processing.
+    Uses SKIP LOCKED so any number of workers (in any number of processes) can claim jobs safely.
+    """
+    now = datetime.utcnow()
+
+    # jobs left processing for too long belonged to a worker that died. Put them back in the queue, unless they have
+    # used up their attempts: a job that kills its worker (running out of memory on a huge image, say) would otherwise loop forever
+    stale = and_(
+        ImageJob.status == ImageJobStatus.PROCESSING,
+        ImageJob.updated < now - timedelta(seconds=app.config["IMAGE_JOB_STALE_AFTER"]),
+    )
+    db.session.execute(
+        db.update(ImageJob)
+        .where(stale, ImageJob.attempts >= app.config["IMAGE_JOB_MAX_ATTEMPTS"])
+        .values(status=ImageJobStatus.FAILED, updated=now, error="The worker processing this image stopped")
+    )
+    db.session.execute(
+        db.update(ImageJob)
+        .where(stale)
+        .values(status=ImageJobStatus.PENDING, updated=now)
+    )
+
+    job = db.session.execute(
+        db.select(ImageJob)
+        .where(ImageJob.status == ImageJobStatus.PENDING, ImageJob.run_after <= now)
+        .order_by(ImageJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).scalar()
+
+    if job is not None:
+        job.status = ImageJobStatus.PROCESSING
+        job.attempts += 1
+        job.updated = now
+    db.session.commit()
+    return job
+
+
+def image_by_hash_select(fullsizehash: str):
+    """Select the images stored under a content hash, newest naming version first"""
+    return db.select(Image).where(Image.fullsizehash == fullsizehash).order_by(Image.naming_version.desc())
 
-        if is_thumbnail:
-            access_point = db.session.execute(
-                db.select(AccessPoint).where(AccessPoint.id == access_point_id)
-            ).scalar_one()
-            if access_point is None:
-                print(f"access point not found with id {access_point_id}")
+
+def process_image_job(job: ImageJob):
+    """Finish processing an uploaded image: generate derivatives (unless an image with this hash already exists),
+    attach the image to the access point and mark the job done
+    """
+    image = db.session.execute(image_by_hash_select(job.fullsizehash)).scalars().first()
+
+    if image is None or job.reprocess:
+        with tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"])) as file_obj:
+            storage.download_file(job.original_key, file_obj)
+            started = time.thread_time()
+            if image is None:
+                image = processImageDerivatives(file_obj, job.fullsizehash)
             else:
-                set_thumbnail(access_point, img)
+                # the original was uploaded again under the latest naming version, so regenerate everything there.
+                # Files that survived are left in place, so a failed upload can't roll them back
+                image.naming_version = get_latest_naming_version()
+                uploadImageDerivatives(file_obj, image, existing_paths=storedImageKeys(job.fullsizehash))
+            job.cpu_seconds = time.thread_time() - started
+
+    already_attached = db.session.execute(
+        db.select(ImageAccessPointRelation).where(
+            ImageAccessPointRelation.image_id == image.id,
+            ImageAccessPointRelation.access_point_id == job.access_point_id,
+        )
+    ).scalar()
+    if already_attached is None:
+        db.session.add(
+            ImageAccessPointRelation(image_id=image.id,
+            ordering=job.ordering,
+            access_point_id=job.access_point_id)
+        )
+
+    if job.is_thumbnail:
+        access_point = db.session.execute(
+            db.select(AccessPoint).where(AccessPoint.id == job.access_point_id)
+        ).scalar_one()
+        set_thumbnail(access_point, image)
+
+    job.status = ImageJobStatus.DONE
+    job.image_id = image.id
+    job.error = None
+    job.updated = datetime.utcnow()
     db.session.commit()
 
 
+def run_next_image_job() -> bool:
+    """Claim and process a single image job, retrying it later (with backoff) if it fails
+
+    Returns:
+        bool: whether there was a job to run
+    """
+    job = claim_image_job()
+    if job is None:
+        return False
+
+    job_id = job.id
+    try:
+        process_image_job(job)
+    except Exception as e:
+        app.logger.error(f"Image job {job_id} failed: {e}")
+        db.session.rollback()
+
+        job = db.session.get(ImageJob, job_id)
+        job.error = str(e)
+        job.updated = datetime.utcnow()
+        if job.attempts >= app.config["IMAGE_JOB_MAX_ATTEMPTS"]:
+            job.status = ImageJobStatus.FAILED
+        else:
+            job.status = ImageJobStatus.PENDING
+            job.run_after = job.updated + timedelta(seconds=app.config["IMAGE_JOB_RETRY_DELAY"] * 2 ** (job.attempts - 1))
+        db.session.commit()
+    return True
+
+
+class ImageJobWorker:
+    """
+    A small pool of background threads that process queued image jobs.
+    Threads sleep until they are notified of new work or the poll interval passes
+    """
+
+    def __init__(self, app, thread_count, poll_interval):
+        self.app = app
+        self.thread_count = thread_count
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads in this process, if they aren't already running"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.thread_count):
+                t = threading.Thread(target=self._run, name=f"image-job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def notify(self):
+        """Wake the workers up to check for new jobs"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    worked = run_next_image_job()
+            except Exception as e:
+                self.app.logger.error(f"Image job worker error: {e}")
+                worked = False
+
+            if not worked:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+image_job_worker = ImageJobWorker(
+    app,
+    thread_count=int(app.config["IMAGE_JOB_WORKERS"]),
+    poll_interval=app.config["IMAGE_JOB_POLL_INTERVAL"],
+)
+
+
+@app.before_request
+def start_image_job_worker():
+    # started lazily so the threads live in the process serving requests (after gunicorn forks)
+    # and not in CLI commands like `flask db upgrade`
+    image_job_worker.start()
+
+
+########################
+# region Alt Text
+########################
+
+def get_cached_alt_text(fullsizehash: str) -> Optional[GeneratedAltText]:
+    return db.session.get(GeneratedAltText, fullsizehash)
+
+
+def describe_stored_image(fullsizehash: str, naming_version: int) -> str:
+    """Ask the alt text client to describe a stored image. Safe to call from any thread"""
+    # the model fetches the image itself, so it needs a URL that works from outside (the resized copy saves tokens).
+    # Locally stored files usually aren't reachable from outside, so those are sent inline
+    key = path_for_image(fullsizehash, ImageType.RESIZED, naming_version=naming_version)
+    path = storage.local_path(key)
+    if path is None:
+        image_url = storage.get_file_s3(key)
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+        # version 0 keys have no extension, so fall back to what the file itself says it is
+        mimetype = mimetypes.guess_type(key)[0]
+        if mimetype is None:
+            with PilImage.open(io.BytesIO(data)) as im:
+                mimetype = im.get_format_mimetype() or "application/octet-stream"
+        image_url = f"data:{mimetype};base64," + base64.b64encode(data).decode()
+    return alt_text_client.describe(image_url)
+
+
+@dataclass
+class AltTextProgress:
+    total: int = 0 # images without alt text when the run started
+    filled: int = 0
+    cached: int = 0 # images filled from the cache, without a request
+    requests: int = 0
+    failed: int = 0
+    running: bool = False
+    error: Optional[str] = None
+
+    def json(self):
+        return {
+            "total": self.total,
+            "filled": self.filled,
+            "cached": self.cached,
+            "requests": self.requests,
+            "failed": self.failed,
+            "running": self.running,
+            "error": self.error,
+        }
+
+
+def missing_alt_text_filter():
+    return db.or_(Image.alttext.is_(None), func.trim(Image.alttext) == "")
+
+
+# key of the Postgres advisory lock that allows one alt text run at a time, across every process and server
+ALT_TEXT_LOCK_KEY = 0x616c7474
+
+
+def generate_missing_alt_text(progress: AltTextProgress, batch_size=50, concurrency=4, rate_limit=60, on_batch=None):
+    """Fill in the alt text of every image that doesn't have any.
+    Only one run can go at a time anywhere (web or CLI), since two would describe the same images and pay twice.
+
+    Images are walked in id order, in batches. Copies of the same image (same hash) share one answer, which is cached
+    in `generated_alt_text`, so only images never described before cost a request. Requests run `concurrency` at a time,
+    no faster than `rate_limit` a minute. Each batch is committed as it finishes and only empty alt text is ever written,
+    so the job can be stopped at any point and run again to pick up where it left off (and retry failures).
+    Alt text an admin writes while the job runs is never overwritten.
+
+    Args:
+        progress (AltTextProgress): updated as the job runs
+        on_batch (callable, optional): called with `progress` after each batch
+
+    Raises:
+        RuntimeError: if another run is already going
+    """
+    # a session level lock, held on a connection of its own since the session's connection goes back to the pool after each commit
+    with db.engine.connect() as lock_connection:
+        locked = lock_connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ALT_TEXT_LOCK_KEY}).scalar()
+        if not locked:
+            raise RuntimeError("Alt text is already being generated elsewhere")
+        try:
+            _generate_missing_alt_text(progress, batch_size, concurrency, rate_limit, on_batch)
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ALT_TEXT_LOCK_KEY})
+
+
+def _generate_missing_alt_text(progress: AltTextProgress, batch_size, concurrency, rate_limit, on_batch):
+    limiter = RateLimiter(rate_limit, burst=concurrency)
+    progress.total = db.session.execute(
+        db.select(func.count()).where(missing_alt_text_filter())
+    ).scalar()
+
+    def describe(fullsizehash, naming_version):
+        limiter.acquire()
+        return describe_stored_image(fullsizehash, naming_version)
+
+    def fill(image_ids, alt_text):
+        result = db.session.execute(
+            db.update(Image)
+            .where(Image.id.in_(image_ids), missing_alt_text_filter())
+            .values(alttext=alt_text)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="alt-text") as pool:
+        while True:
+            batch = db.session.execute(
+                db.select(Image.id, Image.fullsizehash, Image.naming_version)
+                .where(missing_alt_text_filter(), Image.id > last_id)
+                .order_by(Image.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            ids_by_hash = {}
+            naming_versions = {}
+            for image_id, fullsizehash, naming_version in batch:
+                ids_by_hash.setdefault(fullsizehash, []).append(image_id)
+                naming_versions[fullsizehash] = max(naming_version, naming_versions.get(fullsizehash, 0))
+
+            cached = db.session.execute(
+                db.select(GeneratedAltText).where(GeneratedAltText.fullsizehash.in_(ids_by_hash))
+            ).scalars().all()
+            for entry in cached:
+                count = fill(ids_by_hash.pop(entry.fullsizehash), entry.alttext)
+                progress.filled += count
+                progress.cached += count
+
+            futures = {
+                pool.submit(describe, fullsizehash, naming_versions[fullsizehash]): fullsizehash
+                for fullsizehash in ids_by_hash
+            }
+            for future in as_completed(futures):
+                fullsizehash = futures[future]
+                progress.requests += 1
+                try:
+                    alt_text = future.result().strip()
+                except Exception as e:
+                    app.logger.error(f"Generating alt text for {fullsizehash} failed: {e}")
+                    progress.failed += len(ids_by_hash[fullsizehash])
+                    continue
+                db.session.merge(GeneratedAltText(
+                    fullsizehash=fullsizehash,
+                    alttext=alt_text,
+                    model=alt_text_client.model,
+                    created=datetime.utcnow(),
+                ))
+                progress.filled += fill(ids_by_hash[fullsizehash], alt_text)
+            db.session.commit()
+
+            if on_batch is not None:
+                on_batch(progress)
+
+
+class AltTextBatch:
+    """Runs generate_missing_alt_text in a background thread. Besides the advisory lock it takes, runs are tracked per process
+    so progress can be reported"""
+
+    def __init__(self, app):
+        self.app = app
+        self.progress = AltTextProgress()
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Start a run, unless one is already going
+
+        Returns:
+            bool: whether a run was started
+        """
+        with self._lock:
+            if self.progress.running:
+                return False
+            self.progress = AltTextProgress(running=True)
+        threading.Thread(target=self._run, args=(self.progress,), name="alt-text-batch", daemon=True).start()
+        return True
+
+    def _run(self, progress: AltTextProgress):
+        try:
+            with self.app.app_context():
+                generate_missing_alt_text(
+                    progress,
+                    concurrency=int(self.app.config["ALT_TEXT_CONCURRENCY"]),
+                    rate_limit=self.app.config["ALT_TEXT_RATE_LIMIT"],
+                )
+        except Exception as e:
+            self.app.logger.error(f"Alt text batch failed: {e}")
+            progress.error = str(e)
+        finally:
+            progress.running = False
+
+
+alt_text_batch = AltTextBatch(app)
+
+
 ########################
 # region Admin Pages
 ########################
@@ -1493,8 +3203,9 @@ def edit(id):
             "edit.html",
             accessPointDetails=getAccessPoint(id),
             accessPointFeedback=getAccessPointFeedback(id),
+            imageJobs=[image_job_json(j) for j in getUnfinishedImageJobs(id)],
             tags=getAllTags(),
-            showAIButton=False if gptClient is None else True
+            showAIButton=alt_text_client is not None
         )
     else:
         return render_template("404.html"), 404
@@ -1514,6 +3225,8 @@ def admin():
         formData=formFieldData(),
         accessPoints=getAllAccessPoints(),
         buildings=getAllBuildings(),
+        showAIButton=alt_text_client is not None,
+        altTextProgress=alt_text_batch.progress,
     )
 
 
@@ -1522,22 +3235,185 @@ def admin():
 ########################
 
 
+# The whole FeatureCollection is built by Postgres in one query.
+# Coordinates are stored as integers (see MapLocation) and status falls back to UNKNOWN when there is none
+MAP_GEOJSON_SQL = text("""
+    SELECT json_build_object(
+        'type', 'FeatureCollection',
+        'features', coalesce(json_agg(json_build_object(
+            'type', 'Feature',
+            'properties', json_build_object(
+                'id', access_point.id,
+                'building_name', building.name,
+                'room', location.room_number,
+                'status', coalesce(report_status.status_type::text, 'UNKNOWN')
+            ),
+            'geometry', json_build_object(
+                'coordinates', json_build_array(
+                    location.longitude / CAST(:scale AS double precision),
+                    location.latitude / CAST(:scale AS double precision)
+                ),
+                'type', 'Point'
+            )
+        )), '[]'::json)
+    )::text
+    FROM access_point
+    JOIN location ON location.id = access_point.location_id
+    JOIN building ON building.id = location.building_id
+    LEFT JOIN access_point_current_status ON access_point_current_status.access_point_id = access_point.id
+    LEFT JOIN report_status ON report_status.id = access_point_current_status.status_id
+    WHERE location.latitude IS NOT NULL AND location.longitude IS NOT NULL
+""")
+
+# the last map GeoJSON built, and the cache version it was built at
+_map_cache = {"version": None, "body": None}
+
+
+def get_cache_version(name: str) -> int:
+    """Get the current version of some cached data. It is bumped after every commit that changes the underlying tables
+    (see db.CACHE_VERSION_TABLES)
+    """
+    version = db.session.execute(
+        db.select(CacheVersion.version).where(CacheVersion.name == name)
+    ).scalar()
+    return version or 0
+
+
 @app.route("/map.geojson")
 def mapdata():
-    return {
-        "features": list(
-            map(
-                map_features_geojson,
-                db.session.execute(
-                    db.select(AccessPoint)
-                    .join(Location)
-                    .where(AccessPoint.location_id == Location.id)
-                    .filter(and_(Location.latitude != None, Location.longitude != None))
-                ).scalars(),
-            )
-        ),
-        "type": "FeatureCollection",
-    }
+    # read the version before the data, so a concurrent change can only make the cached body newer than its version
+    version = get_cache_version("map")
+    etag = f"map-{version}"
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        if _map_cache["version"] != version:
+            body = db.session.execute(MAP_GEOJSON_SQL, {"scale": 10 ** MapLocation.PRECISION}).scalar()
+            _map_cache.update(version=version, body=body)
+        resp = Response(_map_cache["body"], mimetype="application/json")
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+IMAGE_HASH_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+# keys image files are stored under (see path_for_image and path_for_image_variant): an MD5 hex digest, optionally followed by
+# a suffix and extension
+IMAGE_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}(_[a-z0-9]+\.[a-z0-9]+)?$")
+IMAGE_VARIANT_PATTERN = re.compile(r"^w(?P<width>[0-9]{1,5})\.(?P<format>avif|webp|jpg)$")
+
+
+def send_stored_file(key: str, etag: str, cache_control: str):
+    """Respond with a file from local storage. With LOCAL_STORAGE_X_ACCEL_REDIRECT set, nginx is told to send the file itself
+    (from an `internal` location that serves LOCAL_STORAGE_ROOT under that prefix). Otherwise it is sent from here,
+    using sendfile where the server supports it, with Range requests handled by send_file
+    """
+    path = storage.local_path(key)
+    if not os.path.isfile(path):
+        abort(404)
+
+    accel_prefix = app.config["LOCAL_STORAGE_X_ACCEL_REDIRECT"]
+    if accel_prefix:
+        resp = Response(mimetype=mimetypes.guess_type(key)[0])
+        resp.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{os.path.relpath(path, storage.root)}"
+    else:
+        resp = send_file(path, conditional=True, etag=False)
+    resp.headers["Cache-Control"] = cache_control
+    resp.set_etag(etag)
+    return resp
+
+
+@app.route("/storage/<key>")
+def stored_file(key):
+    """
+    Serve a file from local storage by its key, for the URLs LocalStorage hands out when IMAGE_PROXY is off
+    """
+    if not IMAGE_KEY_PATTERN.match(key) or storage.local_path(key) is None:
+        abort(404)
+    return send_stored_file(key, etag=key, cache_control="public, max-age=31536000, immutable")
+
+
+@app.route("/img/<file_hash>/<image_type>")
+def image_proxy(file_hash, image_type):
+    """
+    Serve an image from storage by its content hash.
+    Images never change once stored under a hash, so responses are cacheable forever
+    and revalidations can be answered without touching storage.
+    """
+    if not IMAGE_HASH_PATTERN.match(file_hash):
+        abort(404)
+
+    # either one of the ImageTypes, or a responsive variant like "w640.webp"
+    variant = IMAGE_VARIANT_PATTERN.match(image_type)
+    if variant is None:
+        try:
+            ImageType(image_type)
+        except ValueError:
+            abort(404)
+
+    # `v` only picks between the versions this hash is actually stored under. Trusting it blindly would
+    # let any other value serve a missing key, or the wrong file under an immutable URL
+    stored_versions = set(db.session.execute(
+        db.select(Image.naming_version).where(Image.fullsizehash == file_hash)
+    ).scalars())
+    naming_version = request.args.get("v", type=int)
+    if naming_version is None and stored_versions:
+        naming_version = max(stored_versions)
+    if naming_version not in stored_versions:
+        abort(404)
+
+    if variant is None:
+        key = path_for_image(file_hash, ImageType(image_type), naming_version=naming_version)
+    elif naming_version >= 2:
+        key = path_for_image_variant(file_hash, int(variant["width"]), ImageFormat(variant["format"]))
+    else:
+        abort(404)
+
+    etag = f"{file_hash}-{naming_version}-{image_type}"
+    cache_control = "public, max-age=31536000, immutable"
+
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = cache_control
+        return resp
+
+    if storage.local_path(key) is not None:
+        return send_stored_file(key, etag=etag, cache_control=cache_control)
+
+    try:
+        s3_object = storage.open_file(key, byte_range=request.headers.get("Range"))
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        if error_code == "InvalidRange":
+            return Response(status=416)
+        if error_code in ("NoSuchKey", "404"):
+            abort(404)
+        raise
+
+    body = s3_object["Body"]
+
+    def stream():
+        try:
+            yield from body.iter_chunks(chunk_size=64 * 1024)
+        finally:
+            body.close()
+
+    resp = Response(
+        stream_with_context(stream()),
+        status=206 if "ContentRange" in s3_object else 200,
+        mimetype=s3_object.get("ContentType", "image/jpeg"),
+        direct_passthrough=True,
+    )
+    resp.content_length = s3_object["ContentLength"]
+    if "ContentRange" in s3_object:
+        resp.headers["Content-Range"] = s3_object["ContentRange"]
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers["Cache-Control"] = cache_control
+    resp.set_etag(etag)
+    return resp
+
 
 @app.route("/buildings.json")
 @cross_origin()
@@ -1551,11 +3427,27 @@ def buildingdata():
     resp.headers['Cache-Control'] = f'public,max-age={int(60 * 10080)}'
     return resp
 
+@app.route("/api/storage/stats")
+@requires_admin
+def storage_stats():
+    """
+    Latency, error and byte counts of this process's S3 calls, and how well presigned URLs are being reused
+    """
+    if not isinstance(storage, S3Bucket):
+        return jsonify({"pid": os.getpid(), "backend": STORAGE_BACKEND})
+    return jsonify({
+        "pid": os.getpid(),
+        "backend": STORAGE_BACKEND,
+        "operations": storage.stats.snapshot(),
+        "url_cache": storage.url_cache.stats(),
+    })
+
+
 @app.route('/api/alt-text/<image_id>', methods=['POST'])
 @requires_admin
 def generate_alt_text(image_id):
 
-    if gptClient is None:
+    if alt_text_client is None:
         return jsonify({"error": "No openAI API key configured on server"}), 500
 
 
@@ -1567,47 +3459,52 @@ def generate_alt_text(image_id):
     if image is None:
         return jsonify({"error": "No image found for the given ID"}), 404
 
-
-    image_url = s3_bucket.get_file_s3(path_for_image(image.fullsizehash, ImageType.RESIZED, naming_version=image.naming_version))
+    # every copy of an image gets the same description, so only the first request for it costs anything
+    cached = get_cached_alt_text(image.fullsizehash)
+    if cached is not None:
+        return jsonify({"altText": cached.alttext, "cached": True})
 
     try:
-        response = gptClient.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                "Please describe the contents of this image in detail using the format of a11y alt text. "
-                                "If possible, please keep the response length to within three sentences or 50 words. "
-                                "Please try to keep the response scope limited to the primary focuses of the image. "
-                                "Please do not start the response with the phrase 'Alt text' or similar phrases. "
-                                "Only include the actual alt text in the response."
-                            )
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url,
-                                "detail": "low"  # Saves tokens/money
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=300
-        )
-
-        alt_text = response.choices[0].message.content
-        return jsonify({"altText": alt_text})
-
+        alt_text = describe_stored_image(image.fullsizehash, image.naming_version).strip()
     except Exception as e:
         # Basic error logging
         app.logger.error(f"OpenAI Error: {e}")
         return jsonify({"error": "Failed to generate description"}), 500
 
+    db.session.merge(GeneratedAltText(
+        fullsizehash=image.fullsizehash,
+        alttext=alt_text,
+        model=alt_text_client.model,
+        created=datetime.utcnow(),
+    ))
+    db.session.commit()
+    return jsonify({"altText": alt_text, "cached": False})
+
+
+@app.route('/api/alt-text/batch', methods=['GET'])
+@requires_admin
+def alt_text_batch_status():
+    """
+    Progress of the alt text batch started from this process
+    """
+    return jsonify(alt_text_batch.progress.json())
+
+
+@app.route('/api/alt-text/batch', methods=['POST'])
+@requires_admin
+def start_alt_text_batch():
+    """
+    Start filling in missing alt text in the background
+    """
+    if alt_text_client is None:
+        return jsonify({"error": "No openAI API key configured on server"}), 500
+
+    started = alt_text_batch.start()
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(alt_text_batch.progress.json()), 202 if started else 409
+    flash("Generating missing alt text in the background" if started else "Alt text is already being generated")
+    return redirect("/admin")
+
 ########################
 # region Form submissions
 ########################
@@ -1820,29 +3717,64 @@ def detachImageEndpoint(image_id, item_id):
     detachImageByID(image_id, item_id)
     
     db.session.commit()
+    flushFileDeletions()
 
     return ("", 204)
 
 
-# @app.route("/export", methods=["POST"])
-# @requires_admin
-# def export_data():
-#     """
-#     Route to perform public export
-#     """
-#     public = bool(int(request.args.get("p")))
-#     now = datetime.now()
-#     dir_name = "export" + now.strftime("%d%m%Y")
-#     basepath = "tmp/"
+def parse_image_types(value: str) -> tuple[ImageType, ...]:
+    try:
+        return tuple(ImageType(t.strip()) for t in value.split(",") if t.strip())
+    except ValueError:
+        abort(400)
 
-#     export_images(basepath + dir_name + "/")
-#     export_database(basepath + dir_name + "/", public)
 
-#     shutil.make_archive(basepath + dir_name, "zip", basepath + dir_name)
+@app.route("/export/images")
+@requires_admin
+def export_images():
+    """
+    Download every image, one folder per access point, as a zip that is built while it downloads.
+    `types` picks which files of each image to include (comma separated ImageTypes, originals by default).
+    An interrupted download can be resumed with `after`, the id of the last access point whose folder arrived complete
+    """
+    after = request.args.get("after", default=0, type=int)
+    image_types = parse_image_types(request.args.get("types", ImageType.ORIGINAL.value))
+    if not image_types:
+        abort(400)
+
+    filename = f"photos-{datetime.now().strftime('%Y%m%d')}" + (f"-after-{after}" if after else "") + ".zip"
+    resp = Response(
+        stream_with_context(stream_image_archive(
+            image_archive_entries(after=after, image_types=image_types),
+            workers=int(app.config["IMAGE_EXPORT_WORKERS"]),
+        )),
+        mimetype="application/zip",
+        direct_passthrough=True,
+    )
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    # don't let nginx buffer the archive to disk
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
-#     return send_file(basepath + dir_name + ".zip")
 
+@app.route("/export", methods=["POST"])
+@requires_admin
+def export_data():
+    """
+    Download the directory's data as a zip of CSV files, streamed straight from the database.
+    `p=1` makes a public export, leaving out feedback, status notes and ticket references
+    """
+    public = bool(request.args.get("p", default=1, type=int))
+    filename = f"export-{'public' if public else 'private'}-{datetime.now().strftime('%Y%m%d')}.zip"
 
+    resp = Response(
+        stream_with_context(stream_database_export(public)),
+        mimetype="application/zip",
+        direct_passthrough=True,
+    )
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 
 @app.route("/uploadimage/<id>", methods=["POST"])
@@ -1855,11 +3787,78 @@ def uploadNewImage(id):
         db.select(func.count()).where(ImageAccessPointRelation.access_point_id == id)
     ).scalar()
 
-    for f in request.files.items(multi=True):
-        uploadImageResize(f[1], id, count)
-        count += 1
+    uploads = []
+    try:
+        for i, f in enumerate(request.files.items(multi=True)):
+            uploads.append(readImageUpload(f[1], count + i))
+        new_uploads, dedup = dedupImageUploads(uploads, id)
+        jobs = queueImageUploads(new_uploads, id)
+    finally:
+        closeImageUploads(uploads)
+
+    db.session.commit()
+    image_job_worker.notify()
+
+    return image_upload_response(id, jobs, dedup)
+
+
+@app.route("/api/image-jobs/<int:job_id>")
+@requires_admin
+def image_job_status(job_id):
+    """
+    Status of a single image processing job
+    """
+    job = db.session.get(ImageJob, job_id)
+    if job is None:
+        return jsonify({"error": "No image job found for the given ID"}), 404
+    return jsonify(image_job_json(job))
+
 
-    return redirect(f"/edit/{id}")
+@app.route("/api/image-jobs/<int:job_id>/dismiss", methods=["POST"])
+@requires_admin
+def dismiss_image_job(job_id):
+    """
+    Remove a failed image job, so it's no longer listed on the edit page.
+    Its original is queued for deletion, and only removed if nothing else still uses it
+    """
+    job = db.session.get(ImageJob, job_id)
+    if job is None or job.status != ImageJobStatus.FAILED:
+        abort(404)
+
+    access_point_id = job.access_point_id
+    if job.image_id is None:
+        queueFileDeletions([job.original_key])
+    db.session.delete(job)
+    db.session.commit()
+    flushFileDeletions()
+
+    return redirect(f"/edit/{access_point_id}")
+
+
+@app.route("/api/image-jobs")
+@requires_admin
+def image_jobs_for_access_point():
+    """
+    Image processing jobs for an access point that haven't finished successfully
+    Route:
+        /api/image-jobs?access_point_id=ap_id
+    """
+    access_point_id = request.args.get("access_point_id", type=int)
+    return jsonify({"jobs": [image_job_json(j) for j in getUnfinishedImageJobs(access_point_id)]})
+
+
+def location_by_room_select(building_id: int, floor: int, room: int):
+    """Select the location of a room in a building"""
+    return db.select(Location).where(
+        Location.building_id == building_id,
+        Location.floor_number == floor,
+        Location.room_number == room,
+    )
+
+
+def building_by_acronym_select(acronym: str):
+    """Select a building by its acronym (like "GOL")"""
+    return db.select(Building).where(Building.acronym == acronym)
 
 
 def build_location(building: Building, room_form_data: str, location_nick:str, coords: str, notes:str) -> tuple[Location, bool]:
@@ -1877,12 +3876,7 @@ def build_location(building: Building, room_form_data: str, location_nick:str, c
     """
     floor, room = RoomNumber.from_string(room_form_data).integers()
 
-    stmt = db.select(Location).where(
-        Location.building_id == building.id,
-        Location.floor_number == floor,
-        Location.room_number == room,
-    )
-    location = db.session.execute(stmt).scalar_one_or_none()
+    location = db.session.execute(location_by_room_select(building.id, floor, room)).scalar_one_or_none()
 
     gpsLocation = MapLocation.from_string(coords)
 
@@ -1928,42 +3922,22 @@ def processAndUploadImages(images, access_point: AccessPoint):
     Args:
         images (_type_): the images/file handles to process
         access_point (AccessPoint): the access point the images should be associated with
+
+    Returns:
+        tuple[list[ImageJob], DedupReport]: the jobs queued to finish processing new images, and what deduplication saved
     """
+    db.session.flush() # make sure the access point has an id
 
     # Count is the order in which the images are shown
-    count = 1
-    for f in images:
-        # print(f[1].filename)
-
-        fullsizehash = generateImageHash(f[1])
-        f[1].seek(0)
-
-        # Check if image is already used in DB
-        usecount = db.session.execute(
-            db.select(func.count()).where(Image.fullsizehash == fullsizehash)
-        ).scalar()
-        if usecount > 0:
-            # print(fullsizehash)
-            # associate image
-            existing_image = db.session.execute(
-                db.select(Image).where(Image.fullsizehash == fullsizehash)
-            ).scalar()
-
-            db.session.add(
-                ImageAccessPointRelation(image_id=existing_image.id, 
-                ordering=count,
-                access_point_id=access_point.id)
-            )
-            count += 1
-            continue
-            # return render_template("404.html"), 404
-
-        # Begin adding full size to database
-        f[1].seek(0)
-
-        uploadImageResize(f[1], access_point.id, count, is_thumbnail=(count == 0))
+    uploads = []
+    try:
+        for count, f in enumerate(images, start=1):
+            uploads.append(readImageUpload(f[1], count, is_thumbnail=(count == 0)))
 
-        count += 1
+        new_uploads, dedup = dedupImageUploads(uploads, access_point.id)
+        return queueImageUploads(new_uploads, access_point.id), dedup
+    finally:
+        closeImageUploads(uploads)
 
 
 @app.route("/upload/button", methods=["POST"])
@@ -1974,8 +3948,7 @@ def upload_button():
     """
 
     # Step 1: Find the building by its number
-    stmt = db.select(Building).where(Building.acronym == request.form["building"])
-    building = db.session.execute(stmt).scalar_one_or_none()
+    building = db.session.execute(building_by_acronym_select(request.form["building"])).scalar_one_or_none()
 
     if not building:
         raise ValueError(
@@ -2044,11 +4017,12 @@ def upload_button():
     db.session.add(button)
 
     
-    processAndUploadImages(request.files.items(multi=True), button)
+    jobs, dedup = processAndUploadImages(request.files.items(multi=True), button)
 
     db.session.commit()
+    image_job_worker.notify()
 
-    return redirect(f"/edit/{button.id}")
+    return image_upload_response(button.id, jobs, dedup)
 
 
 @app.route("/upload/elevator", methods=["POST"])
@@ -2056,8 +4030,7 @@ def upload_button():
 def upload_elevator():
 
     # Step 1: Find the building by its number
-    stmt = db.select(Building).where(Building.acronym == request.form["building"])
-    building = db.session.execute(stmt).scalar_one_or_none()
+    building = db.session.execute(building_by_acronym_select(request.form["building"])).scalar_one_or_none()
 
     if not building:
         raise ValueError(
@@ -2096,11 +4069,701 @@ def upload_elevator():
     db.session.add(elevator)
 
     
-    processAndUploadImages(request.files.items(multi=True), elevator)
+    jobs, dedup = processAndUploadImages(request.files.items(multi=True), elevator)
+
+    db.session.commit()
+    image_job_worker.notify()
 
+    return image_upload_response(elevator.id, jobs, dedup)
+
+
+########################
+# region CLI
+########################
+
+status_cli = AppGroup("status", help="Maintain the current status of access points")
+
+
+@status_cli.command("rebuild")
+def rebuild_status_command():
+    """
+    Rebuild the current status of every access point from the status history
+    """
+    refresh_current_status()
     db.session.commit()
+    click.echo("Current status rebuilt")
+
+
+@status_cli.command("check")
+def check_status_command():
+    """
+    Check that the current status of every access point matches the status history
+    """
+    mismatches = find_current_status_mismatches()
+    for ap_id, stored, expected in mismatches:
+        click.echo(f"access point {ap_id}: stored status {stored}, expected {expected}")
+
+    if mismatches:
+        raise click.ClickException(f"{len(mismatches)} access point(s) out of sync. Run `flask status rebuild` to fix")
+    click.echo("Current status is consistent")
+
+
+app.cli.add_command(status_cli)
+
+
+index_cli = AppGroup("indexes", help="Check that hot queries are served by indexes")
+
+
+def hot_query_statements():
+    """The lookups the app runs on every page render or write, built by the same functions the app uses, with sample values
+
+    Returns:
+        dict: a description of each query mapped to its statement
+    """
+    return {
+        "current status by access point": current_status_select(1),
+        "current statuses of access points": access_point_statuses_select([1, 2]),
+        "status history by access point": latest_status_select()
+            .where(AccessPointReports.access_point_id.in_([1, 2])),
+        "images by access point": access_point_images_select([1, 2]),
+        "tags by access point": access_point_tags_select([1, 2]),
+        "image by hash": image_by_hash_select("0" * 32),
+        "location by room": location_by_room_select(1, 1, 100),
+        "report by ticket number": report_by_ref_select("WOT0000000"),
+        "building by acronym": building_by_acronym_select("GOL"),
+        "access point by concordance": concordance_select("0"),
+    }
+
+
+def find_sequential_scans(stmt) -> list[str]:
+    """EXPLAIN a statement and return the names of any tables it reads with a sequential scan
+    """
+    compiled = stmt.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+    plan = db.session.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+
+    scanned = []
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if node["Node Type"] == "Seq Scan":
+            scanned.append(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return scanned
+
+
+@index_cli.command("check")
+def check_indexes_command():
+    """
+    EXPLAIN each hot query and fail if any of them has to fall back to a sequential scan
+    """
+    # With sequential scans disabled the planner only picks one when no usable index exists,
+    # so this gives the same answer on a small dev database as on a large production one
+    db.session.execute(text("SET LOCAL enable_seqscan = off"))
+
+    failures = 0
+    for name, stmt in hot_query_statements().items():
+        scanned = find_sequential_scans(stmt)
+        if scanned:
+            failures += 1
+            click.echo(f"FAIL {name}: sequential scan on {', '.join(scanned)}")
+        else:
+            click.echo(f"ok   {name}")
+    db.session.rollback()
+
+    if failures:
+        raise click.ClickException(f"{failures} hot quer{'y' if failures == 1 else 'ies'} fell back to a sequential scan")
+
+
+app.cli.add_command(index_cli)
+
+
+images_cli = AppGroup("images", help="Maintain stored images")
+
+
+def init_image_migration_worker():
+    """Runs in each forked migration worker. Connections inherited from the parent can't be shared, so drop them
+    (S3Bucket does this for itself)
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def migrate_image_files(fullsizehash: str, from_version: int, to_version: int) -> dict:
+    """
+    Generate and store the files an image needs under a new naming version. Runs in a worker process, so it only touches S3
+
+    Returns:
+        dict: the columns to set on the Image row (variants, dimensions, sizes, placeholder and perceptual hash)
+            under "columns", and how many bytes of original were read
+    """
+    with app.app_context():
+        old_original = path_for_image(fullsizehash, ImageType.ORIGINAL, naming_version=from_version)
+        new_original = path_for_image(fullsizehash, ImageType.ORIGINAL, naming_version=to_version)
+
+        # files the image already has at the same path under both versions are in use, so aren't touched
+        existing_paths = {
+            path_for_image(fullsizehash, image_type, naming_version=from_version)
+            for image_type in ImageType
+        } & {
+            path_for_image(fullsizehash, image_type, naming_version=to_version)
+            for image_type in ImageType
+        }
+
+        with tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"])) as file_obj:
+            storage.download_file(old_original, file_obj)
+            file_obj.seek(0, io.SEEK_END)
+            original_bytes = file_obj.tell()
+            file_obj.seek(0)
+
+            # a detached row, just to collect the columns the new files are described by
+            image = Image(fullsizehash=fullsizehash, naming_version=to_version)
+            derivatives = uploadImageDerivatives(file_obj, image, existing_paths=existing_paths)
+
+        if new_original not in existing_paths:
+            storage.copy_file(old_original, new_original)
+
+    columns = {
+        "variant_widths": image.variant_widths,
+        "variant_formats": image.variant_formats,
+        "perceptual_hash": image.perceptual_hash,
+        "original_bytes": image.original_bytes,
+    }
+    columns.update({column: getattr(image, column) for column in derivatives.metadata})
+    return {
+        "columns": columns,
+        "original_bytes": original_bytes,
+    }
+
+
+def read_migration_checkpoint(path: Path, to_version: int) -> dict:
+    if path.exists():
+        checkpoint = json.loads(path.read_text())
+        if checkpoint.get("to") == to_version:
+            return checkpoint
+    return {"to": to_version, "last_id": 0, "failed": []}
+
+
+def write_migration_checkpoint(path: Path, checkpoint: dict):
+    # write then rename, so an interrupted run never leaves a half written checkpoint
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(json.dumps(checkpoint))
+    tmp_path.replace(path)
+
+
+@images_cli.command("migrate")
+@click.option("--to", "to_version", type=int, default=get_latest_naming_version, show_default="latest",
+              help="Naming version to migrate images to")
+@click.option("--batch-size", type=int, default=50, show_default=True, help="Images to fetch and process per batch")
+@click.option("--workers", type=int, default=os.cpu_count(), show_default="CPU count", help="Processes generating derivatives")
+@click.option("--checkpoint", "checkpoint_path", type=click.Path(path_type=Path), default=None,
+              help="File to record progress in. Defaults to images-migrate-v<N>.json")
+@click.option("--restart", is_flag=True, help="Ignore any existing checkpoint and start from the beginning")
+@click.option("--dry-run", is_flag=True, help="Report what would be migrated without changing anything")
+def migrate_images_command(to_version, batch_size, workers, checkpoint_path, restart, dry_run):
+    """
+    Regenerate the files of images stored under older naming versions and move them to a newer one.
+
+    Each image keeps being served from its old files until its new ones are all stored,
+    then its naming_version is flipped in a single UPDATE, so this can run against a live site.
+    Progress is checkpointed after every batch, so an interrupted run picks up where it left off.
+    Files only used by the old version are left in S3.
+    """
+    if to_version < 1 or to_version > get_latest_naming_version():
+        raise click.BadParameter(f"must be between 1 and {get_latest_naming_version()}", param_hint="--to")
+
+    checkpoint_path = checkpoint_path or Path(f"images-migrate-v{to_version}.json")
+    checkpoint = {"to": to_version, "last_id": 0, "failed": []}
+    if not restart:
+        checkpoint = read_migration_checkpoint(checkpoint_path, to_version)
+
+    pending = db.select(Image.id, Image.fullsizehash, Image.naming_version).where(
+        Image.naming_version < to_version,
+        Image.id > checkpoint["last_id"],
+    )
+    by_version = db.session.execute(
+        db.select(Image.naming_version, func.count())
+        .where(Image.naming_version < to_version, Image.id > checkpoint["last_id"])
+        .group_by(Image.naming_version)
+        .order_by(Image.naming_version)
+    ).all()
+    total = sum(count for _, count in by_version)
+
+    if checkpoint["last_id"]:
+        click.echo(f"Resuming after image {checkpoint['last_id']} ({len(checkpoint['failed'])} failed so far)")
+    for version, count in by_version:
+        click.echo(f"{count} image(s) at naming version {version}")
+    if dry_run:
+        click.echo(f"Dry run: would migrate {total} image(s) to naming version {to_version}")
+        return
+    if total == 0:
+        click.echo(f"Nothing to migrate to naming version {to_version}")
+        return
+
+    done = 0
+    previously_failed = len(checkpoint["failed"])
+    original_bytes = 0
+    started = time.monotonic()
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_image_migration_worker) as pool:
+        while True:
+            batch = db.session.execute(
+                pending.where(Image.id > checkpoint["last_id"]).order_by(Image.id).limit(batch_size)
+            ).all()
+            if not batch:
+                break
+
+            # rows sharing a hash (and version) share files, so each set of files is only generated once
+            rows_by_files = {}
+            for image_id, fullsizehash, naming_version in batch:
+                rows_by_files.setdefault((fullsizehash, naming_version), []).append(image_id)
+
+            futures = {
+                pool.submit(migrate_image_files, fullsizehash, naming_version, to_version): (fullsizehash, naming_version)
+                for fullsizehash, naming_version in rows_by_files
+            }
+            for future in as_completed(futures):
+                fullsizehash, naming_version = futures[future]
+                image_ids = rows_by_files[(fullsizehash, naming_version)]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    click.echo(f"FAIL image(s) {', '.join(map(str, image_ids))} ({fullsizehash}): {e}", err=True)
+                    checkpoint["failed"].extend(image_ids)
+                    continue
+
+                # the flip. Rows that changed since the batch was read (say, were deleted) are left alone
+                db.session.execute(
+                    db.update(Image)
+                    .where(Image.id.in_(image_ids), Image.naming_version == naming_version)
+                    .values(
+                        naming_version=to_version,
+                        **result["columns"],
+                    )
+                )
+                # the regenerated perceptual hash may differ from the one in the near-duplicate index
+                touched_cache_versions(db.session).add("images")
+                db.session.commit()
+                done += len(image_ids)
+                original_bytes += result["original_bytes"]
+
+            checkpoint["last_id"] = batch[-1][0]
+            write_migration_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.monotonic() - started
+            rate = done / elapsed if elapsed else 0
+            failed = len(checkpoint["failed"]) - previously_failed
+            remaining = max(total - done - failed, 0)
+            click.echo(
+                f"{done + failed}/{total} image(s), {failed} failed, "
+                f"{rate:.1f} images/s, {original_bytes / elapsed / 1024 / 1024:.1f} MB/s of originals, "
+                f"ETA {timedelta(seconds=round(remaining / rate)) if rate else 'unknown'}"
+            )
+
+    click.echo(f"Migrated {done} image(s) to naming version {to_version} in {timedelta(seconds=round(time.monotonic() - started))}")
+    if checkpoint["failed"]:
+        raise click.ClickException(
+            f"{len(checkpoint['failed'])} image(s) failed: {', '.join(map(str, checkpoint['failed']))}. "
+            f"Run again with --restart to retry them"
+        )
+
+
+def perceptual_hash_for_stored_image(fullsizehash: str, naming_version: int) -> int:
+    """dHash an image that is already stored, from its original (the same file new uploads are hashed from)"""
+    with tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"])) as file_obj:
+        storage.download_file(path_for_image(fullsizehash, ImageType.ORIGINAL, naming_version=naming_version), file_obj)
+        with PilImage.open(file_obj) as im:
+            return dhash(im)
+
+
+IMAGE_HEADER_BYTES = 256 * 1024
+
+def read_stored_image_header(key: str):
+    """Open a stored image using only its first few hundred KB, which is enough to read its size and EXIF data.
+    Falls back to downloading the whole file if the header runs past that
+
+    Returns:
+        tuple[PIL.Image.Image, file-like object]: the opened (but not decoded) image and the file it reads from, which the caller must close
+    """
+    s3_object = storage.open_file(key, byte_range=f"bytes=0-{IMAGE_HEADER_BYTES - 1}")
+    try:
+        header = io.BytesIO(s3_object["Body"].read())
+    finally:
+        s3_object["Body"].close()
+    try:
+        return PilImage.open(header), header
+    except (PilImage.UnidentifiedImageError, OSError):
+        file_obj = tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"]))
+        storage.download_file(key, file_obj)
+        return PilImage.open(file_obj), file_obj
+
+
+def metadata_for_stored_image(fullsizehash: str, naming_version: int) -> dict:
+    """Measure an image that is already stored, for the Image columns new uploads get filled in by generateDerivatives"""
+    metadata = {}
+    for image_type in (ImageType.ORIGINAL, ImageType.RESIZED, ImageType.THUMB):
+        key = path_for_image(fullsizehash, image_type, naming_version=naming_version)
+        metadata[f"{image_type.value}_bytes"] = storage.file_size(key)
+
+        im, file_obj = read_stored_image_header(key)
+        with file_obj, im:
+            orientation = im.getexif().get(ExifBase.Orientation.value)
+            width, height = displayedSize(im.size, orientation)
+            metadata[f"{image_type.value}_width"] = width
+            metadata[f"{image_type.value}_height"] = height
+
+    with tempfile.SpooledTemporaryFile(max_size=int(app.config["UPLOAD_SPOOL_MAX_SIZE"])) as file_obj:
+        storage.download_file(path_for_image(fullsizehash, ImageType.RESIZED, naming_version=naming_version), file_obj)
+        with PilImage.open(file_obj) as im:
+            orientation = im.getexif().get(ExifBase.Orientation.value)
+            # the placeholder is tiny, so there's no need to decode the image at full size
+            im.draft("RGB", (PLACEHOLDER_WIDTH * 8, PLACEHOLDER_WIDTH * 8))
+            metadata["placeholder"] = makePlaceholder(im.convert("RGB"), orientation)
+    return metadata
+
+
+@images_cli.command("backfill-metadata")
+@click.option("--batch-size", type=int, default=100, show_default=True, help="Images to fetch and measure per batch")
+@click.option("--workers", type=int, default=8, show_default=True, help="Images to measure at once")
+def backfill_image_metadata_command(batch_size, workers):
+    """
+    Record the dimensions, file sizes and placeholder of every image stored before they were measured at upload.
+    Only images without a placeholder are touched, so this can be interrupted and run again
+    """
+    total = db.session.execute(
+        db.select(func.count()).where(Image.placeholder.is_(None))
+    ).scalar()
+    click.echo(f"{total} image(s) to measure")
+
+    last_id = 0
+    done = 0
+    failed = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = db.session.execute(
+                db.select(Image.id, Image.fullsizehash, Image.naming_version)
+                .where(Image.placeholder.is_(None), Image.id > last_id)
+                .order_by(Image.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            # rows sharing a hash (and version) share files, so each is only measured once
+            rows_by_files = {}
+            for image_id, fullsizehash, naming_version in batch:
+                rows_by_files.setdefault((fullsizehash, naming_version), []).append(image_id)
+
+            futures = {
+                pool.submit(metadata_for_stored_image, fullsizehash, naming_version): (fullsizehash, naming_version)
+                for fullsizehash, naming_version in rows_by_files
+            }
+            for future, files in futures.items():
+                image_ids = rows_by_files[files]
+                try:
+                    metadata = future.result()
+                except Exception as e:
+                    click.echo(f"FAIL image(s) {', '.join(map(str, image_ids))} ({files[0]}): {e}", err=True)
+                    failed += len(image_ids)
+                    continue
+                db.session.execute(db.update(Image).where(Image.id.in_(image_ids)).values(**metadata))
+                done += len(image_ids)
+            db.session.commit()
+
+            elapsed = time.monotonic() - started
+            click.echo(f"{done + failed}/{total} image(s), {failed} failed, {done / elapsed:.1f} images/s")
+
+    click.echo(f"Measured {done} image(s)")
+    if failed:
+        raise click.ClickException(f"{failed} image(s) could not be measured")
+
+
+@images_cli.command("backfill-phash")
+@click.option("--batch-size", type=int, default=100, show_default=True, help="Images to fetch and hash per batch")
+@click.option("--workers", type=int, default=8, show_default=True, help="Images to download and hash at once")
+@click.option("--rehash", is_flag=True, help="Recompute every image's hash, not only missing ones (for hashes taken from resized copies)")
+def backfill_perceptual_hashes_command(batch_size, workers, rehash):
+    """
+    Compute the perceptual hash of every image that doesn't have one yet, so near-duplicate detection covers them.
+    Only images without a hash are touched (unless --rehash is given), so this can be interrupted and run again
+    """
+    needs_hash = Image.perceptual_hash.is_(None) if not rehash else true()
+    total = db.session.execute(
+        db.select(func.count()).select_from(Image).where(needs_hash)
+    ).scalar()
+    click.echo(f"{total} image(s) to hash")
+
+    last_id = 0
+    done = 0
+    failed = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = db.session.execute(
+                db.select(Image.id, Image.fullsizehash, Image.naming_version)
+                .where(needs_hash, Image.id > last_id)
+                .order_by(Image.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            # rows sharing a hash (and version) share files, so each is only downloaded once
+            rows_by_files = {}
+            for image_id, fullsizehash, naming_version in batch:
+                rows_by_files.setdefault((fullsizehash, naming_version), []).append(image_id)
+
+            futures = {
+                pool.submit(perceptual_hash_for_stored_image, fullsizehash, naming_version): (fullsizehash, naming_version)
+                for fullsizehash, naming_version in rows_by_files
+            }
+            for future, files in futures.items():
+                image_ids = rows_by_files[files]
+                try:
+                    perceptual_hash = future.result()
+                except Exception as e:
+                    click.echo(f"FAIL image(s) {', '.join(map(str, image_ids))} ({files[0]}): {e}", err=True)
+                    failed += len(image_ids)
+                    continue
+                db.session.execute(
+                    db.update(Image).where(Image.id.in_(image_ids)).values(perceptual_hash=perceptual_hash)
+                )
+                touched_cache_versions(db.session).add("images")
+                done += len(image_ids)
+            db.session.commit()
+
+            elapsed = time.monotonic() - started
+            click.echo(f"{done + failed}/{total} image(s), {failed} failed, {done / elapsed:.1f} images/s")
+
+    click.echo(f"Hashed {done} image(s)")
+    if failed:
+        raise click.ClickException(f"{failed} image(s) could not be hashed")
+
+
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+@images_cli.command("gc")
+@click.option("--grace-period", type=float, default=24, show_default=True,
+              help="Hours an object must have existed before it can be removed, so uploads that haven't been committed yet are left alone")
+@click.option("--dry-run", is_flag=True, help="Report what would be removed without removing anything")
+def collect_garbage_command(grace_period, dry_run):
+    """
+    Remove image files from the bucket that no image (or queued image job) refers to,
+    such as files uploaded by a request whose transaction then failed
+    """
+    if not dry_run:
+        flushed = flushFileDeletions()
+        if flushed:
+            click.echo(f"Removed {flushed} file(s) queued for deletion")
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_period)
+
+    # list the bucket before reading the database: anything old enough to be a candidate was uploaded before the
+    # rows read below were committed (or they never will be), so a file can't be removed while its row is in flight
+    candidates = {}
+    scanned = 0
+    scanned_bytes = 0
+    for entry in storage.list_files():
+        scanned += 1
+        scanned_bytes += entry["Size"]
+        # only keys shaped like image keys are ever considered garbage, whatever else is in the bucket
+        if entry["LastModified"] < cutoff and IMAGE_KEY_PATTERN.match(entry["Key"]):
+            candidates[entry["Key"]] = entry["Size"]
+    click.echo(f"Scanned {scanned} object(s) ({format_bytes(scanned_bytes)}), {len(candidates)} image file(s) older than {grace_period:g}h")
+
+    images = db.session.execute(
+        db.select(Image.fullsizehash, Image.naming_version, Image.variant_widths, Image.variant_formats)
+        .execution_options(yield_per=1000)
+    )
+    for image in images:
+        for path in paths_for_image(image):
+            candidates.pop(path, None)
+    # originals of jobs still waiting to be (re)processed, or kept for a retry
+    for original_key in db.session.execute(db.select(ImageJob.original_key)).scalars():
+        candidates.pop(original_key, None)
+
+    orphan_bytes = sum(candidates.values())
+    click.echo(f"{len(candidates)} orphaned file(s) ({format_bytes(orphan_bytes)})")
+    if dry_run:
+        for key in sorted(candidates):
+            click.echo(f"  {key}")
+        return
+
+    removed = 0
+    reclaimed = 0
+    failures = {}
+    keys = sorted(candidates)
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = set(keys[start:start + DELETE_BATCH_SIZE])
+        # a file may have been uploaded again (under the same content addressed key) since the listing,
+        # by a request whose rows haven't committed yet. Those are newer than the cutoff now, so are kept
+        last_modified = storedLastModified(batch)
+        batch = {key for key in batch if key in last_modified and last_modified[key] < cutoff}
+        if not batch:
+            continue
+        batch_failures = storage.remove_files(batch)
+        failures.update(batch_failures)
+        removed += len(batch) - len(batch_failures)
+        reclaimed += sum(candidates[key] for key in batch if key not in batch_failures)
+    for key, error in failures.items():
+        click.echo(f"FAIL {key}: {error}", err=True)
+    click.echo(f"Removed {removed} file(s), reclaiming {format_bytes(reclaimed)}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} file(s) could not be removed")
+
+
+
+@images_cli.command("export")
+@click.argument("directory", type=click.Path(file_okay=False, path_type=Path))
+@click.option("--types", default=ImageType.ORIGINAL.value, show_default=True,
+              help="Which files of each image to include, comma separated (original, resized, thumb)")
+@click.option("--volume-size", type=int, default=1000, show_default=True,
+              help="Images per zip file. Volumes only end between access points, so they can run a little over")
+@click.option("--workers", type=int, default=None, show_default="IMAGE_EXPORT_WORKERS", help="Files to fetch from storage at once")
+def export_images_command(directory, types, volume_size, workers):
+    """
+    Export every image into numbered zip files in DIRECTORY (photos-0001.zip, ...), each with a CSV manifest of its contents.
+    Progress is saved after each volume, so running this again with the same DIRECTORY resumes after the last finished volume
+    """
+    try:
+        image_types = tuple(ImageType(t.strip()) for t in types.split(","))
+    except ValueError:
+        raise click.BadParameter(f"{types!r} isn't a list of image types", param_hint="--types")
+
+    directory.mkdir(parents=True, exist_ok=True)
+    progress_path = directory / "export-progress.json"
+    progress = json.loads(progress_path.read_text()) if progress_path.exists() else {"types": types, "after": 0, "volume": 0}
+    if progress["types"] != types:
+        raise click.ClickException(f"{directory} holds an export of --types {progress['types']}. Use that again, or another directory")
+    if progress["volume"]:
+        click.echo(f"Resuming after volume {progress['volume']} (access point {progress['after']})")
+
+    # split the remaining access points into volumes of about `volume_size` images
+    image_counts = db.session.execute(
+        db.select(ImageAccessPointRelation.access_point_id, func.count())
+        .where(ImageAccessPointRelation.access_point_id > progress["after"])
+        .group_by(ImageAccessPointRelation.access_point_id)
+        .order_by(ImageAccessPointRelation.access_point_id)
+    ).all()
+    volumes = []
+    volume_images = 0
+    for access_point_id, count in image_counts:
+        volume_images += count
+        if volume_images >= volume_size or access_point_id == image_counts[-1][0]:
+            volumes.append((access_point_id, volume_images))
+            volume_images = 0
+    click.echo(f"{sum(count for _, count in image_counts)} image(s) left to export in {len(volumes)} volume(s)")
+
+    started = time.monotonic()
+    exported_bytes = 0
+    for until, volume_images in volumes:
+        volume = progress["volume"] + 1
+        name = f"photos-{volume:04d}"
+        partial_path = directory / f"{name}.zip.partial"
+        with open(partial_path, "wb") as f:
+            for chunk in stream_image_archive(
+                image_archive_entries(after=progress["after"], until=until, image_types=image_types),
+                workers=workers or int(app.config["IMAGE_EXPORT_WORKERS"]),
+                manifest_name=f"{name}.csv",
+            ):
+                f.write(chunk)
+            exported_bytes += f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        partial_path.replace(directory / f"{name}.zip")
+
+        progress.update(after=until, volume=volume)
+        write_migration_checkpoint(progress_path, progress)
+        elapsed = time.monotonic() - started
+        click.echo(f"{name}.zip: {volume_images} image(s), {format_bytes(exported_bytes / elapsed)}/s")
+
+    click.echo(f"Exported {progress['volume']} volume(s) to {directory}")
+
+
+@images_cli.command("alt-text")
+@click.option("--batch-size", type=int, default=50, show_default=True, help="Images to fetch per batch")
+@click.option("--concurrency", type=int, default=None, show_default="ALT_TEXT_CONCURRENCY", help="Requests in flight at once")
+@click.option("--rate-limit", type=float, default=None, show_default="ALT_TEXT_RATE_LIMIT", help="Maximum requests per minute")
+def generate_alt_text_command(batch_size, concurrency, rate_limit):
+    """
+    Suggest alt text for every image that doesn't have any, reusing earlier answers for copies of the same image.
+    Only images without alt text are touched, so this can be interrupted and run again
+    """
+    if alt_text_client is None:
+        raise click.ClickException("No alt text client configured. Set OPENAI_API_KEY, or ALT_TEXT_CLIENT=stub")
+
+    started = time.monotonic()
+
+    def report(progress: AltTextProgress):
+        elapsed = time.monotonic() - started
+        click.echo(
+            f"{progress.filled + progress.failed}/{progress.total} image(s), {progress.cached} from cache, "
+            f"{progress.requests} request(s), {progress.failed} failed, {progress.requests / elapsed * 60:.1f} requests/min"
+        )
+
+    progress = AltTextProgress(running=True)
+    click.echo(f"Using {alt_text_client.model}")
+    try:
+        generate_missing_alt_text(
+            progress,
+            batch_size=batch_size,
+            concurrency=concurrency or int(app.config["ALT_TEXT_CONCURRENCY"]),
+            rate_limit=rate_limit or app.config["ALT_TEXT_RATE_LIMIT"],
+            on_batch=report,
+        )
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Filled in alt text for {progress.filled} image(s) with {progress.requests} request(s)")
+    if progress.failed:
+        raise click.ClickException(f"{progress.failed} image(s) could not be described")
+
+
+
+data_cli = AppGroup("data", help="Export the directory's data")
+
+
+@data_cli.command("export")
+@click.argument("directory", type=click.Path(file_okay=False, path_type=Path))
+@click.option("--private", is_flag=True, help="Include feedback, status notes and ticket references")
+@click.option("--format", "formats", type=click.Choice(["csv", "parquet"]), multiple=True, default=["csv"], show_default=True,
+              help="File formats to write. Can be given more than once")
+def export_data_command(directory, private, formats):
+    """
+    Export every table of the directory's data into DIRECTORY, reading rows with server side cursors
+    so memory use stays the same however big the tables get
+    """
+    if "parquet" in formats and pa is None:
+        raise click.ClickException("Exporting Parquet files needs pyarrow (`uv pip install pyarrow`)")
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, select in export_selects(public=not private).items():
+        started = time.monotonic()
+        for export_format in formats:
+            path = directory / f"{name}.{export_format}"
+            tmp_path = path.with_suffix(path.suffix + ".tmp")
+            if export_format == "csv":
+                with open(tmp_path, "wb") as f:
+                    for chunk in export_csv(select):
+                        f.write(chunk)
+            else:
+                export_parquet(select, tmp_path)
+            tmp_path.replace(path)
+        click.echo(f"{name}: {time.monotonic() - started:.1f}s")
+    click.echo(f"Exported {'private' if private else 'public'} data to {directory}")
+
 
-    return redirect(f"/edit/{elevator.id}")
+app.cli.add_command(images_cli)
+app.cli.add_command(data_cli)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+# File: archive.py
+# Building zip archives on the fly, so they can be streamed without being written to disk first
+
+import zipfile
+from datetime import datetime
+
+
+class _ZipSink:
+    """A write-only, unseekable file that collects what zipfile writes to it until it's taken"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStream:
+    """A zip archive built one file at a time, handing back the bytes of each file as it is added.
+
+    The output is never seeked, so zipfile describes each file in its local header and the archive's
+    central directory (with zip64 extensions past 4GB) is written when it is closed.
+    Files are stored uncompressed by default, since images don't compress.
+    """
+
+    def __init__(self, compression=zipfile.ZIP_STORED):
+        self._sink = _ZipSink()
+        self._zip = zipfile.ZipFile(self._sink, "w", compression=compression, allowZip64=True)
+        self.size = 0
+
+    def _take(self) -> bytes:
+        data = self._sink.take()
+        self.size += len(data)
+        return data
+
+    def add(self, name: str, data: bytes, modified: datetime = None) -> bytes:
+        """Add a file to the archive
+
+        Returns:
+            bytes: the next part of the archive
+        """
+        info = zipfile.ZipInfo(name, date_time=(modified or datetime.now()).timetuple()[:6])
+        info.compress_type = self._zip.compression
+        self._zip.writestr(info, data)
+        return self._take()
+
+    def add_stream(self, name: str, chunks, modified: datetime = None, compression=None):
+        """Add a file whose contents arrive in chunks, without holding it all in memory
+
+        Args:
+            chunks (Iterable[bytes]): the contents of the file
+            compression (int, optional): the zipfile compression method for this file. Defaults to the archive's
+
+        Yields:
+            bytes: successive parts of the archive, as the file is written
+        """
+        info = zipfile.ZipInfo(name, date_time=(modified or datetime.now()).timetuple()[:6])
+        info.compress_type = self._zip.compression if compression is None else compression
+        # the size isn't known up front, so allow for it going over 4GB
+        with self._zip.open(info, "w", force_zip64=True) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                data = self._take()
+                if data:
+                    yield data
+        yield self._take()
+
+    def close(self) -> bytes:
+        """Finish the archive
+
+        Returns:
+            bytes: the end of the archive
+        """
+        self._zip.close()
+        return self._take()
@@ -1,7 +1,53 @@
 
 class DefaultConfig():
 	ITEMSPERPAGE = 18
+	SEARCH_RESULT_LIMIT = 150
 	MAX_IMG_HEIGHT = 2048
+	# widths (in px) of the responsive variants generated for each image, in every format available (see get_variant_formats)
+	RESPONSIVE_IMAGE_WIDTHS = [320, 640, 1024, 1600, 2048]
+	# where image files are kept: "s3" (the bucket named by BUCKET_NAME) or "local" (files under LOCAL_STORAGE_ROOT, for single server installs and development)
+	STORAGE_BACKEND = "s3"
+	LOCAL_STORAGE_ROOT = "storage"
+	# with local storage behind nginx, an `internal` location serving LOCAL_STORAGE_ROOT under this prefix lets nginx send files itself
+	LOCAL_STORAGE_X_ACCEL_REDIRECT = None
+	# presigned image URLs are reused for S3_URL_CACHE_TTL seconds and stay valid for S3_URL_EXPIRES_IN seconds
+	S3_URL_EXPIRES_IN = 900
+	S3_URL_CACHE_TTL = 600
+	S3_URL_CACHE_SIZE = 4096
+	# how many files S3Bucket.upload_files sends at once (per process)
+	S3_UPLOAD_CONCURRENCY = 8
+	# files over S3_MULTIPART_THRESHOLD bytes are sent in S3_MULTIPART_CHUNKSIZE parts, S3_MULTIPART_CONCURRENCY at a time
+	S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+	S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+	S3_MULTIPART_CONCURRENCY = 2
+	# connections each process keeps open to S3 (should cover S3_UPLOAD_CONCURRENCY * S3_MULTIPART_CONCURRENCY, plus other requests)
+	S3_MAX_POOL_CONNECTIONS = 32
+	# seconds to wait for S3 to accept a connection / send data before retrying, and attempts per request (retries back off adaptively)
+	S3_CONNECT_TIMEOUT = 5
+	S3_READ_TIMEOUT = 30
+	S3_MAX_ATTEMPTS = 5
+	# uploads bigger than this many bytes are buffered on disk instead of in memory
+	UPLOAD_SPOOL_MAX_SIZE = 2 * 1024 * 1024
+	# before reusing an already-processed image for a duplicate upload, check its files are still in S3 (one HEAD per file)
+	IMAGE_DEDUP_VERIFY = False
+	# what to do with uploads that look like an existing image (perceptual hashes within IMAGE_NEAR_DUPLICATE_DISTANCE bits): "warn", "reuse" or "off"
+	IMAGE_NEAR_DUPLICATE_ACTION = "warn"
+	IMAGE_NEAR_DUPLICATE_DISTANCE = 6
+	# serve images through the cacheable /img route instead of presigned S3 URLs
+	IMAGE_PROXY = True
+	# background image processing (see ImageJobWorker)
+	IMAGE_JOB_WORKERS = 2
+	IMAGE_JOB_POLL_INTERVAL = 5 # seconds between checks for new jobs when idle
+	IMAGE_JOB_MAX_ATTEMPTS = 3
+	IMAGE_JOB_RETRY_DELAY = 30 # seconds before the first retry, doubling each attempt
+	IMAGE_JOB_STALE_AFTER = 600 # seconds before a job stuck processing is requeued
+	# suggested alt text: "openai" (needs OPENAI_API_KEY) or "stub" (canned text, for development and benchmarks)
+	ALT_TEXT_CLIENT = "openai"
+	ALT_TEXT_MODEL = "gpt-4o"
+	ALT_TEXT_CONCURRENCY = 4 # requests in flight at once during a batch
+	ALT_TEXT_RATE_LIMIT = 60 # requests per minute during a batch
+	# threads fetching files ahead of the zip being written, when exporting images
+	IMAGE_EXPORT_WORKERS = 8
 	DEBUG = False
 	JSON_LOGS = False
 
@@ -1,8 +1,9 @@
 from typing import Optional
 import enum
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, ForeignKey, text, Enum as EnumType, inspect
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, with_polymorphic
+from sqlalchemy import func, ForeignKey, text, Enum as EnumType, inspect, Index, DDL, event, Integer, String, BigInteger
+from sqlalchemy.dialects.postgresql import TSVECTOR, ARRAY, insert as pg_insert
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, with_polymorphic, Session
 from datetime import datetime
 from helpers import RoomNumber
 
@@ -40,6 +41,12 @@ class StatusType(enum.Enum):
     FIXED = 3
     VERIFIED = 4
 
+class ImageJobStatus(enum.Enum):
+    PENDING = 0
+    PROCESSING = 1
+    DONE = 2
+    FAILED = 3
+
 class Base(DeclarativeBase):
     pass
 
@@ -54,6 +61,12 @@ class Building(Base):
     additional_info: Mapped[Optional[str]]  # Example: "Renovated in 2020"
     locations = relationship("Location", backref="building")
 
+    __table_args__ = (
+        # catalog sort order (see getAccessPointsPaginated)
+        Index("ix_building_name_id", "name", "id"),
+        Index("ix_building_acronym", "acronym"),
+    )
+
     def human_name(self):
         if self.short_name is not None and self.short_name != "":
             return self.short_name + " (" + self.acronym + ")"
@@ -80,6 +93,12 @@ class Location(Base):
     additional_info: Mapped[Optional[str]]  # Example: "The accessible entrance between X and Y"
     access_points = relationship("AccessPoint", backref="location")
 
+    __table_args__ = (
+        # catalog sort order (see getAccessPointsPaginated)
+        Index("ix_location_building_id_nickname", "building_id", text("coalesce(nickname, '')")),
+        Index("ix_location_building_id_floor_number_room_number", "building_id", "floor_number", "room_number"),
+    )
+
     def human_name(self):
         if self.nickname is not None and self.nickname != "":
             return self.nickname
@@ -99,6 +118,14 @@ class AccessPoint(Base):
     thumbnail_ref: Mapped[int] = mapped_column(ForeignKey("images.id"), nullable=True)
     remarks: Mapped[str]
     active: Mapped[bool]  # Whether the access point is still in use
+    # maintained by database triggers (see SEARCH_INDEX_DDL), never written by the app
+    text_search_index: Mapped[Optional[str]] = mapped_column(TSVECTOR, nullable=True, deferred=True)
+
+    __table_args__ = (
+        Index("ix_access_point_text_search_index", "text_search_index", postgresql_using="gin"),
+        # catalog sort order (see getAccessPointsPaginated)
+        Index("ix_access_point_location_id_id_active", "location_id", "id", postgresql_where=text("active")),
+    )
 
     __mapper_args__ = {
         "polymorphic_identity": "access_point",
@@ -137,7 +164,7 @@ class Report(Base):
     """
     __tablename__ = "report"
     id: Mapped[int] = mapped_column(primary_key=True)
-    ref: Mapped[Optional[str]] # ticket number/reference
+    ref: Mapped[Optional[str]] = mapped_column(index=True) # ticket number/reference
 
 
 
@@ -152,6 +179,11 @@ class AccessPointConcordances(Base):
    
     access_point = relationship("AccessPoint")
 
+    __table_args__ = (
+        # the primary key leads with access_point_id, so lookups by identifier need their own index
+        Index("ix_access_point_concordances_identifier", "identifier"),
+    )
+
 class Status(Base):
     """
     Enables the storage of status history for each report.
@@ -168,6 +200,10 @@ class Status(Base):
 
     report = relationship("Report")
 
+    __table_args__ = (
+        Index("ix_report_status_report_id_timestamp", "report_id", "timestamp"),
+    )
+
     def statusInfo(self):
         return (self.status_type, self.status)
 
@@ -180,6 +216,23 @@ class AccessPointReports(Base):
     report_id: Mapped[int] = mapped_column(ForeignKey("report.id"), primary_key=True)
     access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"), primary_key=True)
 
+    __table_args__ = (
+        Index("ix_access_point_reports_access_point_id", "access_point_id"),
+    )
+
+
+class AccessPointCurrentStatus(Base):
+    """
+    Denormalized pointer to the most recent Status for each access point.
+    This is kept up to date whenever a status is written so readers can do a primary key lookup
+    instead of sorting the whole status history. It can be rebuilt from `report_status` at any time.
+    """
+    __tablename__ = "access_point_current_status"
+    access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"), primary_key=True)
+    status_id: Mapped[int] = mapped_column(ForeignKey("report_status.id"))
+
+    status: Mapped[Status] = relationship()
+
 
 
 class Image(Base):
@@ -189,8 +242,33 @@ class Image(Base):
     alttext: Mapped[Optional[str]]
     attribution: Mapped[Optional[str]]
     datecreated: Mapped[datetime]
-    fullsizehash: Mapped[str]
+    fullsizehash: Mapped[str] = mapped_column(index=True)
     naming_version: Mapped[int] = mapped_column(server_default='1')
+    # responsive variants (naming version 2 and up): the widths generated, and the formats (file extensions) each width was encoded in
+    variant_widths: Mapped[Optional[list[int]]] = mapped_column(ARRAY(Integer))
+    variant_formats: Mapped[Optional[list[str]]] = mapped_column(ARRAY(String))
+    perceptual_hash: Mapped[Optional[int]] = mapped_column(BigInteger) # 64 bit dHash (see perceptual_hash.py), for finding near-duplicates
+    # dimensions (as displayed, i.e. after EXIF rotation) and sizes of each stored file, so pages can reserve space for them
+    original_width: Mapped[Optional[int]]
+    original_height: Mapped[Optional[int]]
+    original_bytes: Mapped[Optional[int]]
+    resized_width: Mapped[Optional[int]]
+    resized_height: Mapped[Optional[int]]
+    resized_bytes: Mapped[Optional[int]]
+    thumb_width: Mapped[Optional[int]]
+    thumb_height: Mapped[Optional[int]]
+    thumb_bytes: Mapped[Optional[int]]
+    placeholder: Mapped[Optional[str]] # a tiny, blurry version of the image as a data URI, shown while it loads
+
+class GeneratedAltText(Base):
+    """
+    Alt text suggested by a model, cached by image hash so every copy of an image (and every later request for it) reuses one answer
+    """
+    __tablename__ = "generated_alt_text"
+    fullsizehash: Mapped[str] = mapped_column(primary_key=True)
+    alttext: Mapped[str]
+    model: Mapped[str] # the model that wrote it, so a better model's output can be told apart
+    created: Mapped[datetime]
 
 class Tag(Base):
     __tablename__ = "tags"
@@ -205,6 +283,10 @@ class AccessPointTag(Base):
     access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"), primary_key=True)
     access_point: Mapped[AccessPoint] = relationship()
 
+    __table_args__ = (
+        Index("ix_access_point_tags_access_point_id", "access_point_id"),
+    )
+
 class ImageAccessPointRelation(Base):
     __tablename__ = "access_point_image_relation"
     image_id: Mapped[int] = mapped_column(ForeignKey("images.id"), primary_key=True)
@@ -213,6 +295,10 @@ class ImageAccessPointRelation(Base):
     access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"), primary_key=True)
     access_point: Mapped[AccessPoint] = relationship()
 
+    __table_args__ = (
+        Index("ix_access_point_image_relation_access_point_id_ordering", "access_point_id", "ordering"),
+    )
+
 class Feedback(Base):
     __tablename__ = "feedback"
     feedback_id: Mapped[int] = mapped_column(primary_key=True)
@@ -222,4 +308,250 @@ class Feedback(Base):
     access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"))
     access_point: Mapped[AccessPoint] = relationship()
 
-db = SQLAlchemy(model_class=Base)
\ No newline at end of file
+class ImageJob(Base):
+    """
+    An uploaded image waiting for its resized and thumbnail derivatives to be generated.
+    The original is already stored in S3 when the job is queued; a background worker does the rest.
+    There is at most one job per image hash per access point, which makes re-uploads idempotent.
+    """
+    __tablename__ = "image_jobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    access_point_id: Mapped[int] = mapped_column(ForeignKey("access_point.id"))
+    fullsizehash: Mapped[str]
+    original_key: Mapped[str] # the S3 key the original upload was stored under
+    ordering: Mapped[int]
+    is_thumbnail: Mapped[bool] = mapped_column(server_default="false")
+    reprocess: Mapped[bool] = mapped_column(server_default="false") # regenerate derivatives even if an Image with this hash exists (its files went missing)
+    status: Mapped[EnumType(ImageJobStatus)] = mapped_column(EnumType(ImageJobStatus))
+    attempts: Mapped[int] = mapped_column(server_default="0")
+    error: Mapped[Optional[str]]
+    image_id: Mapped[Optional[int]] = mapped_column(ForeignKey("images.id"))
+    created: Mapped[datetime]
+    updated: Mapped[datetime]
+    run_after: Mapped[datetime] # not picked up by a worker before this time (used to back off retries)
+    cpu_seconds: Mapped[Optional[float]] # CPU time spent generating derivatives, used to estimate what deduplication saves
+
+    __table_args__ = (
+        Index("ix_image_jobs_access_point_id_fullsizehash", "access_point_id", "fullsizehash", unique=True),
+        Index("ix_image_jobs_status_run_after", "status", "run_after"),
+    )
+
+class FileDeletion(Base):
+    """
+    A file to remove from S3 once the transaction that queued it has committed (a transactional outbox).
+    Queuing deletions instead of making them straight away means a rolled back transaction never loses files,
+    and the files from a whole transaction can be removed in a few batched requests
+    """
+    __tablename__ = "file_deletions"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    key: Mapped[str]
+    created: Mapped[datetime]
+
+class CacheVersion(Base):
+    """
+    Version counters for cached, derived data (for example the map GeoJSON).
+    The app bumps a counter after each commit that changes the tables its data is built from (see CACHE_VERSION_TABLES),
+    so caches (and ETags) can be validated with a single primary key lookup.
+    """
+    __tablename__ = "cache_version"
+    name: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(server_default="0")
+
+
+# The text search config used for both the index and queries against it
+SEARCH_CONFIG = "english"
+
+# SQL that keeps `access_point.text_search_index` up to date.
+# The search document pulls from the building, location and tags, so triggers on those tables
+# refresh the index of every access point they touch.
+# Keep this in sync with the migration that created it if it ever changes.
+SEARCH_INDEX_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION access_point_room_string(floor_number integer, room_number integer) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN floor_number < 0 THEN chr(ascii('A') - floor_number - 1)
+            WHEN floor_number = 0 THEN '_'
+            ELSE floor_number::text
+        END || lpad(room_number::text, 3, '0')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_search_text(ap_id integer, ap_location_id integer, ap_remarks text) RETURNS text
+    LANGUAGE sql STABLE AS $$
+        SELECT concat_ws(' ',
+            b.name, b.acronym, b.short_name,
+            l.nickname, access_point_room_string(l.floor_number, l.room_number),
+            ap_remarks,
+            (SELECT string_agg(t.name, ' ') FROM access_point_tags apt JOIN tags t ON t.id = apt.tag_id WHERE apt.access_point_id = ap_id)
+        )
+        FROM location l JOIN building b ON b.id = l.building_id
+        WHERE l.id = ap_location_id
+    $$
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION access_point_search_document(ap_id integer, ap_location_id integer, ap_remarks text) RETURNS tsvector
+    LANGUAGE sql STABLE AS $$
+        SELECT setweight(to_tsvector('{SEARCH_CONFIG}', concat_ws(' ', b.name, b.acronym, b.short_name)), 'A')
+            || setweight(to_tsvector('{SEARCH_CONFIG}', concat_ws(' ',
+                l.nickname,
+                lpad(l.room_number::text, 3, '0'),
+                access_point_room_string(l.floor_number, l.room_number)
+            )), 'B')
+            || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(
+                (SELECT string_agg(t.name, ' ') FROM access_point_tags apt JOIN tags t ON t.id = apt.tag_id WHERE apt.access_point_id = ap_id),
+                ''
+            )), 'B')
+            || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(ap_remarks, '')), 'C')
+        FROM location l JOIN building b ON b.id = l.building_id
+        WHERE l.id = ap_location_id
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.text_search_index := access_point_search_document(NEW.id, NEW.location_id, NEW.remarks);
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION location_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE location_id = NEW.id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION building_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE location_id IN (SELECT id FROM location WHERE building_id = NEW.id);
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_tags_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        target_id integer;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            target_id := OLD.access_point_id;
+        ELSE
+            target_id := NEW.access_point_id;
+        END IF;
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE id = target_id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tags_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE id IN (SELECT access_point_id FROM access_point_tags WHERE tag_id = NEW.id);
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER access_point_search_index_update
+    BEFORE INSERT OR UPDATE OF remarks, location_id ON access_point
+    FOR EACH ROW EXECUTE FUNCTION access_point_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER location_search_index_update
+    AFTER UPDATE OF nickname, floor_number, room_number, building_id ON location
+    FOR EACH ROW EXECUTE FUNCTION location_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER building_search_index_update
+    AFTER UPDATE OF name, acronym, short_name ON building
+    FOR EACH ROW EXECUTE FUNCTION building_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER access_point_tags_search_index_update
+    AFTER INSERT OR UPDATE OR DELETE ON access_point_tags
+    FOR EACH ROW EXECUTE FUNCTION access_point_tags_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER tags_search_index_update
+    AFTER UPDATE OF name ON tags
+    FOR EACH ROW EXECUTE FUNCTION tags_search_index_trigger()
+    """,
+]
+
+# Which cache version each table's data feeds. Versions are bumped by the app, once per committed transaction
+# that wrote to any of these tables, in a short transaction of its own after the commit. Bumping from triggers
+# inside the writing transaction would hold the version row's lock until commit, serialising every writer on it
+CACHE_VERSION_TABLES = {
+    "access_point": "map",
+    "location": "map",
+    "building": "map",
+    "access_point_current_status": "map",
+}
+# The "images" version isn't bumped by table. The near-duplicate index adds new images as it finds them,
+# so only rehashing existing images bumps it (with touched_cache_versions)
+
+
+def touched_cache_versions(session) -> set:
+    """The cache versions the session's current transaction will bump when it commits"""
+    return session.info.setdefault("cache_versions", set())
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_flushed_cache_versions(session, flush_context):
+    # new, dirty and deleted still hold what was just flushed at this point
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        for table in inspect(obj).mapper.tables:
+            if table.name in CACHE_VERSION_TABLES:
+                touched_cache_versions(session).add(CACHE_VERSION_TABLES[table.name])
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_executed_cache_versions(orm_execute_state):
+    # bulk INSERT/UPDATE/DELETE statements don't go through the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None and table.name in CACHE_VERSION_TABLES:
+            touched_cache_versions(orm_execute_state.session).add(CACHE_VERSION_TABLES[table.name])
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_committed_cache_versions(session):
+    names = session.info.pop("cache_versions", None)
+    if names:
+        bump_cache_versions(session.get_bind(), names)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_cache_versions(session):
+    session.info.pop("cache_versions", None)
+
+
+def bump_cache_versions(bind, names):
+    """Increment some cache versions in their own transaction. Rows are locked in name order, so concurrent bumps can't deadlock"""
+    upsert = pg_insert(CacheVersion).values([{"name": name, "version": 1} for name in sorted(names)])
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[CacheVersion.name],
+        set_={"version": CacheVersion.version + 1},
+    )
+    with bind.begin() as connection:
+        connection.execute(upsert)
+
+
+# create_all only knows about tables, so install the triggers once every table exists
+for statement in SEARCH_INDEX_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+
+db = SQLAlchemy(model_class=Base)
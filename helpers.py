@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from collections import OrderedDict
 import enum
 from dateutil import parser
 from datetime import datetime, timezone
@@ -7,6 +8,8 @@ from bs4 import BeautifulSoup
 from flask import session
 import requests
 import os
+import threading
+import time
 
 ANY_FLOOR_CHAR = "_"
 
@@ -184,13 +187,34 @@ class ServiceNowStatus:
 
 
 
-def get_auth0_user_roles(user_id):
+# Auth0 lookups happen on nearly every page render, so keep one pooled session
+# and cache both the management API token and each user's roles
+AUTH0_TIMEOUT = (3.05, 10) # (connect, read) seconds
+AUTH0_ROLE_CACHE_TTL = 300 # seconds
+AUTH0_ROLE_CACHE_SIZE = 1024 # users, least recently used are dropped first
+# refresh the management token this long before Auth0 says it expires
+AUTH0_TOKEN_EXPIRY_MARGIN = 60 # seconds
+
+_auth0_session = requests.Session()
+_auth0_lock = threading.Lock()
+_auth0_management_token = {"access_token": None, "expires_at": 0}
+_auth0_role_cache = OrderedDict() # user id -> (expires_at, roles), least recently used first
+
+
+def get_auth0_management_token(force_refresh=False):
+    """Get a token for the Auth0 management API, reusing the cached one until it expires
+
+    Args:
+        force_refresh (bool, optional): fetch a new token even if the cached one has not expired. Defaults to False.
+    """
+    with _auth0_lock:
+        if not force_refresh and _auth0_management_token["expires_at"] > time.monotonic():
+            return _auth0_management_token["access_token"]
 
     auth0_domain = os.environ.get("AUTH0_DOMAIN")
     client_id = os.environ.get("AUTH0_CLIENT_ID")
     client_secret = os.environ.get("AUTH0_CLIENT_SECRET")
-        
-    # Step 1: Get Management API token
+
     token_url = f"https://{auth0_domain}/oauth/token"
     token_payload = {
         "client_id": client_id,
@@ -199,27 +223,84 @@ def get_auth0_user_roles(user_id):
         "grant_type": "client_credentials"
     }
     
-    token_response = requests.post(token_url, json=token_payload)
+    token_response = _auth0_session.post(token_url, json=token_payload, timeout=AUTH0_TIMEOUT)
     if token_response.status_code != 200:
         raise Exception(f"Error fetching token: {token_response.text}")
     
-    access_token = token_response.json()["access_token"]
+    token_json = token_response.json()
+    with _auth0_lock:
+        _auth0_management_token["access_token"] = token_json["access_token"]
+        _auth0_management_token["expires_at"] = time.monotonic() + token_json.get("expires_in", 0) - AUTH0_TOKEN_EXPIRY_MARGIN
+    return token_json["access_token"]
+
+
+def get_auth0_user_roles(user_id, use_cache=True):
+    """Get the roles assigned to a user in Auth0
+
+    Args:
+        user_id (str): the Auth0 user id
+        use_cache (bool, optional): whether a cached result (up to AUTH0_ROLE_CACHE_TTL seconds old) may be returned. Defaults to True.
+
+    Returns:
+        list: the role objects for this user
+    """
+    if use_cache:
+        with _auth0_lock:
+            cached = _auth0_role_cache.get(user_id)
+            if cached is not None:
+                _auth0_role_cache.move_to_end(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
 
-    # Step 2: Query user roles
+    auth0_domain = os.environ.get("AUTH0_DOMAIN")
     roles_url = f"https://{auth0_domain}/api/v2/users/{user_id}/roles"
-    headers = {
+
+    access_token = get_auth0_management_token()
+    roles_response = _auth0_session.get(roles_url, headers={
         "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}"
-    }
-    
-    roles_response = requests.get(roles_url, headers=headers)
+    }, timeout=AUTH0_TIMEOUT)
+
+    if roles_response.status_code == 401:
+        # the token may have been revoked before it expired
+        access_token = get_auth0_management_token(force_refresh=True)
+        roles_response = _auth0_session.get(roles_url, headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {access_token}"
+        }, timeout=AUTH0_TIMEOUT)
+
     if roles_response.status_code != 200:
         raise Exception(f"Error fetching user roles: {roles_response.text}")
 
     roles = roles_response.json()
+    now = time.monotonic()
+    with _auth0_lock:
+        _auth0_role_cache[user_id] = (now + AUTH0_ROLE_CACHE_TTL, roles)
+        _auth0_role_cache.move_to_end(user_id)
+        for expired in [uid for uid, (expires_at, _) in _auth0_role_cache.items() if expires_at <= now]:
+            del _auth0_role_cache[expired]
+        while len(_auth0_role_cache) > AUTH0_ROLE_CACHE_SIZE:
+            _auth0_role_cache.popitem(last=False)
     return roles  # List of role objects
 
 
+def invalidate_auth0_user_roles(user_id=None):
+    """Drop cached roles for a user (or for every user if no id is given)
+    """
+    with _auth0_lock:
+        if user_id is None:
+            _auth0_role_cache.clear()
+        else:
+            _auth0_role_cache.pop(user_id, None)
+
+
+def refresh_auth0_user_roles(user_id):
+    """Fetch a user's roles from Auth0 and replace whatever was cached for them.
+    If the fetch fails, the cached roles (if any) are left in place
+    """
+    return get_auth0_user_roles(user_id, use_cache=False)
+
+
 def check_for_admin_role(user_id):
     if user_id is None:
         return False
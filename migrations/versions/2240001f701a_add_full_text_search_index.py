@@ -0,0 +1,190 @@
+"""add full text search index to access points
+
+Revision ID: 2240001f701a
+Revises: f65df1206667
+Create Date: 2026-10-16 11:02:47.118394
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '2240001f701a'
+down_revision = 'f65df1206667'
+branch_labels = None
+depends_on = None
+
+
+# copied from db.SEARCH_INDEX_DDL at the time of this revision
+SEARCH_INDEX_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION access_point_room_string(floor_number integer, room_number integer) RETURNS text
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT CASE
+            WHEN floor_number < 0 THEN chr(ascii('A') - floor_number - 1)
+            WHEN floor_number = 0 THEN '_'
+            ELSE floor_number::text
+        END || lpad(room_number::text, 3, '0')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_search_text(ap_id integer, ap_location_id integer, ap_remarks text) RETURNS text
+    LANGUAGE sql STABLE AS $$
+        SELECT concat_ws(' ',
+            b.name, b.acronym, b.short_name,
+            l.nickname, access_point_room_string(l.floor_number, l.room_number),
+            ap_remarks,
+            (SELECT string_agg(t.name, ' ') FROM access_point_tags apt JOIN tags t ON t.id = apt.tag_id WHERE apt.access_point_id = ap_id)
+        )
+        FROM location l JOIN building b ON b.id = l.building_id
+        WHERE l.id = ap_location_id
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_search_document(ap_id integer, ap_location_id integer, ap_remarks text) RETURNS tsvector
+    LANGUAGE sql STABLE AS $$
+        SELECT setweight(to_tsvector('english', concat_ws(' ', b.name, b.acronym, b.short_name)), 'A')
+            || setweight(to_tsvector('english', concat_ws(' ',
+                l.nickname,
+                lpad(l.room_number::text, 3, '0'),
+                access_point_room_string(l.floor_number, l.room_number)
+            )), 'B')
+            || setweight(to_tsvector('english', coalesce(
+                (SELECT string_agg(t.name, ' ') FROM access_point_tags apt JOIN tags t ON t.id = apt.tag_id WHERE apt.access_point_id = ap_id),
+                ''
+            )), 'B')
+            || setweight(to_tsvector('english', coalesce(ap_remarks, '')), 'C')
+        FROM location l JOIN building b ON b.id = l.building_id
+        WHERE l.id = ap_location_id
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.text_search_index := access_point_search_document(NEW.id, NEW.location_id, NEW.remarks);
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION location_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE location_id = NEW.id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION building_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE location_id IN (SELECT id FROM location WHERE building_id = NEW.id);
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION access_point_tags_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        target_id integer;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            target_id := OLD.access_point_id;
+        ELSE
+            target_id := NEW.access_point_id;
+        END IF;
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE id = target_id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tags_search_index_trigger() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)
+        WHERE id IN (SELECT access_point_id FROM access_point_tags WHERE tag_id = NEW.id);
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER access_point_search_index_update
+    BEFORE INSERT OR UPDATE OF remarks, location_id ON access_point
+    FOR EACH ROW EXECUTE FUNCTION access_point_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER location_search_index_update
+    AFTER UPDATE OF nickname, floor_number, room_number, building_id ON location
+    FOR EACH ROW EXECUTE FUNCTION location_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER building_search_index_update
+    AFTER UPDATE OF name, acronym, short_name ON building
+    FOR EACH ROW EXECUTE FUNCTION building_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER access_point_tags_search_index_update
+    AFTER INSERT OR UPDATE OR DELETE ON access_point_tags
+    FOR EACH ROW EXECUTE FUNCTION access_point_tags_search_index_trigger()
+    """,
+    """
+    CREATE TRIGGER tags_search_index_update
+    AFTER UPDATE OF name ON tags
+    FOR EACH ROW EXECUTE FUNCTION tags_search_index_trigger()
+    """
+]
+
+TRIGGERS = [
+    ("access_point_search_index_update", "access_point"),
+    ("location_search_index_update", "location"),
+    ("building_search_index_update", "building"),
+    ("access_point_tags_search_index_update", "access_point_tags"),
+    ("tags_search_index_update", "tags"),
+]
+
+FUNCTIONS = [
+    "tags_search_index_trigger()",
+    "access_point_tags_search_index_trigger()",
+    "building_search_index_trigger()",
+    "location_search_index_trigger()",
+    "access_point_search_index_trigger()",
+    "access_point_search_document(integer, integer, text)",
+    "access_point_search_text(integer, integer, text)",
+    "access_point_room_string(integer, integer)",
+]
+
+
+def upgrade():
+    # searchAccessPoints has always queried this column, but no revision ever created it.
+    # Some databases may have one added by hand, so start from a clean slate.
+    op.execute("ALTER TABLE access_point DROP COLUMN IF EXISTS text_search_index")
+
+    with op.batch_alter_table('access_point', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('text_search_index', postgresql.TSVECTOR(), nullable=True))
+        batch_op.create_index('ix_access_point_text_search_index', ['text_search_index'], unique=False, postgresql_using='gin')
+
+    for statement in SEARCH_INDEX_DDL:
+        op.execute(statement)
+
+    # backfill existing rows
+    op.execute("UPDATE access_point SET text_search_index = access_point_search_document(id, location_id, remarks)")
+
+
+def downgrade():
+    for trigger, table in TRIGGERS:
+        op.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+    for function in FUNCTIONS:
+        op.execute(f"DROP FUNCTION IF EXISTS {function}")
+
+    with op.batch_alter_table('access_point', schema=None) as batch_op:
+        batch_op.drop_index('ix_access_point_text_search_index', postgresql_using='gin')
+        batch_op.drop_column('text_search_index')
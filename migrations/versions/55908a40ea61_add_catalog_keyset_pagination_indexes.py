@@ -0,0 +1,40 @@
+"""add catalog keyset pagination indexes
+
+Revision ID: 55908a40ea61
+Revises: 2240001f701a
+Create Date: 2026-10-16 11:48:05.930671
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '55908a40ea61'
+down_revision = '2240001f701a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The catalog is sorted by (building.name, coalesce(location.nickname, ''), access_point.id),
+    # which spans three tables, so each table gets an index matching its part of the key.
+    with op.batch_alter_table('building', schema=None) as batch_op:
+        batch_op.create_index('ix_building_name_id', ['name', 'id'], unique=False)
+
+    with op.batch_alter_table('location', schema=None) as batch_op:
+        batch_op.create_index('ix_location_building_id_nickname', ['building_id', sa.text("coalesce(nickname, '')")], unique=False)
+
+    with op.batch_alter_table('access_point', schema=None) as batch_op:
+        batch_op.create_index('ix_access_point_location_id_id_active', ['location_id', 'id'], unique=False, postgresql_where=sa.text('active'))
+
+
+def downgrade():
+    with op.batch_alter_table('access_point', schema=None) as batch_op:
+        batch_op.drop_index('ix_access_point_location_id_id_active', postgresql_where=sa.text('active'))
+
+    with op.batch_alter_table('location', schema=None) as batch_op:
+        batch_op.drop_index('ix_location_building_id_nickname')
+
+    with op.batch_alter_table('building', schema=None) as batch_op:
+        batch_op.drop_index('ix_building_name_id')
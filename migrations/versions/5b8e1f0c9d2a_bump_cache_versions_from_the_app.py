@@ -0,0 +1,52 @@
+"""bump cache versions from the app
+
+Revision ID: 5b8e1f0c9d2a
+Revises: 2cb6fa963908
+Create Date: 2026-10-17 09:12:40.118305
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1f0c9d2a'
+down_revision = '2cb6fa963908'
+branch_labels = None
+depends_on = None
+
+
+MAP_TABLES = ["access_point", "location", "building", "access_point_current_status"]
+
+
+def upgrade():
+    # the app now bumps versions after commit (db.CACHE_VERSION_TABLES), so the triggers that held
+    # the cache_version row lock for the rest of every writing transaction go
+    for table in MAP_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_map_cache_version ON {table}")
+    op.execute("DROP TRIGGER IF EXISTS images_phash_cache_version ON images")
+    op.execute("DROP FUNCTION IF EXISTS bump_cache_version()")
+
+
+def downgrade():
+    # copied from b18d14ad90ff and 83909debbb57
+    op.execute("""
+    CREATE OR REPLACE FUNCTION bump_cache_version() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO cache_version (name, version) VALUES (TG_ARGV[0], 1)
+        ON CONFLICT (name) DO UPDATE SET version = cache_version.version + 1;
+        RETURN NULL;
+    END
+    $$
+    """)
+    for table in MAP_TABLES:
+        op.execute(f"""
+        CREATE TRIGGER {table}_map_cache_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version('map')
+        """)
+    op.execute("""
+    CREATE TRIGGER images_phash_cache_version
+    AFTER INSERT OR UPDATE OF perceptual_hash OR DELETE OR TRUNCATE ON images
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version('images')
+    """)
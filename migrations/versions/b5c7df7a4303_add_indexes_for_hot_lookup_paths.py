@@ -0,0 +1,45 @@
+"""add indexes for hot lookup paths
+
+Revision ID: b5c7df7a4303
+Revises: 55908a40ea61
+Create Date: 2026-10-16 13:20:44.508212
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c7df7a4303'
+down_revision = '55908a40ea61'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_access_point_reports_access_point_id', 'access_point_reports', ['access_point_id']),
+    ('ix_report_status_report_id_timestamp', 'report_status', ['report_id', 'timestamp']),
+    ('ix_access_point_image_relation_access_point_id_ordering', 'access_point_image_relation', ['access_point_id', 'ordering']),
+    ('ix_images_fullsizehash', 'images', ['fullsizehash']),
+    ('ix_access_point_tags_access_point_id', 'access_point_tags', ['access_point_id']),
+    ('ix_location_building_id_floor_number_room_number', 'location', ['building_id', 'floor_number', 'room_number']),
+    ('ix_report_ref', 'report', ['ref']),
+    ('ix_building_acronym', 'building', ['acronym']),
+    ('ix_access_point_concordances_identifier', 'access_point_concordances', ['identifier']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, but it doesn't lock the tables against writes.
+    # A concurrent build that fails partway leaves an INVALID index behind, which IF NOT EXISTS would silently keep,
+    # so any existing index is dropped and built again instead
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,91 @@
+# File: perceptual_hash.py
+# Perceptual hashing and near-duplicate lookup for images
+
+from PIL import Image as PilImage
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def dhash(pil_img) -> int:
+    """Compute the difference hash (dHash) of an image.
+
+    The image is shrunk to 9x8 greyscale pixels and each bit records whether a pixel is brighter than its right-hand
+    neighbour, so re-encoding, resizing or slightly recolouring a photo barely changes the hash.
+
+    Returns:
+        int: the 64 bit hash, as a signed integer so it fits a Postgres BIGINT
+    """
+    # draft lets the JPEG decoder skip most of the work when the image hasn't been decoded yet
+    pil_img.draft("L", ((HASH_SIZE + 1) * 8, HASH_SIZE * 8))
+    small = pil_img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), PilImage.Resampling.BOX)
+    pixels = small.load()
+
+    value = 0
+    for y in range(HASH_SIZE):
+        for x in range(HASH_SIZE):
+            value = (value << 1) | (pixels[x, y] > pixels[x + 1, y])
+
+    # unsigned -> two's complement
+    return value - (1 << HASH_BITS) if value >> (HASH_BITS - 1) else value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """The number of bits that differ between two hashes"""
+    return bin((a ^ b) & HASH_MASK).count("1")
+
+
+class BKTree:
+    """A BK-tree of perceptual hashes.
+
+    Each child edge is labelled with its distance from the parent, and the triangle inequality means a search
+    only has to follow edges within `max_distance` of the query's distance to the node,
+    which skips most of the tree for small distances.
+    """
+
+    def __init__(self):
+        self._root = None # [hash, ids, {distance: child}]
+        self.size = 0
+
+    def add(self, value: int, item_id):
+        """Add a hash, with the id of the item it belongs to. Items with identical hashes share a node"""
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item_id], {}]
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item_id], {}]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, object]]:
+        """Find every item whose hash is within `max_distance` bits of `value`
+
+        Returns:
+            list[tuple[int, object]]: (distance, item id) pairs, closest first
+        """
+        results = []
+        if self._root is None:
+            return results
+
+        nodes = [self._root]
+        while nodes:
+            node_value, ids, children = nodes.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                results.extend((distance, item_id) for item_id in ids)
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+
+        results.sort(key=lambda r: r[0])
+        return results
@@ -2,54 +2,326 @@
 # TunnelVision s3 API calls
 # Written by Steven Greene for CSH audiophiler
 
+import logging
 import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 import magic
-from io import BufferedReader
+from storage import Storage, UploadError
+
+logger = logging.getLogger(__name__)
+
+
+# not every python version knows these, and the content type is guessed from the key
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
 
 
 # based on https://github.com/boto/s3transfer/issues/80#issuecomment-482534256
-class NonCloseableBufferedReader(BufferedReader):
+# a plain wrapper rather than a BufferedReader, which can't wrap a SpooledTemporaryFile before python 3.11
+class NonCloseableFile:
+    """Passes reads and seeks through to a file-like object, but ignores close() so boto3 can't close it"""
+
+    def __init__(self, f):
+        self._f = f
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
     def close(self):
-        self.flush()
+        pass
+
+
+# the most keys a single delete_objects request accepts
+DELETE_BATCH_SIZE = 1000
+
+
+class PresignedUrlCache:
+    """A bounded, thread-safe LRU cache of presigned URLs.
+
+    Time is split into windows of `ttl` seconds and entries are keyed by (object key, window),
+    so the same object gets a byte-identical URL for the whole window (which lets browsers cache the image)
+    and a fresh one once the window rolls over.
+    """
+
+    def __init__(self, ttl=600, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def window(self, now=None):
+        """Returns the index of the time window containing `now`"""
+        now = time.time() if now is None else now
+        return int(now // self.ttl)
+
+    def get(self, key, window):
+        with self._lock:
+            url = self._entries.get((key, window))
+            if url is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((key, window))
+            self.hits += 1
+            return url
+
+    def put(self, key, window, url):
+        with self._lock:
+            self._entries[(key, window)] = url
+            self._entries.move_to_end((key, window))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
 
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
 
-class S3Bucket:
 
-    def __init__(self, name, key, secret, endpoint):
+class S3Stats:
+    """Thread-safe counters of calls, errors, bytes transferred and latency for each kind of S3 operation.
+    Latency percentiles are calculated from the most recent `sample_size` calls of each operation
+    """
+
+    def __init__(self, sample_size=1024):
+        self.sample_size = sample_size
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, transferred=0, error=False):
+        with self._lock:
+            op = self._operations.get(operation)
+            if op is None:
+                op = self._operations[operation] = {
+                    "calls": 0, "errors": 0, "bytes": 0, "seconds": 0.0, "max": 0.0,
+                    "samples": deque(maxlen=self.sample_size),
+                }
+            op["calls"] += 1
+            op["errors"] += error
+            op["bytes"] += transferred
+            op["seconds"] += seconds
+            op["max"] = max(op["max"], seconds)
+            op["samples"].append(seconds)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: maps each operation to its counters, with latencies in milliseconds
+        """
+        with self._lock:
+            operations = {name: (dict(op), sorted(op["samples"])) for name, op in self._operations.items()}
+
+        def percentile(samples, p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 1)
+
+        return {
+            name: {
+                "calls": op["calls"],
+                "errors": op["errors"],
+                "bytes": op["bytes"],
+                "mean_ms": round(op["seconds"] / op["calls"] * 1000, 1),
+                "p50_ms": percentile(samples, 0.5),
+                "p95_ms": percentile(samples, 0.95),
+                "p99_ms": percentile(samples, 0.99),
+                "max_ms": round(op["max"] * 1000, 1),
+            }
+            for name, (op, samples) in operations.items()
+        }
+
+
+class S3Bucket(Storage):
+
+    def __init__(self, name, key, secret, endpoint, url_expires_in=900, url_cache_ttl=600, url_cache_size=4096, upload_concurrency=8,
+                 multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, multipart_concurrency=2,
+                 max_pool_connections=32, connect_timeout=5, read_timeout=30, max_attempts=5):
+        """
+        Args:
+            url_expires_in (int, optional): how long presigned URLs are valid for, in seconds. Must be longer than `url_cache_ttl`
+            url_cache_ttl (int, optional): how long a presigned URL is reused for, in seconds
+            url_cache_size (int, optional): the maximum number of presigned URLs to keep cached
+            upload_concurrency (int, optional): the maximum number of uploads `upload_files` runs at once, across all callers
+            multipart_threshold (int, optional): files larger than this many bytes are transferred in parts
+            multipart_chunksize (int, optional): the size of each part, in bytes
+            multipart_concurrency (int, optional): how many parts of one file are transferred at once.
+                Each transfer buffers about `multipart_chunksize * multipart_concurrency` bytes (or the whole file, under the threshold)
+            max_pool_connections (int, optional): how many connections each process keeps open to S3.
+                Requests beyond this wait for a free connection, so it should cover `upload_concurrency * multipart_concurrency`
+                plus whatever else runs at once
+            connect_timeout (float, optional): seconds to wait for a connection before retrying
+            read_timeout (float, optional): seconds to wait for data on an open connection before retrying
+            max_attempts (int, optional): attempts per request, including the first. Retries back off adaptively,
+                and slow down all requests from the process while S3 is throttling
+        """
+        # a URL can be handed out right up until the end of its cache window, so it needs to outlive the window
+        # by enough to actually be fetched
+        if url_expires_in <= url_cache_ttl:
+            raise ValueError(f"url_expires_in ({url_expires_in}s) must be greater than url_cache_ttl ({url_cache_ttl}s)")
+
         self.name = name
+        self.url_expires_in = url_expires_in
+        self.url_cache = PresignedUrlCache(ttl=url_cache_ttl, max_size=url_cache_size)
+        self.stats = S3Stats()
+        self._upload_concurrency = upload_concurrency
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=multipart_concurrency,
+        )
+        self.client_config = Config(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={"mode": "adaptive", "total_max_attempts": max_attempts},
+        )
+
+        self._credentials = (key, secret, endpoint)
+        self._pid = None
+        self._connect_lock = threading.Lock()
+        # connections and threads can't be shared with a forked child (like a gunicorn worker), so it starts from scratch
+        os.register_at_fork(after_in_child=self._forget_connection)
 
-        self._session = boto3.session.Session()
+    def _forget_connection(self):
+        self._pid = None
+        self._connect_lock = threading.Lock()
+        self.stats = S3Stats()
 
-        self._client = self._session.client(
+    def reconnect(self):
+        """(Re)create the client and upload threads. This happens automatically the first time each process uses the bucket"""
+        with self._connect_lock:
+            self._connect()
+
+    def _connect(self):
+        key, secret, endpoint = self._credentials
+        # sessions aren't thread safe, but the client made from one is
+        session = boto3.session.Session()
+
+        self._s3 = session.client(
             service_name="s3",
             aws_access_key_id=key,
             aws_secret_access_key=secret,
             endpoint_url=endpoint,
+            config=self.client_config,
         )
+        self._pool = ThreadPoolExecutor(max_workers=self._upload_concurrency, thread_name_prefix="s3-upload")
+        self._pid = os.getpid()
+
+    def _ensure_connected(self):
+        if self._pid != os.getpid():
+            with self._connect_lock:
+                if self._pid != os.getpid():
+                    self._connect()
+
+    @property
+    def _client(self):
+        """This process's client"""
+        self._ensure_connected()
+        return self._s3
+
+    @property
+    def _upload_pool(self):
+        """This process's upload threads"""
+        self._ensure_connected()
+        return self._pool
+
+    @contextmanager
+    def _timed(self, operation):
+        """Record the latency of the operation in the block, and whether it failed.
+        The block can set "bytes" on the yielded dict to count the bytes it transferred
+        """
+        measured = {"bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield measured
+        except Exception:
+            self.stats.record(operation, time.perf_counter() - started, measured["bytes"], error=True)
+            raise
+        self.stats.record(operation, time.perf_counter() - started, measured["bytes"])
 
     def get_file(self, file_hash, download_to):
         """Download the file to the specified path"""
-        with open(download_to, "wb") as f:
-            self._client.download_fileobj(self.name, file_hash, f)
+        with open(download_to, "wb") as f, self._timed("download") as measured:
+            self._client.download_fileobj(self.name, file_hash, f, Config=self.transfer_config)
+            measured["bytes"] = f.seek(0, os.SEEK_END)
+
+    def download_file(self, file_hash, f):
+        """Download the file into the provided (writable, seekable) file-like object, and rewind it"""
+        with self._timed("download") as measured:
+            self._client.download_fileobj(self.name, file_hash, f, Config=self.transfer_config)
+            measured["bytes"] = f.seek(0, os.SEEK_END)
+        f.seek(0)
 
     def get_file_s3(self, file_hash):
         """Get the path to the file specified by file_hash"""
-        # Generates presigned URL that lasts for 60 seconds (1 minute)
+        # Generates presigned URL that lasts for `url_expires_in` seconds
         # If streaming begins prior to the time cutoff, s3 will allow
         # for the streaming to continue, uninterrupted.
+        # URLs are cached and reused for the rest of their cache window
         if file_hash is None:
             print(f"Failed to fetch {file_hash}")
-            url = "../static/images/logo_tilted.png"
-        else:
+            return "../static/images/logo_tilted.png"
+
+        window = self.url_cache.window()
+        url = self.url_cache.get(file_hash, window)
+        if url is None:
             url = self._client.generate_presigned_url(
                 "get_object",
                 Params={"Bucket": self.name, "Key": file_hash},
-                ExpiresIn=90,
+                ExpiresIn=self.url_expires_in,
             )
+            self.url_cache.put(file_hash, window, url)
 
         return url
 
+    def open_file(self, file_hash, byte_range=None):
+        """Open a streaming handle to a file in the bucket
+
+        Args:
+            file_hash (str): the key of the file to open
+            byte_range (str, optional): an HTTP Range header value (e.g. "bytes=0-1023") to fetch only part of the file. Defaults to None.
+
+        Returns:
+            dict: the boto3 get_object response. "Body" is a stream that the caller must close
+        """
+        params = {"Bucket": self.name, "Key": file_hash}
+        if byte_range is not None:
+            params["Range"] = byte_range
+        # this only times the response headers; the body is streamed by the caller
+        with self._timed("get_object") as measured:
+            response = self._client.get_object(**params)
+            measured["bytes"] = response.get("ContentLength", 0)
+        return response
+
+    def file_exists(self, file_hash):
+        """Check whether a file is in the bucket, using a HEAD request"""
+        with self._timed("head_object"):
+            try:
+                self._client.head_object(Bucket=self.name, Key=file_hash)
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                    return False
+                raise
+        return True
+
+    def file_size(self, file_hash):
+        """Get the size of a file in the bucket, in bytes, using a HEAD request"""
+        with self._timed("head_object"):
+            return self._client.head_object(Bucket=self.name, Key=file_hash)["ContentLength"]
+
     # def get_date_modified(self, file_hash):
     #     # Get date modified for a specific file in the bucket
     #     date =  self._client.get_object(self.name, file_hash).get("LastModified")
@@ -76,14 +348,95 @@ class S3Bucket:
             # less than 2048 bytes may produce incorrect identification, but unsure if this applies to image file types
             content_type = mgk.from_buffer(f.read(2048))
             f.seek(0)
-        # Upload the file
-        buffer = NonCloseableBufferedReader(f)
-        self._client.upload_fileobj(
-            buffer, self.name, file_hash, ExtraArgs={"ContentType": content_type}
-        )
-        buffer.detach()
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        # Upload the file. Large files are sent as a multipart upload
+        with self._timed("upload") as measured:
+            self._client.upload_fileobj(
+                NonCloseableFile(f), self.name, file_hash,
+                ExtraArgs={"ContentType": content_type},
+                Config=self.transfer_config,
+            )
+            measured["bytes"] = size
+
+    def copy_file(self, source_hash, file_hash):
+        """Copy a file within the bucket, without downloading it"""
+        with self._timed("copy_object"):
+            self._client.copy_object(
+                Bucket=self.name,
+                Key=file_hash,
+                CopySource={"Bucket": self.name, "Key": source_hash},
+            )
+
+    def upload_files(self, uploads):
+        """Uploads several files in parallel. Either every file is uploaded, or none are:
+        if any upload fails, the ones that succeeded are removed again and an UploadError listing every failure is raised
+
+        Only pass keys that weren't already in the bucket, since rolling back deletes them.
+
+        Args:
+            uploads (list[tuple[str, file-like object]]): (key, file) pairs to upload. The key is also used to detect the content type
+        """
+        if not uploads:
+            return
+
+        futures = {
+            self._upload_pool.submit(self.upload_file, key, f, filename=key): key
+            for key, f in uploads
+        }
+        wait(futures)
+
+        failures = {key: future.exception() for future, key in futures.items() if future.exception() is not None}
+        if not failures:
+            return
+
+        rollback_failures = {}
+        for future, key in futures.items():
+            if future.exception() is None:
+                try:
+                    self.remove_file(key)
+                except Exception as e:
+                    logger.warning(f"Failed to roll back upload of {key}, it is now orphaned: {e}")
+                    rollback_failures[key] = e
+        raise UploadError(failures, rollback_failures)
+
+    def list_files(self, prefix=""):
+        """Yield every object in the bucket whose key starts with `prefix`, paging through list_objects_v2
+
+        Yields:
+            dict: the listing entry of each object, with (among others) "Key", "Size" and "LastModified"
+        """
+        pages = iter(self._client.get_paginator("list_objects_v2").paginate(Bucket=self.name, Prefix=prefix))
+        while True:
+            with self._timed("list_objects_v2"):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield from page.get("Contents", [])
+
+    def remove_files(self, file_hashes):
+        """Remove many files, DELETE_BATCH_SIZE per request. Keys that don't exist count as removed
+
+        Returns:
+            dict: maps each key that couldn't be removed to the error S3 gave for it
+        """
+        file_hashes = list(file_hashes)
+        failures = {}
+        for start in range(0, len(file_hashes), DELETE_BATCH_SIZE):
+            with self._timed("delete_objects"):
+                response = self._client.delete_objects(
+                    Bucket=self.name,
+                    Delete={
+                        "Objects": [{"Key": key} for key in file_hashes[start:start + DELETE_BATCH_SIZE]],
+                        "Quiet": True, # only report failures
+                    },
+                )
+            for error in response.get("Errors", []):
+                failures[error["Key"]] = f"{error.get('Code')}: {error.get('Message')}"
+        return failures
 
     def remove_file(self, file_hash):
         # Does anybody read these comments
         # yes
-        self._client.delete_object(Bucket=self.name, Key=file_hash)
+        with self._timed("delete_object"):
+            self._client.delete_object(Bucket=self.name, Key=file_hash)
@@ -0,0 +1,306 @@
+# File: storage.py
+# Where image files are kept: the interface every storage backend implements, and a local filesystem backend
+
+from abc import ABC, abstractmethod
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+
+class UploadError(Exception):
+    """Raised when one or more uploads in a batch fail. Every upload from the batch that did succeed has been removed again,
+    except any listed in `rollback_failures`
+
+    Attributes:
+        failures (dict): maps each key that failed to upload to the exception it raised
+        rollback_failures (dict): maps each key that was uploaded but couldn't be removed again (and so is orphaned) to the exception
+    """
+
+    def __init__(self, failures, rollback_failures=None):
+        self.failures = failures
+        self.rollback_failures = rollback_failures or {}
+        message = f"{len(failures)} upload(s) failed: " + ", ".join(f"{key} ({e})" for key, e in failures.items())
+        if self.rollback_failures:
+            message += f"; {len(self.rollback_failures)} upload(s) could not be rolled back: " + ", ".join(self.rollback_failures)
+        super().__init__(message)
+
+
+class Storage(ABC):
+    """A flat store of files by key (like "<hash>_thumb.jpg"). S3Bucket (s3.py) and LocalStorage implement it"""
+
+    @abstractmethod
+    def get_file(self, file_hash, download_to):
+        """Download the file to the specified path"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def download_file(self, file_hash, f):
+        """Download the file into the provided (writable, seekable) file-like object, and rewind it"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_file_s3(self, file_hash):
+        """Get a URL the file can be fetched from"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open_file(self, file_hash, byte_range=None):
+        """Open a streaming handle to a file
+
+        Args:
+            file_hash (str): the key of the file to open
+            byte_range (str, optional): an HTTP Range header value (e.g. "bytes=0-1023") to fetch only part of the file. Defaults to None.
+
+        Returns:
+            dict: in the shape of a boto3 get_object response: "Body" (a stream the caller must close, with `read` and `iter_chunks`),
+                "ContentLength", "ContentType" and, for ranges, "ContentRange"
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def file_exists(self, file_hash):
+        raise NotImplementedError
+
+    @abstractmethod
+    def file_size(self, file_hash):
+        """Get the size of a file, in bytes"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload_file(self, file_hash, f, filename=""):
+        """Store the whole contents of a file-like object under the key. The file is rewound first,
+        so a buffer that has already been read is still stored in full"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload_files(self, uploads):
+        """Store several files. Either every file is stored, or none are: if any upload fails,
+        the ones that succeeded are removed again and an UploadError listing every failure is raised
+
+        Only pass keys that weren't already stored, since rolling back deletes them.
+
+        Args:
+            uploads (list[tuple[str, file-like object]]): (key, file) pairs to upload
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def copy_file(self, source_hash, file_hash):
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_files(self, prefix=""):
+        """Yield every stored file whose key starts with `prefix`
+
+        Yields:
+            dict: "Key", "Size" and "LastModified" (an aware datetime) of each file
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_files(self, file_hashes):
+        """Remove many files. Keys that don't exist count as removed
+
+        Returns:
+            dict: maps each key that couldn't be removed to the error
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_file(self, file_hash):
+        raise NotImplementedError
+
+    def local_path(self, file_hash):
+        """The path of the file on this machine's filesystem, if the backend keeps it there, so it can be served directly
+
+        Returns:
+            str: the path, or None for remote backends
+        """
+        return None
+
+
+class LocalFileBody:
+    """Reads up to `length` bytes of an open file, like the body of a boto3 get_object response"""
+
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size=64 * 1024):
+        while chunk := self.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        self._f.close()
+
+
+# the process umask, read once at import: it can only be read by setting it, which isn't safe once threads are running
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+# keys become file names, so they can't contain path separators or start with a dot (temporary files do)
+LOCAL_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+RANGE_PATTERN = re.compile(r"^bytes=(?P<start>[0-9]*)-(?P<end>[0-9]*)$")
+
+
+class LocalStorage(Storage):
+    """Keeps files in a directory on the local filesystem, for single server installs, development and benchmarks.
+
+    Files are spread over two levels of subdirectories named after the first characters of their key
+    (so "d41d8cd9..._thumb.jpg" is stored at "d4/1d/d41d8cd9..._thumb.jpg"), which keeps directories small
+    since keys start with a content hash. Writes go to a temporary file that is renamed into place,
+    so a file is either missing or complete, never partly written.
+    """
+
+    def __init__(self, root, url_prefix="/storage"):
+        """
+        Args:
+            root (str): the directory to keep files in. Created if it doesn't exist
+            url_prefix (str, optional): the URL files are served under (by the app or a web server), used by get_file_s3
+        """
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, file_hash):
+        if not LOCAL_KEY_PATTERN.match(file_hash):
+            raise ValueError(f"Invalid storage key {file_hash!r}")
+        return os.path.join(self.root, file_hash[:2], file_hash[2:4], file_hash)
+
+    def _write(self, file_hash, write):
+        """Atomically create or replace a file, by calling `write` with a temporary file in the same directory and renaming it"""
+        path = self.local_path(file_hash)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                # mkstemp makes files only their owner can read, but a web server serving them directly may run as someone else
+                os.fchmod(temp.fileno(), 0o666 & ~_UMASK)
+                write(temp)
+                temp.flush()
+                os.fsync(temp.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        # make the rename itself durable
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def get_file(self, file_hash, download_to):
+        shutil.copyfile(self.local_path(file_hash), download_to)
+
+    def download_file(self, file_hash, f):
+        with open(self.local_path(file_hash), "rb") as stored:
+            shutil.copyfileobj(stored, f)
+        f.seek(0)
+
+    def get_file_s3(self, file_hash):
+        if file_hash is None:
+            return "../static/images/logo_tilted.png"
+        return f"{self.url_prefix}/{file_hash}"
+
+    def open_file(self, file_hash, byte_range=None):
+        f = open(self.local_path(file_hash), "rb")
+        size = os.fstat(f.fileno()).st_size
+        response = {
+            "ContentType": mimetypes.guess_type(file_hash)[0] or "application/octet-stream",
+            "ContentLength": size,
+        }
+        if byte_range is not None:
+            match = RANGE_PATTERN.match(byte_range)
+            if match is None or not (match["start"] or match["end"]):
+                f.close()
+                raise ValueError(f"Unsupported range {byte_range!r}")
+            if match["start"]:
+                start = int(match["start"])
+                end = min(int(match["end"]), size - 1) if match["end"] else size - 1
+            else:
+                # a suffix range: the last N bytes
+                start = max(size - int(match["end"]), 0)
+                end = size - 1
+            if start > end:
+                f.close()
+                raise ValueError(f"Range {byte_range!r} is outside the file")
+            f.seek(start)
+            response["ContentLength"] = end - start + 1
+            response["ContentRange"] = f"bytes {start}-{end}/{size}"
+        response["Body"] = LocalFileBody(f, response["ContentLength"])
+        return response
+
+    def file_exists(self, file_hash):
+        return os.path.isfile(self.local_path(file_hash))
+
+    def file_size(self, file_hash):
+        return os.path.getsize(self.local_path(file_hash))
+
+    def upload_file(self, file_hash, f, filename=""):
+        f.seek(0)
+        self._write(file_hash, lambda temp: shutil.copyfileobj(f, temp))
+
+    def upload_files(self, uploads):
+        stored = []
+        failures = {}
+        for key, f in uploads:
+            try:
+                self.upload_file(key, f)
+                stored.append(key)
+            except Exception as e:
+                failures[key] = e
+        if not failures:
+            return
+
+        rollback_failures = {}
+        for key in stored:
+            try:
+                self.remove_file(key)
+            except OSError as e:
+                rollback_failures[key] = e
+        raise UploadError(failures, rollback_failures)
+
+    def copy_file(self, source_hash, file_hash):
+        with open(self.local_path(source_hash), "rb") as source:
+            self._write(file_hash, lambda temp: shutil.copyfileobj(source, temp))
+
+    def list_files(self, prefix=""):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.startswith(".") or not name.startswith(prefix):
+                    continue
+                stat = os.stat(os.path.join(directory, name))
+                yield {
+                    "Key": name,
+                    "Size": stat.st_size,
+                    "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                }
+
+    def remove_files(self, file_hashes):
+        failures = {}
+        for key in file_hashes:
+            try:
+                self.remove_file(key)
+            except OSError as e:
+                failures[key] = str(e)
+        return failures
+
+    def remove_file(self, file_hash):
+        try:
+            os.unlink(self.local_path(file_hash))
+        except FileNotFoundError:
+            pass